@@ -16,7 +16,7 @@ from werkzeug.wrappers import Response
 
 from .config import Config, config
 from .forms import LoginForm, LogOutForm, CreateSubForm
-from .models import db_init_app, rconn, User, SiteMetadata
+from .models import db_init_app, rconn, SiteMetadata
 from .auth import auth_provider, email_validation_is_required
 from .views import do, subs as sub, api3, jwt
 from .views.auth import bp as auth
@@ -32,9 +32,13 @@ from .views.messages import bp as messages
 
 from . import misc, forms, caching, storage
 from .notifications import notifications
+from .votes import vote_counters
+from .comment_views import comment_views
+from .site_stats import site_stats
+from .search import sub_names
 from .socketio import socketio
 from .misc import SiteAnon, engine, re_amention, mail, talisman, limiter
-from .misc import logging_init_app, get_locale, babel
+from .misc import logging_init_app, get_locale, babel, markdown_cache
 from .email_manager import EmailManager
 
 # /!\ FOR DEBUGGING ONLY /!\
@@ -99,6 +103,13 @@ def create_app(config=None):
     login_manager.init_app(app)
     db_init_app(app)
     re_amention.init_app(app)
+    markdown_cache.init_app(app)
+    vote_counters.init_app(app)
+    comment_views.init_app(app)
+    site_stats.init_app(app)
+    sub_names.init_app(app)
+    if not config.app.testing:
+        config.start_snapshot_listener()
     if "MAIL_SERVER" in app.config:
         mail.init_app(app)
     storage.storage_init_app(app)
@@ -185,7 +196,13 @@ def create_app(config=None):
             diff = "unknown"
         if not hasattr(g, "pqc"):
             g.pqc = 0
-        app.logger.info("%s (%s ms, %s queries)", response.status, diff, g.pqc)
+        app.logger.info(
+            "%s (%s ms, %s queries, %s ms waiting for the database)",
+            response.status,
+            diff,
+            g.pqc,
+            int(g.get("db_wait", 0)),
+        )
         if not app.debug:
             return response  # We won't do this if we're in production mode
         if app.config["THROAT_CONFIG"].app.development:
@@ -240,7 +257,6 @@ def load_user(user_id):
     unique identifier. Required for the 'remember me' functionality.
     The unique identifier is the user_id and their number of password resets."""
     splits = user_id.split("$")
-    user = User.get(User.uid == splits[0])
     resets = 0 if len(splits) == 1 else int(splits[1])
 
     if config.auth.provider == "KEYCLOAK" and config.auth.keycloak.use_oidc:
@@ -248,7 +264,8 @@ def load_user(user_id):
         if session.get("exp_time", 0) < time.time():
             return None
 
+    user = misc.load_user(splits[0])
     if resets == user.resets:
-        return misc.load_user(user.uid)
+        return user
     else:
         return None
@@ -26,6 +26,7 @@ from .models import (
     Sub,
     SubSubscriber,
 )
+from .site_stats import site_stats
 
 logger = logging.getLogger("throat_auth")
 
@@ -173,6 +174,7 @@ class AuthProvider:
             email=email,
             joindate=datetime.utcnow(),
         )
+        site_stats.add(users=1)
         self.set_user_auth_source(user, auth_source)
         self._set_email_verified(user, verified_email)
         return user
@@ -525,7 +527,7 @@ def create_user(username, password, email, invite_code, existing_user):
     if prefs:
         UserMetadata.insert(prefs).execute()
 
-    from .misc import getDefaultSubs
+    from .misc import getDefaultSubs, invalidate_session_snapshot
 
     defaults = getDefaultSubs()
     subs = [
@@ -536,4 +538,5 @@ def create_user(username, password, email, invite_code, existing_user):
     Sub.update(subscribers=Sub.subscribers + 1).where(
         Sub.sid << [x["sid"] for x in defaults]
     ).execute()
+    invalidate_session_snapshot(user.uid)
     return user
@@ -1,5 +1,5 @@
 """ Here we store badges. """
-from .storage import FILE_NAMESPACE, mtype_from_file, calculate_file_hash, store_file
+from .storage import FILE_NAMESPACE, spool_upload, store_file
 from peewee import JOIN
 from .models import Badge, UserMetadata, SubMod
 from flask_babel import lazy_gettext as _l
@@ -122,14 +122,16 @@ class Badges:
 
 
 def gen_icon(icon):
-    mtype = mtype_from_file(icon, allow_video_formats=False)
+    spool, mtype, fhash = spool_upload(icon, allow_video_formats=False)
     if mtype is None:
         raise Exception(_l("Invalid file type. Only jpg, png and gif allowed."))
 
-    fhash = calculate_file_hash(icon)
-    basename = str(uuid.uuid5(FILE_NAMESPACE, fhash))
-    f_name = store_file(icon, basename, mtype, remove_metadata=True)
-    return f_name
+    with spool:
+        basename = str(uuid.uuid5(FILE_NAMESPACE, fhash))
+        try:
+            return store_file(spool, basename, mtype, remove_metadata=True)
+        except ValueError:
+            raise Exception(_l("Invalid file type. Only jpg, png and gif allowed."))
 
 
 badges = Badges()
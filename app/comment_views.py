@@ -0,0 +1,116 @@
+""" Records the comments seen by users, optionally in batches """
+import logging
+from collections import Counter
+import gevent
+from gevent import monkey
+from peewee import ValuesList
+from .models import db, rconn, SubPostComment, SubPostCommentView
+
+# Redis set holding the "uid:pid:cid" of the views not yet recorded.
+PENDING_KEY = "comment-views"
+
+
+def record_comment_views(views):
+    """Store the views of comments given as (uid, pid, cid) tuples, adding
+    them to the view counts and the best scores of the comments. Uses one
+    UPDATE for all the comments, however many there are. Views already
+    recorded are ignored. Returns the number of views stored."""
+    from .misc import best_score_sql
+
+    views = set(views)
+    if not views:
+        return 0
+    cids = {cid for _, _, cid in views}
+    seen = set(
+        SubPostCommentView.select(SubPostCommentView.uid, SubPostCommentView.cid)
+        .where(SubPostCommentView.cid << list(cids))
+        .tuples()
+    )
+    views = [(uid, pid, cid) for uid, pid, cid in views if (uid, cid) not in seen]
+    if not views:
+        return 0
+
+    counts = Counter(cid for _, _, cid in views)
+    # VALUES columns are named column1, column2... by Postgres and SQLite.
+    new = ValuesList(list(counts.items()), alias="new_views")
+    views_after = SubPostComment.views + new.c.column2
+    with db.atomic():
+        SubPostComment.update(
+            views=views_after,
+            best_score=best_score_sql(
+                SubPostComment.upvotes, SubPostComment.downvotes, views_after
+            ),
+        ).from_(new).where(SubPostComment.cid == new.c.column1).execute()
+        SubPostCommentView.insert_many(
+            [{"uid": uid, "pid": pid, "cid": cid} for uid, pid, cid in views]
+        ).execute()
+    return len(views)
+
+
+class CommentViews(object):
+    """When enabled, the comments seen by users are added to a set in Redis
+    instead of being written to the database right away, and a background
+    greenlet records them every `interval` seconds, so the view counts of a
+    busy thread are updated with a few statements instead of one per comment
+    per user."""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.interval = 10
+        self.batch_size = 1000
+        self.logger = logging.getLogger(__name__)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        conf = app.config["THROAT_CONFIG"].app.view_batching
+        self.enabled = conf.enabled
+        self.interval = conf.interval
+        self.batch_size = conf.batch_size
+        self.logger = logging.getLogger(app.logger.name + ".comment_views")
+        if self.enabled and monkey.is_module_patched("os"):
+            gevent.spawn(self.flush_forever, app)
+
+    def add(self, uid, views):
+        """Record that user `uid` saw the comments given as (pid, cid)."""
+        if not self.enabled:
+            return record_comment_views((uid, pid, cid) for pid, cid in views)
+        members = ["{0}:{1}:{2}".format(uid, pid, cid) for pid, cid in views]
+        if members:
+            rconn.sadd(PENDING_KEY, *members)
+        return 0
+
+    @staticmethod
+    def pending():
+        """Return the number of views not yet recorded."""
+        return rconn.scard(PENDING_KEY)
+
+    def flush(self):
+        """Record all the pending views. Returns the number stored."""
+        count = 0
+        while True:
+            members = rconn.spop(PENDING_KEY, self.batch_size)
+            if not members:
+                return count
+            views = []
+            for member in members:
+                uid, pid, cid = member.decode().split(":")
+                views.append((uid, int(pid), cid))
+            try:
+                count += record_comment_views(views)
+            except Exception:
+                # Put the views back so they are not lost.
+                rconn.sadd(PENDING_KEY, *members)
+                raise
+
+    def flush_forever(self, app):
+        while True:
+            gevent.sleep(self.interval)
+            try:
+                with app.app_context():
+                    self.flush()
+            except Exception:  # noqa
+                self.logger.exception("Failed to record comment views")
+
+
+comment_views = CommentViews()
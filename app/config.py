@@ -1,5 +1,8 @@
 """ Config manager """
 import os
+import threading
+import time
+import uuid
 from pathlib import Path
 import yaml
 from flask import current_app
@@ -74,9 +77,17 @@ defaults = {  # key => default value
         "max_content_length": 10485760,  # 10mb
         "fallback_language": "en",
         "testing": False,
+        "markdown_cache": {"size": 4096, "redis_ttl": 0},
+        "vote_batching": {"enabled": False, "interval": 5},
+        "view_batching": {"enabled": False, "interval": 10, "batch_size": 1000},
+        "site_stats": {"interval": 300, "reconcile_interval": 86400},
+        "socketio": {"shards": 0, "resubscribe_interval": 5, "coalesce_window": 0.5},
+        "session_cache": {"ttl": 600},
+        "config_cache": {"ttl": 60},
+        "search": {"language": "english", "name_index_ttl": 300},
     },
     "aws": {},
-    "database": {"autoconnect": False},
+    "database": {"autoconnect": False, "pool": False},
     "ratelimit": {"default": "60/minute"},
     "notifications": {"fcm_api_key": None},
     "matrix": {"enabled": False},
@@ -565,6 +576,82 @@ add_database_source(configurable_defaults)
 cfg_defaults = add_values_to_config(configurable_defaults, defaults, "default")
 
 
+class ConfigSnapshot:
+    """Process-local copy of the values of all the config keys stored in the
+    database, so reading them is a dictionary lookup. The whole copy is
+    reloaded in one bulk fetch from the cache, falling back to the database,
+    when it is older than `ttl` seconds or when another process announces
+    a change through Redis."""
+
+    CHANNEL = "config-updates"
+
+    def __init__(self, model, cache, ttl=60):
+        self._model = model
+        self._cache = cache
+        self.ttl = ttl
+        self.keys = []
+        self._values = {}
+        self._expires = 0
+        # Used to ignore our own announcements.
+        self._origin = uuid.uuid4().hex
+
+    def get(self, key):
+        if time.time() >= self._expires:
+            self.reload()
+        return self._values.get(key)
+
+    def reload(self):
+        values = dict(zip(self.keys, self._cache.get_many(*self.keys)))
+        missing = [key for key, val in values.items() if val is None]
+        if missing:
+            query = self._model.select(self._model.key, self._model.value)
+            found = {r.key: r.value for r in query.where(self._model.key << missing)}
+            for key in missing:
+                if key not in found:
+                    # Did you add a new config key? If so, write a migration to
+                    # add it to SiteMetadata.
+                    logging.warning(f"{key} is not present in SiteMetadata")
+            if found:
+                self._cache.set_many(found)
+            values.update(found)
+        self._values = values
+        self._expires = time.time() + self.ttl
+
+    def set(self, key, val):
+        """Store a new value locally and tell the other processes to
+        reload their copies."""
+        self._values[key] = val
+        from .models import rconn
+
+        rconn.publish(self.CHANNEL, f"{self._origin} {key}")
+
+    def invalidate(self):
+        self._expires = 0
+
+    def start_listener(self):
+        """Start a thread (or greenlet, if gevent has patched threading)
+        which invalidates this copy when another process changes a value."""
+        thread = threading.Thread(target=self.listen, daemon=True)
+        thread.start()
+
+    def listen(self):
+        from .models import rconn
+
+        while True:
+            try:
+                pubsub = rconn.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(self.CHANNEL)
+                # Changes may have been missed while we were not subscribed.
+                self.invalidate()
+                for message in pubsub.listen():
+                    origin, _key = message["data"].decode().split(" ", 1)
+                    if origin != self._origin:
+                        self.invalidate()
+            except Exception:  # noqa
+                logging.exception("Lost subscription to config updates")
+                time.sleep(5)
+
+
 class Map:
     """A dictionary-like object whose keys are accessable as attributes,
     constructed from a nested dictionary structure like
@@ -579,22 +666,24 @@ class Map:
         model=None,
         cache=None,
         prefixes=None,
+        snapshot=None,
     ):
         """Create a Map from the dictionary sdict.
 
         Mutable values will be stored in the database and cached in
-        the cache."""
+        the cache, and in the snapshot if one is given."""
 
         self._content = {}
         self._prefixes = [] if prefixes is None else prefixes
         self._model = model
         self._cache = cache
+        self._snapshot = snapshot
 
         for key, val in sdict.items():
             self._content[key] = dict(val)
             if val["type"] == "map":
                 self._content[key]["value"] = Map(
-                    val["value"], model, cache, self._prefixes + [key]
+                    val["value"], model, cache, self._prefixes + [key], snapshot
                 )
 
     def get_mutable_items(self):
@@ -639,6 +728,8 @@ class Map:
         """Get the value for a key from the cache or the database. Return
         None if no value has been set in the backing store."""
         key = self._key_name_from_attr(attr)
+        if self._snapshot is not None:
+            return self._snapshot.get(key)
         val = self._cache.get(key)
         if val is None:
             try:
@@ -739,6 +830,8 @@ class Map:
                     f"Value for config.{prefix}.{attr} is missing from database"
                 )
             self._cache.set(key, val)
+            if self._snapshot is not None:
+                self._snapshot.set(key, val)
 
 
 class Config(Map):
@@ -765,11 +858,29 @@ class Config(Map):
             env = get_environment_values(config)
             config = add_values_to_config(config, env, "environment")
 
-        super(Config, self).__init__(config, model, cache)
+        snapshot = None
+        if model is not None and cache is not None:
+            snapshot = ConfigSnapshot(model, cache)
+        super(Config, self).__init__(config, model, cache, snapshot=snapshot)
+        if snapshot is not None:
+            snapshot.ttl = self.app.config_cache.ttl
+            snapshot.keys = [key for key, _, _ in self.mutable_item_configuration()]
         self.check_storage_config()
         self.check_auth_config()
         self.check_ratelimit_config()
 
+    def invalidate_snapshot(self):
+        """Make the next read of a value stored in the database reload them
+        all. Needed after changing them without `update_value`."""
+        if self._snapshot is not None:
+            self._snapshot.invalidate()
+
+    def start_snapshot_listener(self):
+        """Listen for changes made to the values stored in the database by
+        other processes."""
+        if self._snapshot is not None:
+            self._snapshot.start_listener()
+
     def check_storage_config(self):
         """Adjust our storage config for compatibility with flask-cloudy."""
         storage = self.storage
@@ -10,10 +10,11 @@ import random
 import time
 import os
 import re
+import threading
 import gevent
 from gevent import monkey
 import ipaddress
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from functools import wraps
 
 from bs4 import BeautifulSoup
@@ -45,11 +46,13 @@ from tinycss2.ast import (
 )
 
 from .config import config
-from flask_login import AnonymousUserMixin, current_user, logout_user
+from flask_login import AnonymousUserMixin, current_user, logout_user, user_logged_in
 from flask_babel import Babel, _
 from flask_talisman import Talisman
 from .caching import cache
 from .socketio import socketio
+from .votes import vote_counters
+from .site_stats import site_stats
 from .badges import badges
 from .auth import auth_provider
 
@@ -98,7 +101,7 @@ from .models import (
 )
 
 from .storage import file_url, thumbnail_url
-from peewee import JOIN, fn, SQL, NodeList, Value
+from peewee import JOIN, fn, SQL, NodeList, Value, Tuple, Case
 import logging
 import logging.config
 from werkzeug.local import LocalProxy
@@ -174,7 +177,9 @@ talisman = Talisman()
 class SiteUser(object):
     """Representation of a site user. Used on the login manager."""
 
-    def __init__(self, userclass=None, subs=(), prefs=()):
+    def __init__(
+        self, userclass=None, subs=(), prefs=(), subs_modded=None, badge_xp=None
+    ):
         self.user = userclass
         self.notifications = self.user.get("notifications", 0)
         self.open_reports = self.user.get("open_reports", 0)
@@ -216,12 +221,17 @@ class SiteUser(object):
         self.is_anonymous = True if self.user["status"] != 0 else False
         # True if the user is an admin, even without authing with TOTP
 
-        self.subs_modded = [
-            s.sid
-            for s in Sub.select(Sub.sid)
-            .join(SubMod)
-            .where((SubMod.user == self.uid) & ~SubMod.invite)
-        ]
+        if subs_modded is None:
+            subs_modded = [
+                s.sid
+                for s in Sub.select(Sub.sid)
+                .join(SubMod)
+                .where((SubMod.user == self.uid) & ~SubMod.invite)
+            ]
+        self.subs_modded = subs_modded
+        if badge_xp is None:
+            badge_xp = sum(b.score for b in badges.badges_for_user(self.uid))
+        self.badge_xp = badge_xp
         self.is_a_mod = len(self.subs_modded) > 0
 
         self.can_admin = "admin" in self.prefs
@@ -241,14 +251,13 @@ class SiteUser(object):
         if config.site.allow_uploads and config.site.upload_min_level == 0:
             self.canupload = True
         elif config.site.allow_uploads and (
-            config.site.upload_min_level <= get_user_level(self.uid, self.score)[0]
+            config.site.upload_min_level <= self.get_user_level()[0]
         ):
             self.canupload = True
 
     def can_pm_users(self):
         return (
-            config.site.send_pm_to_user_min_level
-            <= get_user_level(self.uid, self.score)[0]
+            config.site.send_pm_to_user_min_level <= self.get_user_level()[0]
             or self.admin
         )
 
@@ -331,10 +340,9 @@ class SiteUser(object):
         """Returns true if user selects to block sub styles"""
         return "nostyles" in self.prefs
 
-    @cache.memoize(300)
     def get_user_level(self):
         """Returns the level and xp of a user."""
-        return get_user_level(self.uid, self.score)
+        return level_from_xp(self.score + self.badge_xp)
 
     def get_top_bar(self):
         return self.top_bar
@@ -350,6 +358,7 @@ class SiteUser(object):
             umd.save()
         except UserMetadata.DoesNotExist:
             UserMetadata.create(uid=self.uid, key=key, value=value)
+        invalidate_session_snapshot(self.uid)
 
     @cache.memoize(30)
     def get_global_stylesheet(self):
@@ -540,7 +549,127 @@ md = m.Markdown(
 )
 
 
+# Bump this when a change to `our_markdown` alters the generated HTML, so
+# that previously rendered content is not served from the caches.
+MARKDOWN_RENDERER_VERSION = 1
+
+
+class MarkdownCache:
+    """Bounded in-process LRU of rendered markdown, optionally backed by a
+    shared Redis tier. Entries are keyed by a hash of the text, the sub
+    prefix used for mentions and the renderer version."""
+
+    def __init__(self, app=None, size=4096):
+        self.size = size
+        self.redis_ttl = 0
+        self.prefix = ""
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        conf = app.config["THROAT_CONFIG"]
+        self.size = conf.app.markdown_cache.size
+        self.redis_ttl = conf.app.markdown_cache.redis_ttl
+        self.prefix = conf.site.sub_prefix
+        self.clear()
+
+    def key(self, text):
+        key = "{0}\0{1}\0{2}".format(MARKDOWN_RENDERER_VERSION, self.prefix, text)
+        digest = hashlib.sha1(key.encode())
+        return "md-" + digest.hexdigest()
+
+    def get(self, key):
+        try:
+            html = self._entries[key]
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return html
+        except KeyError:
+            pass
+        if self.redis_ttl:
+            html = rconn.get(key)
+            if html is not None:
+                self.shared_hits += 1
+                html = html.decode()
+                self._store(key, html)
+                return html
+        self.misses += 1
+        return None
+
+    def set(self, key, html):
+        self._store(key, html)
+        if self.redis_ttl:
+            rconn.setex(key, value=html, time=self.redis_ttl)
+
+    def _store(self, key, html):
+        if self.size <= 0:
+            return
+        self._entries[key] = html
+        while len(self._entries) > self.size:
+            try:
+                self._entries.popitem(last=False)
+            except KeyError:
+                break
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.shared_hits = self.misses = 0
+
+    def info(self):
+        """Hit and miss counters of this process."""
+        return {
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "max_size": self.size,
+        }
+
+
+markdown_cache = MarkdownCache()
+
+
 def our_markdown(text):
+    """Renders `text`, using the markdown cache if possible."""
+    key = markdown_cache.key(text)
+    html = markdown_cache.get(key)
+    if html is None:
+        html = render_markdown(text)
+        markdown_cache.set(key, html)
+    return html
+
+
+def rendered_fields(content):
+    """Returns the `content_html` and `html_version` values to store along
+    with `content`, so it doesn't have to be rendered again when read."""
+    if content is None:
+        return {"content_html": None, "html_version": None}
+    return {
+        "content_html": our_markdown(content),
+        "html_version": MARKDOWN_RENDERER_VERSION,
+    }
+
+
+def render_content(item):
+    """Updates the stored rendering of the content of a post or comment
+    instance. The caller must save it."""
+    for field, value in rendered_fields(item.content).items():
+        setattr(item, field, value)
+
+
+def stored_markdown(content, content_html, html_version):
+    """Returns the stored rendering of `content` if it was made by the
+    current renderer, otherwise renders it."""
+    if content_html is not None and html_version == MARKDOWN_RENDERER_VERSION:
+        return content_html
+    return our_markdown(content)
+
+
+def render_markdown(text):
     """Here we create a custom markdown function where we load all the
     extensions we need."""
 
@@ -846,6 +975,9 @@ def workWithMentions(data, receivedby, post, _sub, cid=None, c_user=current_user
                         sender=c_user.uid,
                         target=user.uid,
                     )
+                # Mentions are hidden from users who blocked the sender,
+                # unless either of them is a mod of the sub.
+                invalidate_unread_counts(user.uid)
                 socketio.emit(
                     "notification",
                     {"count": get_notification_count(user.uid)},
@@ -861,6 +993,32 @@ def getDomain(link):
     return x.netloc
 
 
+def domain_key(host):
+    """Returns the labels of a host name in reverse order, lowercased and
+    followed by a dot, so that a domain and all its subdomains share a
+    prefix: "www.Example.com" becomes "com.example.www."."""
+    labels = host.lower().strip(".").split(".")
+    return ".".join(reversed(labels)) + "."
+
+
+def link_domain(link):
+    """Returns the value of `SubPost.domain` for a link, or None if it has
+    no host name."""
+    try:
+        host = urlparse(link).hostname
+    except ValueError:
+        return None
+    return domain_key(host) if host else None
+
+
+def domain_filter(domain):
+    """Returns a condition matching the posts linking to `domain` or any of
+    its subdomains, which can be served by the (domain, pid) index."""
+    key = domain_key(domain)
+    # "/" is the character after "."
+    return (SubPost.domain >= key) & (SubPost.domain < key[:-1] + "/")
+
+
 @cache.memoize(300)
 def isImage(link):
     """Returns True if link ends with img suffix"""
@@ -892,6 +1050,11 @@ def get_user_level(uid, score=None):
     userbadges = badges.badges_for_user(uid)
     for badge in userbadges:
         xp += badge.score
+    return level_from_xp(xp)
+
+
+def level_from_xp(xp):
+    """Returns the level corresponding to an amount of XP as a tuple (level, xp)"""
     if xp <= 0:  # We don't want to do the sqrt of a negative number
         return 0, xp
     level = math.sqrt(xp / 10)
@@ -1016,6 +1179,8 @@ def getSinglePost(pid):
         SubPost.nsfw,
         SubPost.sid,
         SubPost.content,
+        SubPost.content_html,
+        SubPost.html_version,
         SubPost.pid,
         SubPost.title,
         SubPost.posted,
@@ -1257,24 +1422,164 @@ def postListQueryHome(noDetail=False, nofilter=False):
         )
 
 
-def getPostList(baseQuery, sort, page, page_size=25):
+def post_hot_rank(score=SubPost.score):
+    """Returns the SQL expression for the hot rank of a post with the given
+    score. The result is stored in `SubPost.hot`, so this must be used to
+    update it whenever the score of a post changes."""
+    if "Postgresql" in config.database.engine:
+        posted = fn.EXTRACT(NodeList((SQL("EPOCH FROM"), SubPost.posted)))
+    elif "SqliteDatabase" in config.database.engine:
+        posted = fn.strftime("%s", SubPost.posted)
+    else:
+        posted = fn.Unix_Timestamp(SubPost.posted)
+
+    if config.site.custom_hot_sort:
+        return fn.HOT(score, posted)
+    return score * 20 + (posted - 1134028003) / 1500.0
+
+
+def update_post_hot_rank(pid):
+    SubPost.update(hot=post_hot_rank()).where(SubPost.pid == pid).execute()
+
+
+def undo_votes(uid, progress=None):
+    """Removes all the votes cast by a user, except those on their own
+    posts, and reverts their effect on the scores of the posts, comments and
+    users involved. Runs a fixed number of queries in one transaction, no
+    matter how many votes there are. `progress`, if given, is called with
+    the number of steps done and the total after each step. Returns the
+    number of votes removed."""
+    steps = 6
+
+    def step(done):
+        if progress is not None:
+            progress(done, steps)
+
+    def tally(vote_model, target, model, key):
+        """Upvotes and downvotes cast by `uid` by target, with its author."""
+        return (
+            vote_model.select(
+                target.alias("target"),
+                model.uid.alias("author"),
+                fn.COUNT(Case(None, [(vote_model.positive == 1, 1)])).alias("up"),
+                fn.COUNT(Case(None, [(vote_model.positive != 1, 1)])).alias("down"),
+            )
+            .join(model, on=(target == key))
+            .where(vote_model.uid == uid)
+            .group_by(target, model.uid)
+        )
+
+    # Aliased so they can't be confused with the tables being updated.
+    voted_post = SubPost.alias("voted_post")
+    voted_comment = SubPostComment.alias("voted_comment")
+    post_votes = tally(SubPostVote, SubPostVote.pid, voted_post, voted_post.pid).where(
+        voted_post.uid != uid
+    )
+    comment_votes = tally(
+        SubPostCommentVote, SubPostCommentVote.cid, voted_comment, voted_comment.cid
+    )
+
+    with db.atomic():
+        totals = post_votes.alias("pv").select_from(
+            fn.SUM(SQL("up + down")), fn.SUM(SQL("up - down"))
+        ) + comment_votes.alias("cv").select_from(
+            fn.SUM(SQL("up + down")), fn.SUM(SQL("up - down"))
+        )
+        count, given = 0, 0
+        for votes, delta in totals.tuples():
+            count += votes or 0
+            given += delta or 0
+        step(1)
+
+        pv = post_votes.alias("pv")
+        SubPost.update(
+            score=SubPost.score - (pv.c.up - pv.c.down),
+            upvotes=SubPost.upvotes - pv.c.up,
+            downvotes=SubPost.downvotes - pv.c.down,
+            hot=post_hot_rank(SubPost.score - (pv.c.up - pv.c.down)),
+        ).from_(pv).where(SubPost.pid == pv.c.target).execute()
+        step(2)
+
+        cv = comment_votes.alias("cv")
+        SubPostComment.update(
+            score=SubPostComment.score - (cv.c.up - cv.c.down),
+            upvotes=SubPostComment.upvotes - cv.c.up,
+            downvotes=SubPostComment.downvotes - cv.c.down,
+        ).from_(cv).where(SubPostComment.cid == cv.c.target).execute()
+        comments = list(
+            SubPostComment.select(SubPostComment.pid, SubPostComment.cid)
+            .join(cv, on=(cv.c.target == SubPostComment.cid))
+            .tuples()
+        )
+        step(3)
+
+        received = (
+            post_votes.alias("pv").select_from(
+                SQL("author"), SQL("up - down").alias("delta")
+            )
+            + comment_votes.alias("cv").select_from(
+                SQL("author"), SQL("up - down").alias("delta")
+            )
+        ).alias("received")
+        by_author = (
+            received.select_from(SQL("author"), fn.SUM(SQL("delta")).alias("delta"))
+            .group_by(SQL("author"))
+            .alias("by_author")
+        )
+        User.update(score=User.score - by_author.c.delta).from_(by_author).where(
+            User.uid == by_author.c.author
+        ).execute()
+        User.update(given=User.given - given).where(User.uid == uid).execute()
+        step(4)
+
+        SubPostVote.delete().where(
+            (SubPostVote.uid == uid)
+            & SubPostVote.pid.not_in(
+                SubPost.select(SubPost.pid).where(SubPost.uid == uid)
+            )
+        ).execute()
+        SubPostCommentVote.delete().where(SubPostCommentVote.uid == uid).execute()
+        step(5)
+
+    site_stats.add(upvotes=-(count + given) // 2, downvotes=-(count - given) // 2)
+    cids_by_post = defaultdict(list)
+    for pid, cid in comments:
+        cids_by_post[pid].append(cid)
+    for pid, cids in cids_by_post.items():
+        invalidate_comment_cache(pid, cids)
+    step(6)
+    return count
+
+
+def getPostList(baseQuery, sort, page, page_size=25, after=None):
+    """Returns a page of posts from `baseQuery` sorted by `sort`. If `after`
+    is the pid of a post, the page starts right after that post (keyset
+    pagination) instead of at `page`, so deep pages don't get slower. If
+    that post doesn't exist, `page` is used."""
     if sort == "top":
-        posts = baseQuery.order_by(SubPost.score.desc()).paginate(page, page_size)
+        key = SubPost.score
     elif sort == "new":
-        posts = baseQuery.order_by(SubPost.pid.desc()).paginate(page, page_size)
+        key = None
     else:
-        if "Postgresql" in config.database.engine:
-            posted = fn.EXTRACT(NodeList((SQL("EPOCH FROM"), SubPost.posted)))
-        elif "SqliteDatabase" in config.database.engine:
-            posted = fn.datetime(SubPost.posted, "unixepoch")
-        else:
-            posted = fn.Unix_Timestamp(SubPost.posted)
+        key = SubPost.hot
 
-        if config.site.custom_hot_sort:
-            hot = fn.HOT(SubPost.score, posted)
+    if after is not None and key is not None:
+        last = SubPost.select(key).where(SubPost.pid == after).scalar()
+        if last is None:
+            after = None
         else:
-            hot = SubPost.score * 20 + (posted - 1134028003) / 1500
-        posts = baseQuery.order_by(hot.desc()).limit(100).paginate(page, page_size)
+            baseQuery = baseQuery.where(Tuple(key, SubPost.pid) < Tuple(last, after))
+    elif after is not None:
+        baseQuery = baseQuery.where(SubPost.pid < after)
+
+    if key is None:
+        posts = baseQuery.order_by(SubPost.pid.desc())
+    else:
+        posts = baseQuery.order_by(key.desc(), SubPost.pid.desc())
+    if after is None:
+        posts = posts.paginate(page, page_size)
+    else:
+        posts = posts.limit(page_size)
     return [add_blur(p) for p in posts.dicts()]
 
 
@@ -1368,11 +1673,7 @@ def is_archived(post):
 
 
 def load_user(user_id):
-    mcount = select_unread_messages(user_id, fn.Count(Message.mid))
-    ncount = notification_count_query(user_id)
     user = User.select(
-        mcount.alias("messages"),
-        ncount.alias("notifications"),
         User.given,
         User.score,
         User.name,
@@ -1383,6 +1684,7 @@ def load_user(user_id):
         User.resets,
     )
     user = user.where(User.uid == user_id).dicts().get()
+    user["messages"], user["notifications"] = get_unread_counts(user_id)
     user["notifications"] += user["messages"]
 
     # This is the only user attribute needed by the error templates, so stash
@@ -1390,27 +1692,194 @@ def load_user(user_id):
     # load the user to show them the correct language.
     session["language"] = user["language"]
 
+    snapshot = get_session_snapshot(user_id)
     if request.path == "/socket.io/":
-        return SiteUser(user, [], [])
-    else:
-        prefs = UserMetadata.select(UserMetadata.key, UserMetadata.value).where(
-            UserMetadata.uid == user_id
-        )
-        prefs = prefs.where(
-            (UserMetadata.value == "1") | (UserMetadata.key == "subtheme")
-        ).dicts()
+        return SiteUser(user, [], [], snapshot["subs_modded"], snapshot["badge_xp"])
+    return SiteUser(
+        user,
+        snapshot["subs"],
+        snapshot["prefs"],
+        snapshot["subs_modded"],
+        snapshot["badge_xp"],
+    )
+
 
+# Redis hash holding the unread message and notification counts of a user.
+UNREAD_COUNTS_KEY = "unread:{0}"
+# Seconds to keep the counts of a user before recomputing them.
+UNREAD_COUNTS_TTL = 86400
+
+# Adds ARGV[2] to the ARGV[1] field of the hash if it has that field,
+# without going below zero.
+ADJUST_UNREAD_SCRIPT = """
+if redis.call('hexists', KEYS[1], ARGV[1]) == 1 then
+    if redis.call('hincrby', KEYS[1], ARGV[1], ARGV[2]) < 0 then
+        redis.call('hset', KEYS[1], ARGV[1], 0)
+    end
+end
+"""
+
+# Sets the "messages" and "notifications" fields of the hash to ARGV[1] and
+# ARGV[2] where they are missing, and returns both. Fields filled in
+# meanwhile by another process are kept, along with the adjustments made
+# to them since.
+FILL_UNREAD_SCRIPT = """
+redis.call('hsetnx', KEYS[1], 'messages', ARGV[1])
+redis.call('hsetnx', KEYS[1], 'notifications', ARGV[2])
+redis.call('expire', KEYS[1], ARGV[3])
+return redis.call('hmget', KEYS[1], 'messages', 'notifications')
+"""
+
+
+def get_unread_counts(uid):
+    """Returns the number of unread messages and unread notifications of a
+    user as a tuple. The counts are maintained in Redis by the functions
+    which send and read messages and notifications, and recomputed from
+    the database when missing."""
+    key = UNREAD_COUNTS_KEY.format(uid)
+    messages, notifications = rconn.hmget(key, "messages", "notifications")
+    if messages is not None and notifications is not None:
+        return int(messages), int(notifications)
+
+    messages, notifications = rconn.eval(
+        FILL_UNREAD_SCRIPT, 1, key, *count_unread(uid), UNREAD_COUNTS_TTL
+    )
+    return int(messages), int(notifications)
+
+
+def count_unread(uid):
+    """Counts the unread messages and unread notifications of a user in the
+    database."""
+    counts = (
+        User.select(
+            select_unread_messages(uid, fn.Count(Message.mid)).alias("messages"),
+            notification_count_query(uid).alias("notifications"),
+        )
+        .where(User.uid == uid)
+        .dicts()
+        .get()
+    )
+    return counts["messages"], counts["notifications"]
+
+
+def adjust_unread_count(uid, field, delta=1):
+    """Adds `delta` to the cached count of unread "messages" or
+    "notifications" of a user. Does nothing if the count is not cached."""
+    rconn.eval(ADJUST_UNREAD_SCRIPT, 1, UNREAD_COUNTS_KEY.format(uid), field, delta)
+
+
+def clear_unread_count(uid, field):
+    """Sets the cached count of unread "messages" or "notifications" of a
+    user to zero."""
+    key = UNREAD_COUNTS_KEY.format(uid)
+    pipe = rconn.pipeline()
+    pipe.hset(key, field, 0)
+    pipe.expire(key, UNREAD_COUNTS_TTL)
+    pipe.execute()
+
+
+def invalidate_unread_counts(*uids):
+    """Discards the cached unread counts of the given users, for changes
+    whose effect on them is not simple to work out (such as blocking an
+    user)."""
+    uids = [uid for uid in uids if uid is not None]
+    if uids:
+        rconn.delete(*[UNREAD_COUNTS_KEY.format(uid) for uid in uids])
+
+
+def repair_unread_counts(save=True):
+    """Compares every cached unread count with the database. Returns a list
+    of (uid, cached, actual) tuples for the users whose counts were wrong,
+    and fixes them if `save` is True."""
+    wrong = []
+    for key in rconn.scan_iter(match=UNREAD_COUNTS_KEY.format("*"), count=500):
+        uid = key.decode().split(":", 1)[1]
+        cached = rconn.hmget(key, "messages", "notifications")
+        cached = tuple(None if v is None else int(v) for v in cached)
         try:
-            subs = (
-                SubSubscriber.select(SubSubscriber.sid, Sub.name, SubSubscriber.status)
-                .join(Sub, on=(Sub.sid == SubSubscriber.sid))
-                .switch(SubSubscriber)
-                .where(SubSubscriber.uid == user_id)
-            )
-            subs = subs.order_by(SubSubscriber.order.asc()).dicts()
-            return SiteUser(user, subs, prefs)
+            actual = count_unread(uid)
         except User.DoesNotExist:
-            return None
+            actual = None
+        if cached == actual:
+            continue
+        wrong.append((uid, cached, actual))
+        if save:
+            # Let the next read recompute them instead of racing with the
+            # increments made meanwhile.
+            rconn.delete(key)
+    return wrong
+
+
+# Redis key holding the session snapshot of a user.
+SESSION_SNAPSHOT_KEY = "user-session:{0}"
+# Incremented to discard the snapshots of all users at once.
+SESSION_GENERATION_KEY = "user-session-generation"
+
+
+def get_session_snapshot(uid):
+    """Returns the parts of a user's session which change rarely: their
+    preferences, subscriptions and blocked subs, the subs they moderate and
+    the XP given by their badges. The snapshot is kept in Redis for
+    `app.session_cache.ttl` seconds, or until it is invalidated by a change
+    to any of those."""
+    ttl = config.app.session_cache.ttl
+    key = SESSION_SNAPSHOT_KEY.format(uid)
+    generation = 0
+    if ttl:
+        generation, data = rconn.mget(SESSION_GENERATION_KEY, key)
+        generation = int(generation or 0)
+        if data is not None:
+            snapshot = json.loads(data)
+            if snapshot["generation"] == generation:
+                return snapshot
+
+    prefs = UserMetadata.select(UserMetadata.key, UserMetadata.value).where(
+        UserMetadata.uid == uid
+    )
+    prefs = prefs.where((UserMetadata.value == "1") | (UserMetadata.key == "subtheme"))
+    subs = (
+        SubSubscriber.select(SubSubscriber.sid, Sub.name, SubSubscriber.status)
+        .join(Sub, on=(Sub.sid == SubSubscriber.sid))
+        .switch(SubSubscriber)
+        .where(SubSubscriber.uid == uid)
+        .order_by(SubSubscriber.order.asc())
+    )
+    subs_modded = (
+        Sub.select(Sub.sid).join(SubMod).where((SubMod.user == uid) & ~SubMod.invite)
+    )
+    snapshot = {
+        "generation": generation,
+        "prefs": list(prefs.dicts()),
+        "subs": list(subs.dicts()),
+        "subs_modded": [s.sid for s in subs_modded],
+        "badge_xp": sum(b.score for b in badges.badges_for_user(uid)),
+    }
+    if ttl:
+        rconn.setex(key, value=json.dumps(snapshot), time=ttl)
+    return snapshot
+
+
+def invalidate_session_snapshot(*uids):
+    """Discards the cached session snapshots of the given users. Called
+    whenever something stored in the snapshot changes."""
+    uids = [uid for uid in uids if uid is not None]
+    if uids:
+        rconn.delete(*[SESSION_SNAPSHOT_KEY.format(uid) for uid in uids])
+
+
+def invalidate_all_session_snapshots():
+    """Discards the cached session snapshots of every user, for changes
+    which affect too many users to enumerate (such as editing a badge)."""
+    rconn.incr(SESSION_GENERATION_KEY)
+
+
+def discard_snapshot_on_login(sender, user, **kwargs):
+    """Start every new session with a fresh snapshot, so changes made to the
+    database outside of the site are picked up by logging in again."""
+    invalidate_session_snapshot(user.uid)
+
+
+user_logged_in.connect(discard_snapshot_on_login)
 
 
 def user_is_loaded():
@@ -1607,8 +2076,7 @@ def notification_count_query(uid):
 
 
 def get_notification_count(uid):
-    messages = select_unread_messages(uid).count()
-    notifications = notification_count_query(uid).dicts().get()["count"]
+    messages, notifications = get_unread_counts(uid)
     modmail = get_modmail_count(uid)
     return {"notifications": notifications, "messages": messages, "modmail": modmail}
 
@@ -1649,9 +2117,8 @@ def select_unread_messages(user_id, *args):
     )
 
 
-@cache.memoize(1)
 def get_unread_count():
-    return select_unread_messages(current_user.uid).count()
+    return get_unread_counts(current_user.uid)[0]
 
 
 def get_errors(form, first=False):
@@ -1862,10 +2329,11 @@ def process_msgs(msgs):
 # user comments
 
 
-def getUserComments(uid, page, include_deleted_comments=False):
+def getUserComments(uid, page, include_deleted_comments=False, after=None):
     """Returns comments for a user.  'include_deleted_comments' may be
     True, False or a list of subs, in which case deleted comments from
-    those subs will be included in the result."""
+    those subs will be included in the result.  If 'after' is the cid of
+    a comment, the comments following it are returned instead of 'page'."""
     try:
         com = (
             SubPostComment.select(
@@ -1907,7 +2375,21 @@ def getUserComments(uid, page, include_deleted_comments=False):
         if "nsfw" not in current_user.prefs:
             com = com.where(SubPost.nsfw == 0)
 
-        com = com.order_by(SubPostComment.time.desc()).paginate(page, 20).dicts()
+        last = None
+        if after is not None:
+            last = (
+                SubPostComment.select(SubPostComment.time)
+                .where(SubPostComment.cid == after)
+                .scalar()
+            )
+        com = com.order_by(SubPostComment.time.desc(), SubPostComment.cid.desc())
+        if last is not None:
+            com = com.where(
+                Tuple(SubPostComment.time, SubPostComment.cid) < Tuple(last, after)
+            ).limit(20)
+        else:
+            com = com.paginate(page, 20)
+        com = com.dicts()
     except SubPostComment.DoesNotExist:
         return False
 
@@ -2168,6 +2650,28 @@ def pick_random_security_question():
     return sc[1]
 
 
+def delete_unread_message(uid, mid):
+    """Marks a message as read by an user and updates their unread count."""
+    counted = select_unread_messages(uid).where(Message.mid == mid).exists()
+    UserUnreadMessage.delete().where(
+        (UserUnreadMessage.uid == uid) & (UserUnreadMessage.mid == mid)
+    ).execute()
+    if counted:
+        adjust_unread_count(uid, "messages", -1)
+
+
+def is_message_blocked(uid, sender, mtype):
+    """Returns True if a message of type `mtype` from `sender` is hidden from
+    the inbox of `uid`."""
+    if mtype != MessageType.USER_TO_USER:
+        return False
+    return (
+        UserMessageBlock.select()
+        .where((UserMessageBlock.uid == uid) & (UserMessageBlock.target == sender))
+        .exists()
+    )
+
+
 def create_message(mfrom, to, subject, content, mtype):
     """Creates a message."""
     posted = datetime.utcnow()
@@ -2184,6 +2688,8 @@ def create_message(mfrom, to, subject, content, mtype):
     UserUnreadMessage.create(uid=to, mid=msg.mid)
     UserMessageMailbox.create(uid=to, mid=msg.mid, mailbox=MessageMailbox.INBOX)
     UserMessageMailbox.create(uid=mfrom, mid=msg.mid, mailbox=MessageMailbox.SENT)
+    if not is_message_blocked(to, mfrom, mtype):
+        adjust_unread_count(to, "messages")
     socketio.emit(
         "notification",
         {"count": get_notification_count(to)},
@@ -2211,6 +2717,7 @@ def create_notification_message(mfrom, as_admin, sub, to, subject, content):
     UserUnreadMessage.create(uid=to, mid=msg.mid)
     UserMessageMailbox.create(uid=to, mid=msg.mid, mailbox=MessageMailbox.INBOX)
     SubMessageMailbox.create(thread=msg_thread.mtid, mailbox=MessageMailbox.PENDING)
+    adjust_unread_count(to, "messages")
     socketio.emit(
         "notification",
         {"count": get_notification_count(to)},
@@ -2252,6 +2759,8 @@ def create_message_reply(message, content):
         UserMessageMailbox.create(
             uid=recipient, mid=msg.mid, mailbox=MessageMailbox.INBOX
         )
+        if not is_message_blocked(recipient, sender, mtype):
+            adjust_unread_count(recipient, "messages")
         socketio.emit(
             "notification",
             {"count": get_notification_count(recipient)},
@@ -2447,25 +2956,80 @@ def create_reportlog(
         CommentReportLog.create(action=action, uid=uid, id=obj_id, desc=original_report)
 
 
+# Bumped to make every process reload its `BannedDomains`.
+BANNED_DOMAINS_VERSION_KEY = "banned-domains-version"
+
+
+class BannedDomains:
+    """Per-process matcher for the banned link and email domains. The bans
+    are loaded into tries keyed by the labels of the domains in reverse
+    order, so checking a domain takes one dict lookup per label no matter
+    how many domains are banned. They are loaded again when the version
+    number in Redis changes, which `invalidate` does."""
+
+    KEYS = {"link": "banned_domain", "email": "banned_email_domain"}
+    # Version of a matcher which hasn't loaded the bans yet. Unlike None, it
+    # is different from the version read when the key is missing in Redis.
+    NOT_LOADED = object()
+
+    def __init__(self):
+        self.version = self.NOT_LOADED
+        self.tries = {}
+        self.lock = threading.Lock()
+
+    def load(self, version):
+        tries = {domain_type: {} for domain_type in self.KEYS}
+        types = {key: domain_type for domain_type, key in self.KEYS.items()}
+        bans = SiteMetadata.select(SiteMetadata.key, SiteMetadata.value).where(
+            SiteMetadata.key << list(types)
+        )
+        for key, value in bans.tuples():
+            node = tries[types[key]]
+            for label in domain_key(value)[:-1].split("."):
+                node = node.setdefault(label, {})
+            node[None] = True
+        self.tries = tries
+        self.version = version
+
+    def refresh(self):
+        version = rconn.get(BANNED_DOMAINS_VERSION_KEY)
+        if version != self.version:
+            with self.lock:
+                if version != self.version:
+                    self.load(version)
+
+    def is_banned(self, domain, domain_type):
+        """Returns True if `domain`, as returned by `domain_key`, or any of
+        its parent domains is banned."""
+        self.refresh()
+        node = self.tries[domain_type]
+        for label in domain[:-1].split("."):
+            node = node.get(label)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+    @staticmethod
+    def invalidate():
+        """Make every process reload the bans. Call after changing them."""
+        rconn.incr(BANNED_DOMAINS_VERSION_KEY)
+
+
+banned_domains = BannedDomains()
+
+
 def is_domain_banned(addr, domain_type):
     if domain_type == "link":
-        key = "banned_domain"
-        netloc = urlparse(addr).netloc
+        domain = link_domain(addr)
     elif domain_type == "email":
-        key = "banned_email_domain"
-        netloc = addr.split("@")[1]
+        domain = domain_key(addr.split("@")[1])
     else:
         raise RuntimeError
-
-    bans = SiteMetadata.select().where(SiteMetadata.key == key)
-    banned_domains, banned_domains_b = ([], [])
-    for ban in bans:
-        banned_domains.append(ban.value)
-        banned_domains_b.append("." + ban.value)
-
-    if (netloc in banned_domains) or (netloc.endswith(tuple(banned_domains_b))):
-        return True
-    return False
+    if domain is None:
+        return False
+    return banned_domains.is_banned(domain, domain_type)
 
 
 def create_captcha():
@@ -2547,101 +3111,228 @@ def get_comment_query(pid, sort):
     return comments
 
 
-def get_comment_tree(
-    pid,
-    sid,
-    comments,
-    root=None,
-    only_after=None,
-    uid=None,
-    provide_context=True,
-    include_history=False,
-    postmeta=None,
-):
-    """Returns a fully paginated and expanded comment tree.
+COMMENT_SORTS = ("best", "top", "new")
 
-    TODO: Move to misc and implement globally
-    @param include_history:
-    @param pid: post for comments
-    @param sid: sub for post
-    @param comments: bare list of comments (only cid and parentcid)
-    @param root: if present, the root comment to start building the tree on
-    @param only_after: removes all siblings of `root` before the cid on its value
-    @param uid:
-    @param provide_context:
-    @param postmeta: SubPostMetadata dict if it has already been fetched
-    """
 
-    if postmeta is None:
-        postmeta = metadata_to_dict(
-            SubPostMetadata.select().where(
-                (SubPostMetadata.pid == pid) & (SubPostMetadata.key == "sticky_cid")
-            )
+@cache.memoize(60)
+def _get_comment_list(pid, sort):
+    return list(get_comment_query(pid, sort))
+
+
+def get_comment_list(pid, sort):
+    """Returns the cached, ordered list of comments (only cid and parentcid)
+    of a post. The cache is dropped by `invalidate_comment_cache`."""
+    return _get_comment_list(int(pid), sort if sort in COMMENT_SORTS else None)
+
+
+def _comment_cache_key(cid):
+    return "comment-data-{}".format(cid)
+
+
+def invalidate_comment_cache(pid, cids=()):
+    """Drops the cached comment lists of a post and the cached data of the
+    comments in `cids`. Must be called after anything that changes the
+    content, status, score or order of the comments of a post."""
+    for sort in COMMENT_SORTS + (None,):
+        cache.delete_memoized(_get_comment_list, int(pid), sort)
+    if cids:
+        cache.delete_many(*[_comment_cache_key(cid) for cid in cids])
+
+
+def get_comment_data(cid_list):
+    """Returns the viewer-independent data of the comments in `cid_list`
+    (with their content already rendered in `html`), indexed by cid.
+    Comments that are not in the cache are fetched and rendered together
+    and then cached."""
+    if not cid_list:
+        return {}
+    cached = cache.get_many(*[_comment_cache_key(cid) for cid in cid_list])
+    commdata = {cid: comm for cid, comm in zip(cid_list, cached) if comm}
+    missing = [cid for cid in cid_list if cid not in commdata]
+    if not missing:
+        return commdata
+
+    expcomms = (
+        SubPostComment.select(
+            SubPostComment.cid,
+            SubPostComment.content,
+            SubPostComment.content_html,
+            SubPostComment.html_version,
+            SubPostComment.lastedit,
+            SubPostComment.score,
+            SubPostComment.status,
+            SubPostComment.time,
+            SubPostComment.pid,
+            SubPostComment.distinguish,
+            SubPostComment.parentcid,
+            User.name.alias("user"),
+            SubPostComment.uid,
+            User.status.alias("userstatus"),
+            SubPostComment.upvotes,
+            SubPostComment.downvotes,
+            SubUserFlair.flair.alias("user_flair"),
+            SubUserFlair.flair_choice.alias("user_flair_id"),
         )
-    sticky_cid = postmeta.get("sticky_cid")
+        .join(User, on=(User.uid == SubPostComment.uid))
+        .switch(SubPostComment)
+        .join(SubPost)
+        .join(Sub)
+        .join(
+            SubUserFlair,
+            JOIN.LEFT_OUTER,
+            on=(SubUserFlair.sub == Sub.sid) & (SubUserFlair.user == User.uid),
+        )
+        .where(SubPostComment.cid << missing)
+        .dicts()
+    )
+    fetched = {}
+    for comm in expcomms:
+        comm["html"] = stored_markdown(
+            comm["content"], comm.pop("content_html"), comm.pop("html_version")
+        )
+        fetched[comm["cid"]] = comm
+    cache.set_many(
+        {_comment_cache_key(cid): comm for cid, comm in fetched.items()},
+        timeout=300,
+    )
+    commdata.update(fetched)
+    return commdata
+
+
+def get_comment_overlay(uid, sid, commdata):
+    """Returns the per-viewer data of the comments in `commdata`: the vote
+    of `uid`, whether `uid` blocked the author, whether the author is a
+    mod of the sub and whether `uid` has already seen the comment."""
+    cids = list(commdata.keys())
+    authors = list({comm["uid"] for comm in commdata.values() if comm["uid"]})
+    votes = dict(
+        SubPostCommentVote.select(SubPostCommentVote.cid, SubPostCommentVote.positive)
+        .where((SubPostCommentVote.uid == uid) & (SubPostCommentVote.cid << cids))
+        .tuples()
+    )
+    views = dict(
+        SubPostCommentView.select(SubPostCommentView.cid, SubPostCommentView.id)
+        .where((SubPostCommentView.uid == uid) & (SubPostCommentView.cid << cids))
+        .tuples()
+    )
+    blocks, mods = {}, set()
+    if authors:
+        blocks = dict(
+            UserContentBlock.select(UserContentBlock.target, UserContentBlock.method)
+            .where((UserContentBlock.uid == uid) & (UserContentBlock.target << authors))
+            .tuples()
+        )
+        mods = set(
+            mod_uid
+            for mod_uid, in SubMod.select(SubMod.uid)
+            .where((SubMod.sid == sid) & (SubMod.uid << authors) & ~SubMod.invite)
+            .tuples()
+        )
+
+    overlay = {}
+    for cid, comm in commdata.items():
+        method = blocks.get(comm["uid"])
+        overlay[cid] = {
+            "positive": votes.get(cid),
+            "hide_content": None
+            if method is None
+            else method == UserContentBlockMethod.HIDE,
+            "blur_content": None
+            if method is None
+            else method == UserContentBlockMethod.BLUR,
+            "user_is_mod": sid if comm["uid"] in mods else None,
+            "already_viewed": views.get(cid),
+        }
+    return overlay
+
+
+def build_comment_tree(comments):
+    """Builds a bare comment tree in a single pass.
+
+    `comments` is an ordered iterable of dicts with (at least) `cid` and
+    `parentcid`. Every comment gets a `children` list holding its replies in
+    the same order they had in `comments`. Returns a tuple with the list of
+    top-level comments and a dict of all the comments indexed by cid.
+    Comments whose parent is not in `comments` are left out of the tree."""
+    by_cid = {}
+    by_parent = defaultdict(list)
+    for comment in comments:
+        by_cid[comment["cid"]] = comment
+        by_parent[comment["parentcid"]].append(comment)
+
+    for cid, comment in by_cid.items():
+        comment["children"] = by_parent.get(cid, [])
+    return by_parent.get(None, []), by_cid
+
+
+def _in_comment_tree(by_cid, comment):
+    """Returns True if the chain of parents of `comment` reaches the top level."""
+    for _step in range(len(by_cid)):
+        if comment["parentcid"] is None:
+            return True
+        comment = by_cid.get(comment["parentcid"])
+        if comment is None:
+            return False
+    return False
+
+
+def _sibling_position(siblings, cid):
+    for position, comment in enumerate(siblings):
+        if comment["cid"] == cid:
+            return position
+    return None
 
-    def build_tree(tuff, rootcid=None):
-        """Builds a comment tree"""
-        res = []
-        for i in tuff[::]:
-            if i["parentcid"] == rootcid:
-                tuff.remove(i)
-                i["children"] = build_tree(tuff, rootcid=i["cid"])
-                res.append(i)
-        return res
 
+def get_comment_skeleton(
+    comments, sticky_cid=None, root=None, only_after=None, provide_context=True
+):
+    """Builds and paginates the bare comment tree.
+
+    Returns a tuple with the trimmed tree and the list of cids in it that
+    must be populated. See `get_comment_tree` for the meaning of the
+    parameters."""
     # 2 - Build bare comment tree
-    comment_tree = build_tree(list(comments))
+    comment_tree, by_cid = build_comment_tree(comments)
 
     # 2.1 - get only a branch of the tree if necessary
     if root:
-
-        def select_branch(commentslst, rootcid):
-            """Finds a branch with a certain root and returns a new tree"""
-            for i in commentslst:
-                if i["cid"] == rootcid:
-                    return i
-                k = select_branch(i["children"], rootcid)
-                if k:
-                    return k
-
-        comment_tree = select_branch(comment_tree, root)
-        if comment_tree:
-            # include the parent of the root for context.
-            if comment_tree["parentcid"] is None or not provide_context:
-                comment_tree = [comment_tree]
-            else:
-                orig_root = [
-                    x for x in list(comments) if x["cid"] == comment_tree["parentcid"]
-                ]
-                orig_root[0]["children"] = [comment_tree]
-                comment_tree = orig_root
+        branch = by_cid.get(root)
+        if branch is None or not _in_comment_tree(by_cid, branch):
+            return [], []
+        # include the parent of the root for context.
+        if branch["parentcid"] is None or not provide_context:
+            comment_tree = [branch]
         else:
-            return []
+            parent = by_cid[branch["parentcid"]]
+            parent["children"] = [branch]
+            comment_tree = [parent]
     elif sticky_cid is not None:
         # If there is a sticky comment, move it to the top.
-        elem = list(filter(lambda x: x["cid"] == sticky_cid, comment_tree))
-        if elem:
-            comment_tree.remove(elem[0])
+        position = _sibling_position(comment_tree, sticky_cid)
+        if position is not None:
+            elem = comment_tree.pop(position)
             if only_after is None:
-                comment_tree.insert(0, elem[0])
+                comment_tree.insert(0, elem)
+
+    # 2.2 - find the list of siblings holding `only_after`, if any.
+    after_siblings, after_position = None, None
+    after = by_cid.get(only_after) if only_after else None
+    if after is not None:
+        if after["parentcid"] is None or root:
+            after_position = _sibling_position(comment_tree, only_after)
+            after_siblings = comment_tree
+        if after_position is None and after["parentcid"] in by_cid:
+            after_siblings = by_cid[after["parentcid"]]["children"]
+            after_position = _sibling_position(after_siblings, only_after)
 
     # 3 - Trim tree (remove all children of depth=3 comments, all siblings after #5
     cid_list = []
-    trimmed = False
 
-    def recursive_check(tree, depth=0, trimmedtree=None, pcid=""):
+    def recursive_check(tree, depth=0, pcid=""):
         """Recursively checks tree to apply pagination limits"""
+        if after_position is not None and tree is after_siblings:
+            tree = tree[after_position + 1 :]
         or_len = len(tree)
-        if only_after and not trimmedtree:
-            imf = list(filter(lambda x: x["cid"] == only_after, tree))
-            if imf:
-                try:
-                    tree = tree[tree.index(imf[0]) + 1 :]
-                except IndexError:
-                    return []
-                or_len = len(tree)
-                trimmedtree = True
         if depth > 3:
             return [{"cid": None, "more": len(tree), "pcid": pcid}] if tree else []
         if (len(tree) > 5 and depth > 0) or (len(tree) > 10):
@@ -2660,98 +3351,64 @@ def get_comment_tree(
             if not i["cid"]:
                 continue
             cid_list.append(i["cid"])
-            i["children"] = recursive_check(
-                i["children"], depth + 1, pcid=i["cid"], trimmedtree=trimmedtree
-            )
+            i["children"] = recursive_check(i["children"], depth + 1, pcid=i["cid"])
 
         return tree
 
-    comment_tree = recursive_check(comment_tree, trimmedtree=trimmed)
+    comment_tree = recursive_check(comment_tree)
+    return comment_tree, cid_list
 
-    # 4 - Populate the tree (get all the data and cram it into the tree)
-    fields = [
-        SubPostComment.cid,
-        SubPostComment.content,
-        SubPostComment.lastedit,
-        SubPostComment.score,
-        SubPostComment.status,
-        SubPostComment.time,
-        SubPostComment.pid,
-        SubPostComment.distinguish,
-        SubPostComment.parentcid,
-        User.name.alias("user"),
-        SubPostComment.uid,
-        User.status.alias("userstatus"),
-        SubPostComment.upvotes,
-        SubPostComment.downvotes,
-        SubUserFlair.flair.alias("user_flair"),
-        SubUserFlair.flair_choice.alias("user_flair_id"),
-    ]
-    if uid:
-        fields += [
-            SubPostCommentVote.positive,
-            (UserContentBlock.method == UserContentBlockMethod.HIDE).alias(
-                "hide_content"
-            ),
-            (UserContentBlock.method == UserContentBlockMethod.BLUR).alias(
-                "blur_content"
-            ),
-            SubMod.sid.alias("user_is_mod"),
-            SubPostCommentView.id.alias("already_viewed"),
-        ]
-    else:
-        fields += [
-            Value(None).alias("hide_content"),
-            Value(None).alias("blur_content"),
-            Value(None).alias("user_is_mod"),
-        ]
-    expcomms = SubPostComment.select(*fields)
-    expcomms = (
-        expcomms.join(User, on=(User.uid == SubPostComment.uid))
-        .switch(SubPostComment)
-        .join(SubPost)
-        .join(Sub)
-        .join(
-            SubUserFlair,
-            JOIN.LEFT_OUTER,
-            on=(SubUserFlair.sub == Sub.sid) & (SubUserFlair.user == User.uid),
+
+def get_comment_tree(
+    pid,
+    sid,
+    comments,
+    root=None,
+    only_after=None,
+    uid=None,
+    provide_context=True,
+    include_history=False,
+    postmeta=None,
+):
+    """Returns a fully paginated and expanded comment tree.
+
+    TODO: Move to misc and implement globally
+    @param include_history:
+    @param pid: post for comments
+    @param sid: sub for post
+    @param comments: bare list of comments (only cid and parentcid)
+    @param root: if present, the root comment to start building the tree on
+    @param only_after: removes all siblings of `root` before the cid on its value
+    @param uid:
+    @param provide_context:
+    @param postmeta: SubPostMetadata dict if it has already been fetched
+    """
+
+    if postmeta is None:
+        postmeta = metadata_to_dict(
+            SubPostMetadata.select().where(
+                (SubPostMetadata.pid == pid) & (SubPostMetadata.key == "sticky_cid")
+            )
         )
+    sticky_cid = postmeta.get("sticky_cid")
+
+    comment_tree, cid_list = get_comment_skeleton(
+        comments,
+        sticky_cid=sticky_cid,
+        root=root,
+        only_after=only_after,
+        provide_context=provide_context,
     )
+    if root and not comment_tree:
+        return []
+
+    # 4 - Populate the tree (get all the data and cram it into the tree)
+    basedata = get_comment_data(cid_list)
     if uid:
-        expcomms = (
-            expcomms.join(
-                SubPostCommentVote,
-                JOIN.LEFT_OUTER,
-                on=(
-                    (SubPostCommentVote.uid == uid)
-                    & (SubPostCommentVote.cid == SubPostComment.cid)
-                ),
-            )
-            .join(
-                SubMod,
-                JOIN.LEFT_OUTER,
-                on=(
-                    (SubMod.uid == User.uid) & (SubMod.sid == Sub.sid) & ~SubMod.invite
-                ),
-            )
-            .join(
-                UserContentBlock,
-                JOIN.LEFT_OUTER,
-                on=(
-                    (UserContentBlock.uid == uid)
-                    & (UserContentBlock.target == User.uid)
-                ),
-            )
-            .join(
-                SubPostCommentView,
-                JOIN.LEFT_OUTER,
-                on=(
-                    (SubPostCommentView.cid == SubPostComment.cid)
-                    & (SubPostCommentView.uid == uid)
-                ),
-            )
-        )
-    expcomms = expcomms.where(SubPostComment.cid << cid_list).dicts()
+        overlay = get_comment_overlay(uid, sid, basedata)
+    else:
+        overlay = {}
+    no_overlay = {"hide_content": None, "blur_content": None, "user_is_mod": None}
 
     commdata = {}
     is_admin = current_user.is_admin()
@@ -2762,7 +3419,11 @@ def get_comment_tree(
         "lastedit": None,
         "visibility": "none",
     }
-    for comm in expcomms:
+    for cid in cid_list:
+        if cid not in basedata:
+            continue
+        comm = dict(basedata[cid])
+        comm.update(overlay.get(cid, no_overlay))
         comm["history"] = []
         comm["visibility"] = ""
         comm["sticky"] = comm["cid"] == sticky_cid
@@ -2812,6 +3473,8 @@ def get_comment_tree(
             SubPostCommentHistory.select(
                 SubPostCommentHistory.cid,
                 SubPostCommentHistory.content,
+                SubPostCommentHistory.content_html,
+                SubPostCommentHistory.html_version,
                 SubPostCommentHistory.datetime,
             )
             .where(SubPostCommentHistory.cid << cid_list)
@@ -2820,7 +3483,9 @@ def get_comment_tree(
         )
         for hist in history:
             if hist["cid"] in commdata:
-                hist["content"] = our_markdown(hist["content"])
+                hist["content"] = stored_markdown(
+                    hist["content"], hist.pop("content_html"), hist.pop("html_version")
+                )
                 commdata[hist["cid"]]["history"].append(hist)
 
     def recursive_populate(tree):
@@ -2831,8 +3496,9 @@ def get_comment_tree(
                 populated_tree.append(i)
                 continue
             comment = commdata[i["cid"]]
+            html = comment.pop("html")
             comment["source"] = comment["content"]
-            comment["content"] = our_markdown(comment["content"])
+            comment["content"] = html if comment["content"] else ""
             comment["children"] = recursive_populate(i["children"])
             populated_tree.append(comment)
         return populated_tree
@@ -2841,13 +3507,12 @@ def get_comment_tree(
     return comment_tree
 
 
-@cache.memoize(1)
 def get_notif_count():
     """
     Temporary till we get rid of the old template
      @deprecated
     """
-    return notification_count_query(current_user.uid).dicts().get()["count"]
+    return get_unread_counts(current_user.uid)[1]
 
 
 def anti_double_post(func):
@@ -2972,67 +3637,20 @@ def cast_vote(uid, target_type, pcid, value):
 
     positive = True if voteValue == 1 else False
     undone = False
-    kwargs = {}
 
     if qvote is not False:
         if bool(qvote.positive) == (True if voteValue == 1 else False):
             qvote.delete_instance()
-
-            if target_type == "comment" and target_model.views > 0:
-                kwargs["best_score"] = best_score(
-                    target.upvotes - (1 if positive else 0),
-                    target.downvotes - (0 if positive else 1),
-                    target.views,
-                )
-
-            if positive:
-                upd_q = target_model.update(
-                    score=target_model.score - voteValue,
-                    upvotes=target_model.upvotes - 1,
-                    **kwargs,
-                )
-            else:
-                upd_q = target_model.update(
-                    score=target_model.score - voteValue,
-                    downvotes=target_model.downvotes - 1,
-                    **kwargs,
-                )
             new_score = -voteValue
+            given = -voteValue
+            upvotes, downvotes = (-1, 0) if positive else (0, -1)
             undone = True
-            User.update(score=User.score - voteValue).where(
-                User.uid == target.uid
-            ).execute()
-            User.update(given=User.given - voteValue).where(User.uid == uid).execute()
         else:
             qvote.positive = positive
             qvote.save()
-
-            if target_type == "comment" and target_model.views > 0:
-                kwargs["best_score"] = best_score(
-                    target.upvotes + (1 if positive else -1),
-                    target.downvotes + (-1 if positive else 1),
-                    target.views,
-                )
-
-            if positive:
-                upd_q = target_model.update(
-                    score=target_model.score + (voteValue * 2),
-                    upvotes=target_model.upvotes + 1,
-                    downvotes=target_model.downvotes - 1,
-                    **kwargs,
-                )
-            else:
-                upd_q = target_model.update(
-                    score=target_model.score + (voteValue * 2),
-                    upvotes=target_model.upvotes - 1,
-                    downvotes=target_model.downvotes + 1,
-                    **kwargs,
-                )
             new_score = voteValue * 2
-            User.update(score=User.score + (voteValue * 2)).where(
-                User.uid == target.uid
-            ).execute()
-            User.update(given=User.given + voteValue).where(User.uid == uid).execute()
+            given = voteValue
+            upvotes, downvotes = (1, -1) if positive else (-1, 1)
     else:  # First vote cast on post
         now = datetime.utcnow()
         if target_type == "post":
@@ -3041,36 +3659,56 @@ def cast_vote(uid, target_type, pcid, value):
             SubPostCommentVote.create(
                 cid=pcid, uid=uid, positive=positive, datetime=now
             )
-            if target_model.views > 0:
-                kwargs["best_score"] = best_score(
-                    target.upvotes + (1 if positive else 0),
-                    target.downvotes + (0 if positive else 1),
-                    target.views,
-                )
-
-        if positive:
-            upd_q = target_model.update(
-                score=target_model.score + voteValue,
-                upvotes=target_model.upvotes + 1,
-                **kwargs,
+        new_score = voteValue
+        given = voteValue
+        upvotes, downvotes = (1, 0) if positive else (0, 1)
+    site_stats.add(upvotes=upvotes, downvotes=downvotes)
+
+    score = target.score + new_score
+    user_score = target.uid.score + new_score
+    if vote_counters.enabled:
+        vote_counters.add(
+            target_type,
+            target.id,
+            score=new_score,
+            upvotes=upvotes,
+            downvotes=downvotes,
+        )
+        vote_counters.add("user", target.uid_id, score=new_score)
+        vote_counters.add("user", uid, given=given)
+        # Show the scores including the deltas not flushed yet.
+        pending = vote_counters.pending(target_type, target.id)
+        score = target.score + pending.get("score", 0)
+        pending = vote_counters.pending("user", target.uid_id)
+        user_score = target.uid.score + pending.get("score", 0)
+    else:
+        kwargs = {}
+        if target_type == "comment":
+            kwargs["best_score"] = best_score(
+                target.upvotes + upvotes, target.downvotes + downvotes, target.views
             )
         else:
-            upd_q = target_model.update(
-                score=target_model.score + voteValue,
-                downvotes=target_model.downvotes + 1,
-                **kwargs,
-            )
-        new_score = voteValue
-        User.update(score=User.score + voteValue).where(
+            kwargs["hot"] = post_hot_rank(SubPost.score + new_score)
+        upd_q = target_model.update(
+            score=target_model.score + new_score,
+            upvotes=target_model.upvotes + upvotes,
+            downvotes=target_model.downvotes + downvotes,
+            **kwargs,
+        )
+        if target_type == "post":
+            upd_q.where(SubPost.pid == target.id).execute()
+        else:
+            upd_q.where(SubPostComment.cid == target.id).execute()
+            invalidate_comment_cache(target.pid_id, [target.id])
+        User.update(score=User.score + new_score).where(
             User.uid == target.uid
         ).execute()
-        User.update(given=User.given + voteValue).where(User.uid == uid).execute()
+        User.update(given=User.given + given).where(User.uid == uid).execute()
 
     if target_type == "post":
-        upd_q.where(SubPost.pid == target.id).execute()
-        socketio.emit(
+        socketio.emit_latest(
             "threadscore",
-            {"pid": target.id, "score": target.score + new_score},
+            {"pid": target.id, "score": score},
             namespace="/snt",
             room=target.id,
         )
@@ -3080,22 +3718,20 @@ def cast_vote(uid, target_type, pcid, value):
             {
                 "pid": target.id,
                 "status": voteValue if not undone else 0,
-                "score": target.score + new_score,
+                "score": score,
             },
             namespace="/snt",
             room="user" + uid,
         )
-    else:
-        upd_q.where(SubPostComment.cid == target.id).execute()
 
-    socketio.emit(
+    socketio.emit_latest(
         "uscore",
-        {"score": target.uid.score + new_score},
+        {"score": user_score},
         namespace="/snt",
         room="user" + target.uid_id,
     )
 
-    return jsonify(score=target.score + new_score, rm=undone)
+    return jsonify(score=score, rm=undone)
 
 
 def best_score(upvotes, downvotes, views):
@@ -3117,6 +3753,20 @@ def best_score(upvotes, downvotes, views):
     )
 
 
+def best_score_sql(upvotes, downvotes, views):
+    """The same as `best_score`, as an SQL expression of the given columns
+    or expressions, to recompute it in UPDATE statements."""
+    z = 1.96
+    n = Case(None, [(views < 1, 1)], views) * 1.0
+    score = upvotes - downvotes + 1
+    magnitude = fn.ABS(score)
+    phat = Case(None, [(magnitude > n, n)], magnitude) / n
+    lower_bound = (
+        phat + z * z / (2 * n) - z * fn.SQRT((phat * (1 - phat) + z * z / (4 * n)) / n)
+    ) / (1 + z * z / n)
+    return Case(None, [(score < 0, lower_bound * -1)], lower_bound)
+
+
 def is_sub_mod(uid, sid, power_level, can_admin=False):
     try:
         SubMod.get(
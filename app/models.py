@@ -9,6 +9,8 @@ from flask import g
 from flask_redis import FlaskRedis
 from peewee import IntegerField, DateTimeField, BooleanField, Proxy, Model, Database
 from peewee import CharField, ForeignKeyField, TextField, PrimaryKeyField, FloatField
+from peewee import DateField
+from playhouse.pool import PooledDatabase
 from werkzeug.local import LocalProxy
 from .storage import file_url
 from .config import config
@@ -17,15 +19,49 @@ rconn = FlaskRedis()
 
 dbp = Proxy()
 
+# Pooled engines used in place of the plain ones when `database.pool` is set.
+POOLED_ENGINES = {
+    "PostgresqlDatabase": "playhouse.pool.PooledPostgresqlDatabase",
+    "PostgresqlExtDatabase": "playhouse.pool.PooledPostgresqlExtDatabase",
+    "MySQLDatabase": "playhouse.pool.PooledMySQLDatabase",
+    "SqliteDatabase": "playhouse.pool.PooledSqliteDatabase",
+}
+
+# Connection checkout counters of this process, shown in the admin page.
+db_checkouts = {"count": 0, "wait_ms": 0.0, "max_wait_ms": 0.0, "failures": 0}
+
 
 def get_db():
     if "db" not in g:
         if dbp.is_closed():
-            dbp.connect()
+            starttime = time.time()
+            try:
+                dbp.connect()
+            except Exception:
+                db_checkouts["failures"] += 1
+                raise
+            wait = (time.time() - starttime) * 1000
+            g.db_wait = wait
+            db_checkouts["count"] += 1
+            db_checkouts["wait_ms"] += wait
+            db_checkouts["max_wait_ms"] = max(db_checkouts["max_wait_ms"], wait)
         g.db = dbp
     return g.db
 
 
+def db_pool_stats():
+    """Returns the connection checkout counters of this process, along with
+    the state of the connection pool if a pooled engine is in use."""
+    stats = dict(db_checkouts)
+    stats["avg_wait_ms"] = stats["wait_ms"] / stats["count"] if stats["count"] else 0
+    database = dbp.obj
+    if isinstance(database, PooledDatabase):
+        stats["in_use"] = len(database._in_use)
+        stats["idle"] = len(database._connections)
+        stats["max_connections"] = database._max_connections
+    return stats
+
+
 db = LocalProxy(get_db)
 
 
@@ -37,6 +73,8 @@ def db_init_app(app):
         engine = dbconnect.pop("engine")
     except KeyError:
         raise RuntimeError("DATABASE configuration must specify a `name` and `engine`.")
+    if dbconnect.pop("pool", False):
+        engine = POOLED_ENGINES.get(engine, engine)
 
     if "." in engine:
         path, class_name = engine.rsplit(".", 1)
@@ -194,6 +232,25 @@ class SiteMetadata(BaseModel):
         table_name = "site_metadata"
 
 
+class SiteDailyStats(BaseModel):
+    """How much the site totals shown in the admin page changed on a day.
+    Kept up to date by `app.site_stats`."""
+
+    day = DateField(primary_key=True)
+    users = IntegerField(default=0)
+    subs = IntegerField(default=0)
+    posts = IntegerField(default=0)
+    comments = IntegerField(default=0)
+    upvotes = IntegerField(default=0)
+    downvotes = IntegerField(default=0)
+
+    def __repr__(self):
+        return f"<SiteDailyStats {self.day}>"
+
+    class Meta:
+        table_name = "site_daily_stats"
+
+
 class Sub(BaseModel):
     name = CharField(unique=True, max_length=32)
     nsfw = BooleanField(default=False)
@@ -295,16 +352,22 @@ class SubMetadata(BaseModel):
 
 class SubPost(BaseModel):
     content = TextField(null=True)
+    # Rendered `content`, valid if `html_version` is the current renderer version.
+    content_html = TextField(null=True)
+    html_version = IntegerField(null=True)
     deleted = IntegerField(
         default=0
     )  # 1=self delete, 2=mod delete, 3=admin delete, 0=not deleted
     distinguish = IntegerField(null=True)  # 1=mod, 2=admin, 0 or null = normal
     link = CharField(null=True)
+    # Host name of `link`, see misc.domain_key. Uses the "C" collation on Postgres.
+    domain = CharField(null=True)
     nsfw = BooleanField(null=True)
     pid = PrimaryKeyField()
     posted = DateTimeField(default=datetime.datetime.utcnow)
     edited = DateTimeField(null=True)
     ptype = IntegerField(null=True)  # 1=text, 2=link, 3=poll
+    hot = FloatField(null=True)  # See misc.post_hot_rank
 
     score = IntegerField(default=1)  # XXX: Deprecated
     upvotes = IntegerField(default=0)
@@ -360,6 +423,9 @@ class SubPostPollVote(BaseModel):
 class SubPostComment(BaseModel):
     cid = CharField(primary_key=True, max_length=40)
     content = TextField(null=True)
+    # Rendered `content`, valid if `html_version` is the current renderer version.
+    content_html = TextField(null=True)
+    html_version = IntegerField(null=True)
     lastedit = DateTimeField(null=True)
     parentcid = ForeignKeyField(
         db_column="parentcid", null=True, model="self", field="cid"
@@ -642,6 +708,8 @@ class SubPostCommentHistory(BaseModel):
     cid = ForeignKeyField(db_column="cid", model=SubPostComment, field="cid")
     datetime = DateTimeField(default=datetime.datetime.now)
     content = TextField(null=True)
+    content_html = TextField(null=True)
+    html_version = IntegerField(null=True)
 
     def __repr__(self):
         return f'<SubPostCommentHistory "{self.content[:20]}">'
@@ -17,7 +17,7 @@ from .models import (
     SubPostVote,
 )
 from .socketio import socketio
-from .misc import get_notification_count
+from .misc import get_notification_count, adjust_unread_count, clear_unread_count
 
 
 class Notifications(object):
@@ -181,6 +181,7 @@ class Notifications(object):
         Notification.update(read=datetime.utcnow()).where(
             (Notification.read.is_null(True)) & (Notification.target == uid)
         ).execute()
+        clear_unread_count(uid, "notifications")
 
     def send(
         self,
@@ -252,6 +253,7 @@ class Notifications(object):
         if ignore is not None:
             return
 
+        adjust_unread_count(target, "notifications")
         notification_count = get_notification_count(target)
         socketio.emit(
             "notification",
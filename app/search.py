@@ -0,0 +1,312 @@
+""" Full-text search of posts and comments, and sub name autocompletion """
+import bisect
+import heapq
+import threading
+import time
+from peewee import Cast, Expression, PostgresqlDatabase, SqliteDatabase, SQL, Table
+from peewee import Value, fn
+from .config import config
+from .models import dbp, rconn, Sub, SubPost, SubPostComment
+
+# On Postgres the search tables hold a weighted `tsvector` of every post and
+# comment, with GIN indexes. On SQLite (used by the tests) they are FTS5
+# tables instead. Other databases fall back to `LIKE` and have no tables.
+PostgresPostSearch = Table("sub_post_search", ("pid", "vector"))
+PostgresCommentSearch = Table("sub_post_comment_search", ("cid", "vector"))
+SqlitePostSearch = Table(
+    "sub_post_search", ("rowid", "title", "content", "rank", "sub_post_search")
+)
+SqliteCommentSearch = Table(
+    "sub_post_comment_search",
+    ("cid", "content", "rank", "sub_post_comment_search"),
+)
+
+# Bumped to make every process reload its `SubNameIndex`.
+SUB_NAMES_VERSION_KEY = "sub-names-version"
+
+POSTGRES_TABLES = [
+    "CREATE TABLE IF NOT EXISTS sub_post_search ("
+    "pid INTEGER PRIMARY KEY REFERENCES sub_post (pid) ON DELETE CASCADE, "
+    "vector TSVECTOR NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS sub_post_search_vector "
+    "ON sub_post_search USING GIN (vector)",
+    "CREATE TABLE IF NOT EXISTS sub_post_comment_search ("
+    "cid VARCHAR(40) PRIMARY KEY REFERENCES sub_post_comment (cid) ON DELETE CASCADE, "
+    "vector TSVECTOR NOT NULL)",
+    "CREATE INDEX IF NOT EXISTS sub_post_comment_search_vector "
+    "ON sub_post_comment_search USING GIN (vector)",
+]
+
+SQLITE_TABLES = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS sub_post_search USING fts5(title, content)",
+    # Matches in titles count ten times as much as matches in the content.
+    "INSERT INTO sub_post_search (sub_post_search, rank) "
+    "VALUES ('rank', 'bm25(10.0, 1.0)')",
+    "CREATE VIRTUAL TABLE IF NOT EXISTS sub_post_comment_search "
+    "USING fts5(cid UNINDEXED, content)",
+]
+
+
+def search_backend(database=None):
+    """Returns "postgres", "sqlite" or None if full-text search is not
+    supported by the database in use."""
+    database = database or dbp.obj
+    if isinstance(database, PostgresqlDatabase):
+        return "postgres"
+    if isinstance(database, SqliteDatabase):
+        return "sqlite"
+    return None
+
+
+def create_search_tables(database=None):
+    """Create the search tables if they don't exist. The migrations create
+    them too; this is for databases made with `create_tables`."""
+    database = database or dbp.obj
+    backend = search_backend(database)
+    if backend == "postgres":
+        statements = POSTGRES_TABLES
+    elif backend == "sqlite":
+        statements = SQLITE_TABLES
+    else:
+        return
+    for statement in statements:
+        database.execute_sql(statement)
+
+
+def language():
+    return config.app.search.language
+
+
+def match_terms(terms):
+    """Turn the words in `terms` into an FTS5 query matching all of them.
+    Returns None if there are no words."""
+    words = ['"' + word.replace('"', '""') + '"' for word in terms.split()]
+    return " ".join(words) or None
+
+
+def index_post(pid):
+    """Add a post to the search index, or update it after an edit."""
+    backend = search_backend()
+    if backend == "postgres":
+        dbp.execute_sql(
+            "INSERT INTO sub_post_search (pid, vector) "
+            "SELECT pid, setweight(to_tsvector(%s::regconfig, title), 'A') || "
+            "setweight(to_tsvector(%s::regconfig, coalesce(content, '')), 'B') "
+            "FROM sub_post WHERE pid = %s "
+            "ON CONFLICT (pid) DO UPDATE SET vector = EXCLUDED.vector",
+            (language(), language(), pid),
+        )
+    elif backend == "sqlite":
+        dbp.execute_sql("DELETE FROM sub_post_search WHERE rowid = ?", (pid,))
+        dbp.execute_sql(
+            "INSERT INTO sub_post_search (rowid, title, content) "
+            "SELECT pid, title, coalesce(content, '') FROM sub_post WHERE pid = ?",
+            (pid,),
+        )
+
+
+def unindex_post(pid):
+    """Remove a post from the search index."""
+    backend = search_backend()
+    if backend == "postgres":
+        dbp.execute_sql("DELETE FROM sub_post_search WHERE pid = %s", (pid,))
+    elif backend == "sqlite":
+        dbp.execute_sql("DELETE FROM sub_post_search WHERE rowid = ?", (pid,))
+
+
+def index_comment(cid):
+    """Add a comment to the search index, or update it after an edit."""
+    cid = str(cid)
+    backend = search_backend()
+    if backend == "postgres":
+        dbp.execute_sql(
+            "INSERT INTO sub_post_comment_search (cid, vector) "
+            "SELECT cid, to_tsvector(%s::regconfig, coalesce(content, '')) "
+            "FROM sub_post_comment WHERE cid = %s "
+            "ON CONFLICT (cid) DO UPDATE SET vector = EXCLUDED.vector",
+            (language(), cid),
+        )
+    elif backend == "sqlite":
+        dbp.execute_sql("DELETE FROM sub_post_comment_search WHERE cid = ?", (cid,))
+        dbp.execute_sql(
+            "INSERT INTO sub_post_comment_search (cid, content) "
+            "SELECT cid, coalesce(content, '') FROM sub_post_comment WHERE cid = ?",
+            (cid,),
+        )
+
+
+def unindex_comment(cid):
+    """Remove a comment from the search index."""
+    cid = str(cid)
+    backend = search_backend()
+    if backend == "postgres":
+        dbp.execute_sql("DELETE FROM sub_post_comment_search WHERE cid = %s", (cid,))
+    elif backend == "sqlite":
+        dbp.execute_sql("DELETE FROM sub_post_comment_search WHERE cid = ?", (cid,))
+
+
+def search_posts(query, terms):
+    """Restrict `query`, a select from SubPost, to the posts matching the
+    words in `terms`, ordered with the best matches first."""
+    backend = search_backend()
+    if backend == "postgres":
+        tsquery = fn.plainto_tsquery(Cast(Value(language()), "regconfig"), terms)
+        search = PostgresPostSearch
+        return (
+            query.switch(SubPost)
+            .join(search, on=(search.pid == SubPost.pid))
+            .where(Expression(search.vector, "@@", tsquery))
+            .order_by(fn.ts_rank(search.vector, tsquery).desc(), SubPost.pid.desc())
+        )
+    elif backend == "sqlite":
+        match = match_terms(terms)
+        if match is None:
+            return query.where(SQL("0 = 1"))
+        search = SqlitePostSearch
+        return (
+            query.switch(SubPost)
+            .join(search, on=(search.rowid == SubPost.pid))
+            .where(Expression(search.sub_post_search, "MATCH", match))
+            .order_by(search.rank, SubPost.pid.desc())
+        )
+    pattern = "%" + terms + "%"
+    return query.where(
+        (SubPost.title**pattern) | (SubPost.content**pattern)
+    ).order_by(SubPost.pid.desc())
+
+
+def search_comments(query, terms):
+    """Restrict `query`, a select from SubPostComment, to the comments
+    matching the words in `terms`, ordered with the best matches first."""
+    backend = search_backend()
+    if backend == "postgres":
+        tsquery = fn.plainto_tsquery(Cast(Value(language()), "regconfig"), terms)
+        search = PostgresCommentSearch
+        return (
+            query.switch(SubPostComment)
+            .join(search, on=(search.cid == SubPostComment.cid))
+            .where(Expression(search.vector, "@@", tsquery))
+            .order_by(
+                fn.ts_rank(search.vector, tsquery).desc(), SubPostComment.time.desc()
+            )
+        )
+    elif backend == "sqlite":
+        match = match_terms(terms)
+        if match is None:
+            return query.where(SQL("0 = 1"))
+        search = SqliteCommentSearch
+        return (
+            query.switch(SubPostComment)
+            .join(search, on=(search.cid == SubPostComment.cid))
+            .where(Expression(search.sub_post_comment_search, "MATCH", match))
+            .order_by(search.rank, SubPostComment.time.desc())
+        )
+    return query.where(SubPostComment.content ** ("%" + terms + "%")).order_by(
+        SubPostComment.time.desc()
+    )
+
+
+def rebuild_search_index():
+    """Index all the posts and comments again, for example after changing
+    the search language. Returns the number of posts and comments indexed."""
+    backend = search_backend()
+    if backend is None:
+        return 0, 0
+    with dbp.atomic():
+        if backend == "postgres":
+            dbp.execute_sql("TRUNCATE sub_post_search, sub_post_comment_search")
+            dbp.execute_sql(
+                "INSERT INTO sub_post_search (pid, vector) "
+                "SELECT pid, setweight(to_tsvector(%s::regconfig, title), 'A') || "
+                "setweight(to_tsvector(%s::regconfig, coalesce(content, '')), 'B') "
+                "FROM sub_post WHERE deleted = 0",
+                (language(), language()),
+            )
+            dbp.execute_sql(
+                "INSERT INTO sub_post_comment_search (cid, vector) "
+                "SELECT cid, to_tsvector(%s::regconfig, coalesce(content, '')) "
+                "FROM sub_post_comment WHERE coalesce(status, 0) = 0",
+                (language(),),
+            )
+        else:
+            dbp.execute_sql("DELETE FROM sub_post_search")
+            dbp.execute_sql("DELETE FROM sub_post_comment_search")
+            dbp.execute_sql(
+                "INSERT INTO sub_post_search (rowid, title, content) "
+                "SELECT pid, title, coalesce(content, '') FROM sub_post "
+                "WHERE deleted = 0"
+            )
+            dbp.execute_sql(
+                "INSERT INTO sub_post_comment_search (cid, content) "
+                "SELECT cid, coalesce(content, '') FROM sub_post_comment "
+                "WHERE coalesce(status, 0) = 0"
+            )
+    return (
+        dbp.execute_sql("SELECT count(*) FROM sub_post_search").fetchone()[0],
+        dbp.execute_sql("SELECT count(*) FROM sub_post_comment_search").fetchone()[0],
+    )
+
+
+class SubNameIndex(object):
+    """Sorted in-memory list of the names of all the active subs, used to
+    autocomplete sub names without querying the database. Each process
+    loads it on first use, and loads it again when a sub is created (which
+    is announced by bumping a version number in Redis) or after `ttl`
+    seconds, to pick up the changes in subscriber counts."""
+
+    def __init__(self, app=None):
+        self.ttl = 300
+        self.version = None
+        self.loaded = 0
+        # Lowercased names, and (name, subscribers) in the same order.
+        self.index = ([], [])
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config["THROAT_CONFIG"].app.search.name_index_ttl
+
+    def load(self, version):
+        subs = Sub.select(Sub.name, Sub.subscribers).where(Sub.status == 0).tuples()
+        entries = sorted(
+            (name.lower(), name, subscribers) for name, subscribers in subs
+        )
+        self.index = (
+            [entry[0] for entry in entries],
+            [(name, subscribers or 0) for _, name, subscribers in entries],
+        )
+        self.version = version
+        self.loaded = time.time()
+
+    def refresh(self):
+        version = rconn.get(SUB_NAMES_VERSION_KEY)
+        if version == self.version and time.time() - self.loaded < self.ttl:
+            return
+        with self.lock:
+            if version != self.version or time.time() - self.loaded >= self.ttl:
+                self.load(version)
+
+    def complete(self, prefix, limit=10):
+        """Returns the names of up to `limit` subs starting with `prefix`,
+        ignoring case. An exact match comes first, then the subs with the
+        most subscribers."""
+        self.refresh()
+        keys, entries = self.index
+        prefix = prefix.lower()
+        start = bisect.bisect_left(keys, prefix)
+        end = bisect.bisect_left(keys, prefix + "\U0010ffff", lo=start)
+        matches = heapq.nlargest(
+            limit,
+            range(start, end),
+            key=lambda i: (keys[i] == prefix, entries[i][1]),
+        )
+        return [entries[i][0] for i in matches]
+
+    @staticmethod
+    def invalidate():
+        """Make every process reload the index. Call after creating a sub."""
+        rconn.incr(SUB_NAMES_VERSION_KEY)
+
+
+sub_names = SubNameIndex()
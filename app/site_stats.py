@@ -0,0 +1,186 @@
+""" Running totals of users, subs, posts, comments and votes """
+import datetime
+import logging
+import time
+import gevent
+from gevent import monkey
+from peewee import fn
+from .models import db, rconn, Sub, SubPost, SubPostComment, User
+from .models import SubPostVote, SubPostCommentVote, SiteDailyStats
+
+FIELDS = ("users", "subs", "posts", "comments", "upvotes", "downvotes")
+
+# Redis hash holding the totals, and the time they were last counted.
+TOTALS_KEY = "site-stats"
+# Redis hash holding the changes to the totals on a day.
+DAY_KEY = "site-stats:{0}"
+# Redis set holding the days with changes not yet saved to the database.
+DAYS_KEY = "site-stats-days"
+# Set for `reconcile_interval` seconds by the process which counts the totals.
+RECONCILE_KEY = "site-stats-reconciled"
+# Seconds to keep the changes of a day in Redis.
+DAY_TTL = 8 * 86400
+
+
+class SiteStats(object):
+    """Keeps the totals shown in the admin page in a Redis hash, updated as
+    things are created and votes are cast so the page doesn't have to count
+    the rows of the biggest tables. The changes are also accumulated per
+    day and saved to `SiteDailyStats` every `interval` seconds by a
+    background greenlet, which also counts the totals again every
+    `reconcile_interval` seconds to correct any drift."""
+
+    def __init__(self, app=None):
+        self.interval = 300
+        self.reconcile_interval = 86400
+        self.logger = logging.getLogger(__name__)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        conf = app.config["THROAT_CONFIG"].app.site_stats
+        self.interval = conf.interval
+        self.reconcile_interval = conf.reconcile_interval
+        self.logger = logging.getLogger(app.logger.name + ".site_stats")
+        if monkey.is_module_patched("os"):
+            gevent.spawn(self.save_forever, app)
+
+    @staticmethod
+    def add(**deltas):
+        """Add `deltas` (field name => increment) to the totals and to the
+        changes of the current day."""
+        day = DAY_KEY.format(datetime.datetime.utcnow().date().isoformat())
+        pipe = rconn.pipeline()
+        for field, delta in deltas.items():
+            if delta:
+                pipe.hincrby(TOTALS_KEY, field, delta)
+                pipe.hincrby(day, field, delta)
+        pipe.expire(day, DAY_TTL)
+        pipe.sadd(DAYS_KEY, day)
+        pipe.execute()
+
+    @staticmethod
+    def count():
+        """Count the totals in the database."""
+        totals = {
+            "users": User.select().count(),
+            "subs": Sub.select().count(),
+            "posts": SubPost.select().count(),
+            "comments": SubPostComment.select().count(),
+            "upvotes": 0,
+            "downvotes": 0,
+        }
+        for model in [SubPostVote, SubPostCommentVote]:
+            votes = model.select(model.positive, fn.COUNT(model.xid)).group_by(
+                model.positive
+            )
+            for positive, count in votes.tuples():
+                totals["upvotes" if positive == 1 else "downvotes"] += count
+        return totals
+
+    def totals(self):
+        """Returns the totals as a dict, counting them if they are missing."""
+        values = {k.decode(): int(v) for k, v in rconn.hgetall(TOTALS_KEY).items()}
+        if "counted" not in values:
+            return self.reconcile()
+        return {field: values.get(field, 0) for field in FIELDS}
+
+    def reconcile(self):
+        """Count the totals again and store them. Returns the new totals."""
+        totals = self.count()
+        rconn.hset(TOTALS_KEY, mapping=dict(totals, counted=int(time.time())))
+        return totals
+
+    @staticmethod
+    def save():
+        """Store the changes of every day touched since the last call in
+        `SiteDailyStats`. Returns the number of days saved."""
+        count = 0
+        while True:
+            key = rconn.spop(DAYS_KEY)
+            if key is None:
+                return count
+            try:
+                values = rconn.hgetall(key)
+                row = {field.decode(): int(v) for field, v in values.items()}
+                row["day"] = datetime.date.fromisoformat(key.decode().split(":")[1])
+                SiteDailyStats.insert(row).on_conflict(
+                    conflict_target=[SiteDailyStats.day],
+                    update={field: row.get(field, 0) for field in FIELDS},
+                ).execute()
+            except Exception:
+                # Try again next time.
+                rconn.sadd(DAYS_KEY, key)
+                raise
+            count += 1
+
+    def history(self, days=30):
+        """Returns the `SiteDailyStats` of the last `days` days with
+        changes, newest first."""
+        self.save()
+        since = datetime.datetime.utcnow().date() - datetime.timedelta(days=days - 1)
+        return list(
+            SiteDailyStats.select()
+            .where(SiteDailyStats.day >= since)
+            .order_by(SiteDailyStats.day.desc())
+        )
+
+    @staticmethod
+    def rebuild_history():
+        """Fill in `SiteDailyStats` from the creation times of the rows in
+        the database, replacing what it had. Votes which were removed or
+        changed are not accounted for. Returns the number of days stored."""
+        days = {}
+
+        def tally(field, query):
+            for day, count in query.tuples():
+                if day is not None:
+                    day = str(day)[:10]
+                    days.setdefault(day, dict.fromkeys(FIELDS, 0))[field] += count
+
+        for field, column, key in [
+            ("users", User.joindate, User.uid),
+            ("subs", Sub.creation, Sub.sid),
+            ("posts", SubPost.posted, SubPost.pid),
+            ("comments", SubPostComment.time, SubPostComment.cid),
+        ]:
+            day = fn.DATE(column)
+            tally(field, column.model.select(day, fn.COUNT(key)).group_by(day))
+        for model in [SubPostVote, SubPostCommentVote]:
+            day = fn.DATE(model.datetime)
+            for field, positive in [("upvotes", 1), ("downvotes", 0)]:
+                tally(
+                    field,
+                    model.select(day, fn.COUNT(model.xid))
+                    .where(model.positive == positive)
+                    .group_by(day),
+                )
+
+        rows = [
+            dict(values, day=datetime.date.fromisoformat(day))
+            for day, values in days.items()
+        ]
+        with db.atomic():
+            SiteDailyStats.delete().execute()
+            for start in range(0, len(rows), 1000):
+                SiteDailyStats.insert_many(rows[start : start + 1000]).execute()
+        return len(rows)
+
+    @staticmethod
+    def invalidate():
+        """Discard the totals, to count them again on the next read."""
+        rconn.delete(TOTALS_KEY)
+
+    def save_forever(self, app):
+        while True:
+            gevent.sleep(self.interval)
+            try:
+                with app.app_context():
+                    self.save()
+                    if rconn.set(RECONCILE_KEY, 1, nx=True, ex=self.reconcile_interval):
+                        self.reconcile()
+            except Exception:  # noqa
+                self.logger.exception("Failed to save the site statistics")
+
+
+site_stats = SiteStats()
@@ -1,9 +1,12 @@
+import redis
+import socketio as python_socketio
 from flask_socketio import SocketIO, join_room
 from flask_login import current_user
 from flask_jwt_extended import decode_token
 from flask import request
 from .models import rconn
 from . import misc
+import atexit
 import gevent
 from gevent import monkey
 import json
@@ -12,12 +15,13 @@ import re
 from wheezy.html.utils import escape_html
 import logging
 import time
+import zlib
 from engineio.payload import Payload
 
 Payload.max_decode_packets = 50
 
 
-# Time in seconds for the expiration of the Redis keys used to decide
+# Time in seconds for the expiration of the Redis lease which decides
 # which instance should do the socketio.emit for messages received via
 # Redis subscription.  This should be somewhere in between the longest
 # time the gevent loop might get blocked and the acceptable time for
@@ -25,28 +29,256 @@ Payload.max_decode_packets = 50
 # emitting goes down.
 NAME_KEY_KEEPALIVE = 1
 
+# Redis stream holding the chat messages, trimmed to about CHAT_HISTORY
+# messages, and the number of messages sent by each chatbacklog event.
+CHAT_KEY = "chat-history"
+CHAT_HISTORY = 1000
+CHAT_BACKLOG = 20
+
+# Redis key holding the name of the instance which does the emitting.
+LEADER_KEY = "throat-socketio-leader"
+
+# Take the lease if it is free, or extend it if this instance holds it.
+# Returns whether this instance holds the lease, and for how many more
+# milliseconds the lease is valid.
+LEASE_SCRIPT = """
+if redis.call('set', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return {1, tonumber(ARGV[2])}
+end
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    redis.call('pexpire', KEYS[1], ARGV[2])
+    return {1, tonumber(ARGV[2])}
+end
+return {0, redis.call('pttl', KEYS[1])}
+"""
+
+# Give up the lease if this instance holds it.
+RESIGN_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class ShardedRedisManager(python_socketio.RedisManager):
+    """Client manager which spreads the events sent to rooms over `shards`
+    Redis channels, chosen by a hash of the room name. Each worker only
+    subscribes to the channels of the rooms its own clients are in, and
+    delivers the events it receives to its own clients, so a worker is not
+    woken up by the events of posts and users none of its clients are
+    looking at. Broadcasts and the messages used to manage the clients of
+    other workers go through the base channel, which every worker reads."""
+
+    name = "sharded-redis"
+
+    def __init__(
+        self, url, channel="flask-socketio", shards=16, resubscribe_interval=5, **kwargs
+    ):
+        super(ShardedRedisManager, self).__init__(url, channel=channel, **kwargs)
+        self.shards = shards
+        self.resubscribe_interval = resubscribe_interval
+        self.connected = False
+        # Shard channels this worker is subscribed to, and the Redis
+        # subscription used to receive them.
+        self.subscribed = set()
+        self.listener = None
+
+    def initialize(self):
+        super(ShardedRedisManager, self).initialize()
+        if not self.write_only:
+            self.server.start_background_task(self.resubscribe_forever)
+
+    def room_channel(self, room):
+        """Return the channel of the shard of `room`."""
+        shard = zlib.crc32(str(room).encode("utf-8")) % self.shards
+        return "{0}:{1}".format(self.channel, shard)
+
+    def message_channel(self, message):
+        """Return the channel a message to the other workers goes to."""
+        room = message.get("room")
+        if message.get("method") == "emit" and isinstance(room, (str, int)):
+            return self.room_channel(room)
+        return self.channel
+
+    def local_channels(self):
+        """Return the shard channels of the rooms of this worker's clients."""
+        return {
+            self.room_channel(room)
+            for rooms in self.rooms.values()
+            for room in rooms
+            if room is not None
+        }
+
+    def subscribe(self, channels):
+        """Start receiving the events sent to `channels`."""
+        channels = set(channels) - self.subscribed
+        if channels:
+            self.subscribed |= channels
+            if self.listener is not None:
+                self.listener.subscribe(*channels)
+
+    def resubscribe(self):
+        """Subscribe to the shards of the rooms of this worker's clients,
+        and unsubscribe from the others."""
+        wanted = self.local_channels()
+        stale = self.subscribed - wanted
+        if stale:
+            self.subscribed -= stale
+            if self.listener is not None:
+                self.listener.unsubscribe(*stale)
+        self.subscribe(wanted)
+
+    def resubscribe_forever(self):
+        while True:
+            self.server.sleep(self.resubscribe_interval)
+            try:
+                self.resubscribe()
+            except Exception:  # noqa
+                self._get_logger().exception("Failed to update subscriptions")
+
+    def connect(self, eio_sid, namespace):
+        sid = super(ShardedRedisManager, self).connect(eio_sid, namespace)
+        self.subscribe([self.room_channel(sid)])
+        return sid
+
+    def enter_room(self, sid, namespace, room, eio_sid=None):
+        super(ShardedRedisManager, self).enter_room(
+            sid, namespace, room, eio_sid=eio_sid
+        )
+        if self.is_connected(sid, namespace):
+            self.subscribe([self.room_channel(room)])
+
+    # The methods below override private methods of socketio.RedisManager,
+    # following their implementation in python-socketio 5.17 (the version
+    # pinned in pyproject.toml). Check them again before upgrading it.
+    def _handle_enter_room(self, message):
+        super(ShardedRedisManager, self)._handle_enter_room(message)
+        if self.is_connected(message.get("sid"), message.get("namespace")):
+            self.subscribe([self.room_channel(message.get("room"))])
+
+    def _redis_connect(self):
+        super(ShardedRedisManager, self)._redis_connect()
+        self.connected = True
+
+    def _publish(self, data):
+        channel = self.message_channel(data)
+        for retries_left in (1, 0):
+            try:
+                if not self.connected:
+                    self._redis_connect()
+                return self.redis.publish(channel, json.dumps(data))
+            except redis.exceptions.RedisError:
+                self.connected = False
+                if not retries_left:
+                    self._get_logger().exception("Cannot publish to redis")
+
+    def _listen(self):
+        retry_sleep = 1
+        while True:
+            try:
+                listener = redis.Redis.from_url(
+                    self.redis_url, **self.redis_options
+                ).pubsub(ignore_subscribe_messages=True)
+                subscribed = set(self.subscribed)
+                listener.subscribe(self.channel, *subscribed)
+                self.listener = listener
+                # Catch up with the rooms entered while subscribing.
+                if self.subscribed - subscribed:
+                    listener.subscribe(*(self.subscribed - subscribed))
+                retry_sleep = 1
+                for message in listener.listen():
+                    if message["type"] != "message":
+                        continue
+                    try:
+                        yield json.loads(message["data"])
+                    except ValueError:
+                        self._get_logger().error(
+                            "Failed to decode message on channel %s",
+                            message["channel"],
+                        )
+            except redis.exceptions.RedisError:
+                self._get_logger().exception(
+                    "Cannot receive from redis, retrying in %s seconds", retry_sleep
+                )
+                self.listener = None
+                self.server.sleep(retry_sleep)
+                retry_sleep = min(retry_sleep * 2, 60)
+
 
 class SocketIOWithLogging(SocketIO):
+    __logger = logging.getLogger(__name__)
+    instance_name = None
+    # Whether this instance holds the lease, and until when (in
+    # time.monotonic() seconds) that answer can be trusted without asking
+    # Redis again.
+    leader = False
+    lease_until = 0.0
+    # Whether every instance emits the messages received via Redis
+    # subscription to its own clients, instead of only the leader emitting
+    # them to everyone. Set when the rooms are sharded.
+    local_delivery = False
+    # Seconds during which the updates sent with emit_latest are held back,
+    # so only the last one of each event to each room is sent. Zero to send
+    # every update right away.
+    coalesce_window = 0
+
+    def __init__(self, app=None, **kwargs):
+        # (namespace, event, room) => data of the update waiting to be sent.
+        self.pending_updates = {}
+        super(SocketIOWithLogging, self).__init__(app, **kwargs)
+
     def init_app(self, app, **kwargs):
+        conf = app.config["THROAT_CONFIG"].app.socketio
+        if conf.shards and kwargs.get("message_queue"):
+            kwargs["client_manager"] = ShardedRedisManager(
+                kwargs.pop("message_queue"),
+                shards=conf.shards,
+                resubscribe_interval=conf.resubscribe_interval,
+            )
+            self.local_delivery = True
         super(SocketIOWithLogging, self).init_app(app, **kwargs)
         self.__logger = logging.getLogger(app.logger.name + ".socketio")
         if monkey.is_module_patched("os"):
-            self.instance_name_prefix = "throat-socketio-instance-name-"
-            self.instance_name = self.instance_name_prefix + "".join(
-                [chr(random.randrange(0, 26) + ord("a")) for i in range(6)]
-            )
-            gevent.spawn(self.refresh_name_key)
+            self.coalesce_window = conf.coalesce_window
+            if not self.local_delivery:
+                self.instance_name = "throat-socketio-instance-name-" + "".join(
+                    [chr(random.randrange(0, 26) + ord("a")) for i in range(6)]
+                )
+                atexit.register(self.resign)
+                gevent.spawn(self.refresh_name_key)
             gevent.spawn(self.emit_messages)
 
     def emit(self, event, *args, **kwargs):
         self.__logger.debug("EMIT %s %s %s", event, args[0], kwargs)
-        if "room" in kwargs:
+        if "room" in kwargs and not kwargs.get("ignore_queue"):
             rconn.publish(
                 kwargs["namespace"] + ":" + event + ":" + str(kwargs["room"]),
                 json.dumps(args[0]),
             )
         super(SocketIOWithLogging, self).emit(event, *args, **kwargs)
 
+    def emit_latest(self, event, data, namespace, room):
+        """Emit an update which supersedes the previous updates of the same
+        event to the same room, such as a new score. While coalescing, the
+        update is sent `coalesce_window` seconds after the first one which
+        is waiting, with the data of the last one."""
+        if not self.coalesce_window:
+            return self.emit(event, data, namespace=namespace, room=room)
+        key = (namespace, event, room)
+        if key not in self.pending_updates:
+            gevent.spawn_later(self.coalesce_window, self.send_latest, key)
+        self.pending_updates[key] = data
+
+    def send_latest(self, key):
+        """Emit the update waiting for (namespace, event, room)."""
+        namespace, event, room = key
+        data = self.pending_updates.pop(key)
+        try:
+            self.emit(event, data, namespace=namespace, room=room)
+        except Exception:  # noqa
+            self.__logger.exception("Failed to emit %s to %s", event, room)
+
     def on(self, message, namespace=None):
         def decorator(handler):
             def func(*args):
@@ -58,43 +290,78 @@ class SocketIOWithLogging(SocketIO):
         return decorator
 
     def refresh_name_key(self):
-        """Keep a key set to expire in a few seconds alive on Redis."""
+        """Keep renewing the lease while this instance holds it, and try to
+        take it over when it expires."""
         while True:
-            rconn.setex(
-                name=self.instance_name,
-                value="true",
-                time=NAME_KEY_KEEPALIVE,
-            )
-            gevent.sleep(NAME_KEY_KEEPALIVE * 0.9)
+            self.claim_lease()
+            gevent.sleep(NAME_KEY_KEEPALIVE / 3)
+
+    def claim_lease(self):
+        """Take or extend the lease in Redis, and remember the outcome until
+        the lease expires. Returns True if this instance holds it."""
+        start = time.monotonic()
+        leader, ttl = rconn.eval(
+            LEASE_SCRIPT,
+            1,
+            LEADER_KEY,
+            self.instance_name,
+            int(NAME_KEY_KEEPALIVE * 1000),
+        )
+        self.leader = bool(leader)
+        self.lease_until = start + max(ttl, 0) / 1000
+        return self.leader
+
+    def resign(self):
+        """Give up the lease, so another instance can take over without
+        waiting for it to expire."""
+        if self.leader:
+            rconn.eval(RESIGN_SCRIPT, 1, LEADER_KEY, self.instance_name)
+        self.leader = False
+        self.lease_until = 0.0
 
     def emitting_instance(self):
-        """Return True if this is the first instance in alphabetical order by
-        instance name."""
-        keys = rconn.keys(self.instance_name_prefix + "*")
-        names = sorted([k.decode("utf-8") for k in keys])
-        return len(names) == 0 or names[0] == self.instance_name
+        """Return True if this instance holds the lease. Only asks Redis
+        when the lease this instance knows about has expired."""
+        if time.monotonic() >= self.lease_until:
+            return self.claim_lease()
+        return self.leader
 
     def emit_messages(self):
         """Emit SocketIO events for messages from Redis."""
         pubsub = rconn.pubsub(ignore_subscribe_messages=True)
         pubsub.psubscribe("/send:*")
         for message in pubsub.listen():
-            if self.emitting_instance():
-                self.__logger.debug("PSUB %s", message)
-                if message["type"] == "pmessage":
-                    match = re.match(
-                        r"/send:(.+?):(.+)", message["channel"].decode("utf-8")
-                    )
-                    if match:
-                        try:
-                            data = json.loads(message["data"])
-                            self.emit(match[1], data, room=match[2], namespace="/snt")
-                        except json.JSONDecodeError:
-                            self.__logger.error(
-                                "Failed to decode message on channel %s: %s",
-                                message["channel"],
-                                message["data"],
-                            )
+            self.emit_message(message)
+
+    def emit_message(self, message):
+        """Emit the SocketIO event for a message from Redis, if this is the
+        instance which does the emitting, or to this instance's own clients
+        if every instance does. Returns True if it was emitted."""
+        if not self.local_delivery and not self.emitting_instance():
+            return False
+        self.__logger.debug("PSUB %s", message)
+        if message["type"] != "pmessage":
+            return False
+        match = re.match(r"/send:(.+?):(.+)", message["channel"].decode("utf-8"))
+        if not match:
+            return False
+        try:
+            data = json.loads(message["data"])
+        except json.JSONDecodeError:
+            self.__logger.error(
+                "Failed to decode message on channel %s: %s",
+                message["channel"],
+                message["data"],
+            )
+            return False
+        self.emit(
+            match[1],
+            data,
+            room=match[2],
+            namespace="/snt",
+            ignore_queue=self.local_delivery,
+        )
+        return True
 
 
 socketio = SocketIOWithLogging()
@@ -108,8 +375,12 @@ def chat_message(g):
             "user": current_user.name,
             "msg": escape_html(g.get("msg")[:250]),
         }
-        rconn.lpush("chathistory", json.dumps(message))
-        rconn.ltrim("chathistory", 0, 20)
+        rconn.xadd(
+            CHAT_KEY,
+            {"msg": json.dumps(message)},
+            maxlen=CHAT_HISTORY,
+            approximate=True,
+        )
         socketio.emit("msg", message, namespace="/snt", room="chat")
 
 
@@ -129,11 +400,33 @@ def handle_message():
         )
 
 
+def chat_backlog(before=None, count=CHAT_BACKLOG):
+    """Returns the last `count` chat messages sent before the one with the
+    stream id `before`, or the last ones if it is None, as a JSON array
+    (oldest first) put together from the JSON stored in Redis. Also
+    returns the id to pass as `before` to get the messages preceding
+    those, or None if there are no more."""
+    entries = rconn.xrevrange(CHAT_KEY, max=before or "+", count=count + 2)
+    if before is not None:
+        # The range includes `before` itself.
+        entries = [entry for entry in entries if entry[0].decode() != before]
+    cursor = entries[count - 1][0].decode() if len(entries) > count else None
+    messages = [fields[b"msg"].decode() for _, fields in entries[:count]]
+    return "[" + ",".join(reversed(messages)) + "]", cursor
+
+
 @socketio.on("getchatbacklog", namespace="/snt")
-def get_chat_backlog():
-    msgs = rconn.lrange("chathistory", 0, 20)
-    for m in msgs[::-1]:
-        socketio.emit("msg", json.loads(m.decode()), namespace="/snt", room=request.sid)
+def get_chat_backlog(data=None):
+    before = data.get("before") if isinstance(data, dict) else None
+    if before is not None and not re.match(r"^\d+-\d+$", str(before)):
+        return
+    messages, cursor = chat_backlog(before)
+    socketio.emit(
+        "chatbacklog",
+        {"messages": messages, "before": before, "cursor": cursor},
+        namespace="/snt",
+        room=request.sid,
+    )
 
 
 @socketio.on("deferred", namespace="/snt")
@@ -173,6 +173,20 @@ socket.on('uscore', function(d){
   document.getElementById('postscore').innerHTML = d.score;
 })
 
+socket.on('undovotes', function(data){
+  const progress = document.getElementById('wipevotes-progress');
+  if (!progress || progress.getAttribute('data-uid') != data.uid) {
+    return;
+  }
+  if (data.status == 'ok') {
+    document.location.reload();
+  } else if (data.status == 'error') {
+    progress.innerHTML = _('Error while removing votes');
+  } else {
+    progress.innerHTML = _('Removing votes: %1%', Math.round(100 * data.done / data.steps));
+  }
+})
+
 socket.on('deletion', function(data){
   var post = document.querySelector('div.post[pid="' + data.pid + '"]');
   post.parentNode.removeChild(post);
@@ -333,11 +347,7 @@ socket.on('rmannouncement', function(){
   }
 })
 
-socket.on('msg', function(data){
-  if(document.getElementById('matrix-chat')) return
-  var cont = document.getElementById('chcont')
-  if(!cont){return;}
-  var uname = document.getElementById('unameb').innerHTML.toLowerCase();
+function chatMessageHtml(data, uname){
   var reg = /(^|\s)(@|\/u\/)([a-zA-Z0-9_-]{3,})(\s|\'|\.|,|$)/g
   var reg2 = /\u0001ACTION (.+)\u0001/
   var m = data.msg.match(reg);
@@ -357,13 +367,62 @@ socket.on('msg', function(data){
   var hours = String(d.getHours()).padStart(2, '0');
   var minutes = String(d.getMinutes()).padStart(2, '0');
   var seconds = String(d.getSeconds()).padStart(2, '0');
-  cont.innerHTML = cont.innerHTML + '<div class="msg ' + xc + '"><span class="msgtime">(' + hours + ':' + minutes + ':' + seconds + ') </span><span class="msguser">' + data.user + '&gt;</span><span class="damsg">' + anchorme(ircStylize(data.msg.replace(/  /g, '&#32;&nbsp;')), { emails: false, files: false, attributes: [{ name: "target", value: "blank" }] }).replace(reg, "$1<a href='/u/$3'>$2$3</a>$4") + '</span></div>';
+  return '<div class="msg ' + xc + '"><span class="msgtime">(' + hours + ':' + minutes + ':' + seconds + ') </span><span class="msguser">' + data.user + '&gt;</span><span class="damsg">' + anchorme(ircStylize(data.msg.replace(/  /g, '&#32;&nbsp;')), { emails: false, files: false, attributes: [{ name: "target", value: "blank" }] }).replace(reg, "$1<a href='/u/$3'>$2$3</a>$4") + '</span></div>';
+}
+
+function scrollToLastMessage(){
   var k = document.getElementsByClassName('msg')
   if(k.length > 3){
     if(u.isScrolledIntoView(k[k.length-2])){
       k[k.length-2].scrollIntoView();
     }
   }
+}
+
+socket.on('msg', function(data){
+  if(document.getElementById('matrix-chat')) return
+  var cont = document.getElementById('chcont')
+  if(!cont){return;}
+  var uname = document.getElementById('unameb').innerHTML.toLowerCase();
+  cont.insertAdjacentHTML('beforeend', chatMessageHtml(data, uname));
+  scrollToLastMessage();
+})
+
+// Id of the oldest chat message shown, to ask for the ones before it when
+// scrolling to the top of the chat. Null when there are no more.
+var chatCursor = null;
+var chatLoading = false;
+
+socket.on('chatbacklog', function(data){
+  if(document.getElementById('matrix-chat')) return
+  var cont = document.getElementById('chcont')
+  if(!cont){return;}
+  var uname = document.getElementById('unameb').innerHTML.toLowerCase();
+  var html = JSON.parse(data.messages).map(function(msg){
+    return chatMessageHtml(msg, uname);
+  }).join('');
+  chatCursor = data.cursor;
+  chatLoading = false;
+  if(data.before){
+    // Older messages go on top, keeping the ones shown where they were.
+    var height = cont.scrollHeight;
+    cont.insertAdjacentHTML('afterbegin', html);
+    cont.scrollTop += cont.scrollHeight - height;
+  } else {
+    cont.insertAdjacentHTML('beforeend', html);
+    scrollToLastMessage();
+  }
+})
+
+u.ready(function(){
+  var cont = document.getElementById('chcont');
+  if(!cont){return;}
+  cont.addEventListener('scroll', function(){
+    if(cont.scrollTop == 0 && chatCursor && !chatLoading){
+      chatLoading = true;
+      socket.emit('getchatbacklog', {before: chatCursor});
+    }
+  });
 })
 
 socket.on('announcement', function(data){
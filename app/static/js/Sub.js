@@ -295,12 +295,12 @@ u.sub('#sub', 'change', function(e) {
 const sa = document.querySelector('.sub_autocomplete');
 if(sa){
   autocomplete({
-    minLength: 3,
-    debounceWaitMs: 200,
+    minLength: 1,
+    debounceWaitMs: 50,
     input: sa,
     fetch: function(text, update) {
         text = text.toLowerCase();
-        u.get('/api/v3/sub?query=' + text, function(data){
+        u.get('/api/v3/search/subs/typeahead?q=' + encodeURIComponent(text), function(data){
           suggestions = data.results;
           update(suggestions);
         })
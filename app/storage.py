@@ -1,13 +1,17 @@
 """ Store and serve uploads and thumbnails. """
+import io
+import struct
+import tempfile
 import uuid
 import pathlib
+import zlib
 
 import gevent
 import libcloud.storage.types
 import magic
 from PIL.Image import Exif
 from mutagen.mp4 import MP4
-from PIL import Image, TiffImagePlugin
+from PIL import TiffImagePlugin
 from contextlib import ExitStack
 import hashlib
 import jinja2
@@ -30,6 +34,23 @@ FILE_NAMESPACE = uuid.UUID("acd2da84-91a2-4169-9fdb-054583b364c4")
 
 ISO8601 = "%Y-%m-%dT%H:%M:%SZ"
 
+# Uploads are read and written in chunks of this many bytes, and kept in
+# memory until they grow past SPOOL_MAX_MEMORY bytes, when they are moved
+# to a temporary file.
+CHUNK_SIZE = 65536
+SPOOL_MAX_MEMORY = 1024 * 1024
+# Number of bytes at the start of a file used to determine its type.
+SNIFF_SIZE = 1024
+# EXIF tag holding the orientation of an image.
+ORIENTATION = 274
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# PNG chunks holding metadata, which are left out of stored files.
+PNG_METADATA_CHUNKS = {b"eXIf", b"tEXt", b"zTXt", b"iTXt", b"tIME"}
+# PNG EXIF chunks bigger than this are dropped without looking for the
+# orientation, to keep them from filling the memory.
+PNG_MAX_EXIF_SIZE = 1024 * 1024
+
 
 class Objectview(object):
     def __init__(self, d):
@@ -136,36 +157,154 @@ def thumbnail_url(name):
         return make_url(stg, config.storage.thumbnails, name)
 
 
-def clear_metadata(fileobj: FileStorage, mime_type: str):
-    resultIO = FileStorage()
+class ChunkedReader(object):
+    """Wraps a binary file, so that iterating over it gives chunks of
+    CHUNK_SIZE bytes instead of lines."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+    def __iter__(self):
+        return iter(lambda: self.fileobj.read(CHUNK_SIZE), b"")
+
+
+def copy_bytes(src, dst, count):
+    """Copy `count` bytes from `src` to `dst`, a chunk at a time."""
+    while count > 0:
+        data = src.read(min(count, CHUNK_SIZE))
+        if not data:
+            raise ValueError("Unexpected end of file")
+        dst.write(data)
+        count -= len(data)
+
+
+def orientation_exif(data):
+    """Returns TIFF formatted EXIF data holding only the orientation tag of
+    the EXIF data in `data`, or None if it doesn't have one."""
+    exifdata = Exif()
+    try:
+        exifdata.load(data)
+    except SyntaxError:
+        raise ValueError("Invalid EXIF data")
+    if ORIENTATION not in exifdata:
+        return None
+    # XXX: We want to remove all EXIF data except orientation (tag 274) or people will start seeing
+    # rotated images...
+    # Also, Pillow can't encode EXIF data, so we have to do it manually
+    if exifdata.endian == "<":
+        head = b"II\x2A\x00\x08\x00\x00\x00"
+    else:
+        head = b"MM\x00\x2A\x00\x00\x00\x08"
+    ifd = TiffImagePlugin.ImageFileDirectory_v2(ifh=head)
+    ifd[ORIENTATION] = exifdata[ORIENTATION]
+    return head + ifd.tobytes(8)
+
+
+def strip_jpeg_metadata(src, dst):
+    """Copy a JPEG file from `src` to `dst`, leaving out the comments, the
+    XMP and IPTC metadata and the EXIF data except for the orientation.
+    Only the segments before the image data are looked at, one at a time,
+    so the image isn't decoded."""
+    if src.read(2) != b"\xff\xd8":
+        raise ValueError("Not a JPEG file")
+    dst.write(b"\xff\xd8")
+    while True:
+        marker = src.read(2)
+        # Markers may be preceded by any number of 0xff fill bytes.
+        while marker == b"\xff\xff":
+            marker = b"\xff" + src.read(1)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            raise ValueError("Invalid JPEG marker")
+        kind = marker[1]
+        if kind == 0xD9:  # End of image
+            dst.write(marker)
+            return
+        if kind == 0x01 or 0xD0 <= kind <= 0xD7:  # Markers without data
+            dst.write(marker)
+            continue
+        header = src.read(2)
+        if len(header) < 2:
+            raise ValueError("Unexpected end of file")
+        length = struct.unpack(">H", header)[0]
+        # The length counts its own two bytes.
+        if length < 2:
+            raise ValueError("Invalid JPEG segment")
+        segment = src.read(length - 2)
+        if len(segment) != length - 2:
+            raise ValueError("Unexpected end of file")
+        if kind == 0xDA:  # Start of scan, followed by the image data
+            dst.write(marker + header + segment)
+            while True:
+                data = src.read(CHUNK_SIZE)
+                if not data:
+                    return
+                dst.write(data)
+        if kind == 0xE1 and segment.startswith(b"Exif\x00\x00"):
+            exif = orientation_exif(segment)
+            if exif is None:
+                continue
+            segment = b"Exif\x00\x00" + exif
+        elif kind in (0xE1, 0xED, 0xFE):  # XMP, IPTC, comments
+            continue
+        dst.write(marker + struct.pack(">H", len(segment) + 2) + segment)
+
+
+def strip_png_metadata(src, dst):
+    """Copy a PNG file from `src` to `dst`, leaving out the text chunks,
+    the modification time and the EXIF data except for the orientation.
+    The chunks are copied a piece at a time, without decoding the image."""
+    if src.read(8) != PNG_SIGNATURE:
+        raise ValueError("Not a PNG file")
+    dst.write(PNG_SIGNATURE)
+    while True:
+        header = src.read(8)
+        if len(header) < 8:
+            raise ValueError("Unexpected end of file")
+        length, kind = struct.unpack(">I4s", header)
+        if kind == b"eXIf" and length <= PNG_MAX_EXIF_SIZE:
+            exif = orientation_exif(src.read(length))
+            src.seek(4, io.SEEK_CUR)
+            if exif is not None:
+                dst.write(struct.pack(">I4s", len(exif), kind) + exif)
+                dst.write(struct.pack(">I", zlib.crc32(kind + exif)))
+        elif kind in PNG_METADATA_CHUNKS:
+            src.seek(length + 4, io.SEEK_CUR)
+        else:
+            dst.write(header)
+            copy_bytes(src, dst, length + 4)
+        if kind == b"IEND":
+            return
+
+
+def clear_metadata(fileobj, mime_type):
+    """Remove the metadata from a JPEG, PNG or MP4 file, without decoding
+    images. Returns a file positioned at its start, which is either
+    `fileobj` itself or a new temporary file with the result."""
     fileobj.seek(0)
     if mime_type in ("image/jpeg", "image/png"):
-        image = Image.open(fileobj)
-        if not image.info.get("exif"):
-            return fileobj
-        exifdata = Exif()
-        exifdata.load(image.info["exif"])
-        # XXX: We want to remove all EXIF data except orientation (tag 274) or people will start seeing
-        # rotated images...
-        # Also, Pillow can't encode EXIF data, so we have to do it manually
-        if exifdata.endian == "<":
-            head = b"II\x2A\x00\x08\x00\x00\x00"
-        else:
-            head = b"MM\x00\x2A\x00\x00\x00\x08"
-        ifd = TiffImagePlugin.ImageFileDirectory_v2(ifh=head)
-        for tag, value in exifdata.items():
-            if tag == 274:
-                ifd[tag] = value
-        newExif = b"Exif\x00\x00" + head + ifd.tobytes(8)
-        image.save(
-            resultIO, format=Image.EXTENSION[EXTENSIONS[mime_type]], exif=newExif
-        )
-        return resultIO
+        result = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+        try:
+            if mime_type == "image/jpeg":
+                strip_jpeg_metadata(fileobj, result)
+            else:
+                strip_png_metadata(fileobj, result)
+        except Exception:
+            result.close()
+            raise
+        result.seek(0)
+        return result
     elif mime_type == "video/mp4":
+        # Mutagen rewrites the metadata in place, moving the rest of the
+        # file a chunk at a time if the size changes.
         video = MP4(fileobj)
-        video.clear()
-        video.save(resultIO)
-        return resultIO
+        if video.tags is not None:
+            video.clear()
+            video.save(fileobj)
+        fileobj.seek(0)
+        return fileobj
     elif mime_type == "video/webm":
         # XXX: Mutagen doesn't seem to support webm files
         return fileobj
@@ -185,12 +324,12 @@ def upload_file():
     if ufile.filename == "":
         return False, False
 
-    mtype = mtype_from_file(ufile, allow_video_formats=config.site.allow_video_uploads)
-    if mtype is None:
-        return _("File type not allowed"), False
-
     try:
-        fhash = calculate_file_hash(ufile, size_limit=config.site.upload_max_size)
+        spool, mtype, fhash = spool_upload(
+            ufile,
+            size_limit=config.site.upload_max_size,
+            allow_video_formats=config.site.allow_video_uploads,
+        )
     except SizeLimitExceededError:
         return (
             _(
@@ -199,10 +338,16 @@ def upload_file():
             ),
             False,
         )
+    if mtype is None:
+        return _("File type not allowed"), False
 
-    basename = str(uuid.uuid5(FILE_NAMESPACE, fhash))
-
-    return store_file(ufile, basename, mtype, remove_metadata=True), True
+    with spool:
+        basename = str(uuid.uuid5(FILE_NAMESPACE, fhash))
+        try:
+            return store_file(spool, basename, mtype, remove_metadata=True), True
+        except ValueError:
+            # The file looked like an image but couldn't be parsed.
+            return _("File type not allowed"), False
 
 
 EXTENSIONS = {
@@ -235,18 +380,21 @@ def store_file(ufile, basename, mtype, remove_metadata=False):
     except libcloud.storage.types.ContainerDoesNotExistError:
         pathlib.Path(config.storage.uploads.path).mkdir(exist_ok=True)
 
-    if remove_metadata:
-        ufile = clear_metadata(ufile, mtype)
-    ufile.seek(0)
-    ufile.filename = filename
-    current_app.logger.debug("Adding %s to stored files", filename)
-    return storage.upload(
-        ufile,
-        prefix=config.storage.uploads.filename_prefix,
-        name=filename,
-        acl=config.storage.acl,
-        content_type=mtype,
-    ).name
+    with ExitStack() as stack:
+        if remove_metadata:
+            cleaned = clear_metadata(ufile, mtype)
+            if cleaned is not ufile:
+                stack.callback(cleaned.close)
+            ufile = cleaned
+        ufile.seek(0)
+        current_app.logger.debug("Adding %s to stored files", filename)
+        return storage.upload(
+            FileStorage(stream=ChunkedReader(ufile), filename=filename),
+            prefix=config.storage.uploads.filename_prefix,
+            name=filename,
+            acl=config.storage.acl,
+            content_type=mtype,
+        ).name
 
 
 def get_stored_file_size(filename):
@@ -300,35 +448,49 @@ def store_thumbnail(im, basename):
         return find_existing_or_store_new(stg, im, filename)
 
 
-def mtype_from_file(ufile, allow_video_formats=True):
-    """Determine the file type from a file storage object and return the
+def mtype_from_buffer(data, allow_video_formats=True):
+    """Determine the file type from the first bytes of a file and return the
     MIME type, or None if the file type is not recognized.
     """
-    ufile.seek(0)
-    mtype = magic.from_buffer(ufile.read(1024), mime=True)
+    mtype = magic.from_buffer(data[:SNIFF_SIZE], mime=True)
     if mtype in EXTENSIONS or (allow_video_formats and mtype in VIDEO_EXTENSIONS):
         return mtype
     return None
 
 
-def calculate_file_hash(ufile, size_limit=None):
-    """Read all data from a file and calculate the MD5 hash of the result.
-    If a size limit is given, stop reading and raise an error if it is
-    exceeded.
+def spool_upload(ufile, size_limit=None, allow_video_formats=True):
+    """Copy an uploaded file to a temporary file in a single pass, which also
+    determines the file type from its first bytes and calculates the hash
+    of its contents. Returns the temporary file, the MIME type and the hash,
+    or (None, None, None) if the file type is not recognized, in which case
+    the rest of the file is not read. If a size limit is given, stop reading
+    and raise an error if it is exceeded. Only CHUNK_SIZE bytes of the
+    upload are read at a time, and the copy is moved from memory to disk
+    when it grows past SPOOL_MAX_MEMORY bytes.
     """
     ufile.seek(0)
-    size = 0
-    fhash = hashlib.blake2b()
-    while True:
-        data = ufile.read(65536)
-        if not data:
-            break
-        size += len(data)
-        if size_limit is not None and size > size_limit:
-            raise SizeLimitExceededError
-        fhash.update(data)
-        gevent.sleep(0)
-    return fhash.hexdigest()
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+    try:
+        data = ufile.read(CHUNK_SIZE)
+        mtype = mtype_from_buffer(data, allow_video_formats)
+        if mtype is None:
+            spool.close()
+            return None, None, None
+        size = 0
+        fhash = hashlib.blake2b()
+        while data:
+            size += len(data)
+            if size_limit is not None and size > size_limit:
+                raise SizeLimitExceededError
+            fhash.update(data)
+            spool.write(data)
+            gevent.sleep(0)
+            data = ufile.read(CHUNK_SIZE)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool, mtype, fhash.hexdigest()
 
 
 def human_readable(fbytes):
@@ -14,9 +14,13 @@ from PIL import Image
 import requests
 
 from .config import config
-from .misc import WHITESPACE, logger
+from .misc import WHITESPACE, logger, undo_votes as undo_votes_query
+from .models import rconn
 from .storage import store_thumbnail, thumbnail_url
-from .socketio import send_deferred_event
+from .socketio import socketio, send_deferred_event
+
+# Held while the votes of a user are being removed.
+UNDO_VOTES_KEY = "undo-votes:{0}"
 
 
 def create_thumbnail(fileid, store):
@@ -270,3 +274,43 @@ def safe_request(
             else:
                 raise ValueError("response too large")
     return r, f
+
+
+def undo_votes(uid, admin_uid):
+    """Start removing all the votes cast by a user in a new gevent thread,
+    reporting the progress to the admin who requested it via socketio.
+    Returns False if the votes of that user are already being removed."""
+    if not rconn.set(UNDO_VOTES_KEY.format(uid), admin_uid, nx=True, ex=3600):
+        return False
+    if config.app.testing:
+        undo_votes_async(uid, admin_uid)
+    else:
+        gevent.spawn(
+            undo_votes_async_appctx, current_app._get_current_object(), uid, admin_uid
+        )
+    return True
+
+
+def undo_votes_async_appctx(app, uid, admin_uid):
+    with app.app_context():
+        undo_votes_async(uid, admin_uid)
+
+
+def undo_votes_async(uid, admin_uid):
+    def progress(done, steps):
+        socketio.emit(
+            "undovotes",
+            {"uid": uid, "done": done, "steps": steps},
+            namespace="/snt",
+            room="user" + admin_uid,
+        )
+
+    try:
+        count = undo_votes_query(uid, progress)
+        result = {"uid": uid, "status": "ok", "count": count}
+    except Exception:  # noqa
+        logger.exception("Failed to remove the votes of %s", uid)
+        result = {"uid": uid, "status": "error"}
+    finally:
+        rconn.delete(UNDO_VOTES_KEY.format(uid))
+    socketio.emit("undovotes", result, namespace="/snt", room="user" + admin_uid)
@@ -48,9 +48,10 @@ from ..models import (
     SubPostVote,
     SiteMetadata,
 )
-from ..models import UserUploads, InviteCode, Wiki
+from ..models import UserUploads, InviteCode, Wiki, db_pool_stats
 from ..misc import engine, getReports
 from ..badges import badges
+from ..site_stats import site_stats
 
 bp = Blueprint("admin", __name__)
 
@@ -164,14 +165,7 @@ def index():
     if not current_user.admin:
         return redirect(url_for("admin.auth"))
 
-    users = User.select().count()
-    subs = Sub.select().count()
-    posts = SubPost.select().count()
-    comms = SubPostComment.select().count()
-    ups = SubPostVote.select().where(SubPostVote.positive == 1).count()
-    downs = SubPostVote.select().where(SubPostVote.positive == 0).count()
-    ups += SubPostCommentVote.select().where(SubPostCommentVote.positive == 1).count()
-    downs += SubPostCommentVote.select().where(SubPostCommentVote.positive == 0).count()
+    stats = site_stats.totals()
 
     invite = UseInviteCodeForm()
     invite.minlevel.data = config.site.invite_level
@@ -181,12 +175,15 @@ def index():
 
     return render_template(
         "admin/admin.html",
-        subs=subs,
-        posts=posts,
-        ups=ups,
-        downs=downs,
-        users=users,
-        comms=comms,
+        subs=stats["subs"],
+        posts=stats["posts"],
+        ups=stats["upvotes"],
+        downs=stats["downvotes"],
+        users=stats["users"],
+        comms=stats["comments"],
+        daily_stats=site_stats.history(),
+        markdown_cache=misc.markdown_cache.info(),
+        db_pool=db_pool_stats(),
         subOfTheDay=subOfTheDay,
         useinvitecodeform=invite,
         csrf_form=CsrfTokenOnlyForm(),
@@ -298,6 +295,7 @@ def editbadge(badge):
             rank=form.rank.data,
             icon=icon,
         )
+        misc.invalidate_all_session_snapshots()
         return redirect(url_for("admin.userbadges"))
     form.name.data = badge.name
     form.alt.data = badge.alt
@@ -315,6 +313,7 @@ def deletebadge(badge):
         abort(404)
 
     badges.delete_badge(badge)
+    misc.invalidate_all_session_snapshots()
     return redirect(url_for("admin.userbadges"))
 
 
@@ -552,7 +551,11 @@ def posts(page):
     if not current_user.is_admin():
         abort(404)
     posts = misc.getPostList(
-        misc.postListQueryBase(include_deleted_posts=True), "new", page, page_size=50
+        misc.postListQueryBase(include_deleted_posts=True),
+        "new",
+        page,
+        page_size=50,
+        after=request.args.get("after", type=int),
     )
     return render_template(
         "admin/posts.html", page=page, admin_route="admin.posts", posts=posts
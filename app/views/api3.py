@@ -56,6 +56,9 @@ from ..caching import cache
 from ..config import config
 from ..badges import badges
 from ..notifications import notifications
+from ..search import index_post, unindex_post, index_comment, unindex_comment
+from ..search import search_posts, search_comments, sub_names
+from ..site_stats import site_stats
 
 API = Blueprint("apiv3", __name__)
 
@@ -247,13 +250,15 @@ def fresh_login():
 @jwt_required(optional=True)
 def get_post_list(target):
     """Same as v2, but `content` is returned as parsed markdown and the `sort` can be `default`
-    when `target` is a sub"""
+    when `target` is a sub. Passing the pid of the last post received as `after` returns the
+    posts that follow it, regardless of `page`."""
 
     if target not in ("all", "home"):
         sort = request.args.get("sort", default="default")
     else:
         sort = request.args.get("sort", default="new")
     page = request.args.get("page", default=1, type=int)
+    after = request.args.get("after", default=None, type=int)
 
     if sort not in ("hot", "top", "new", "default"):
         return jsonify(msg="Invalid sort"), 400
@@ -264,7 +269,10 @@ def get_post_list(target):
     base_query = SubPost.select(
         SubPost.nsfw,
         SubPost.content,
+        SubPost.content_html,
+        SubPost.html_version,
         SubPost.pid,
+        SubPost.sid,
         SubPost.title,
         SubPost.posted,
         SubPost.score,
@@ -272,6 +280,7 @@ def get_post_list(target):
         SubPost.link,
         User.name.alias("user"),
         Sub.name.alias("sub"),
+        Sub.nsfw.alias("sub_nsfw"),
         SubPost.flair,
         SubPost.edited,
         SubPost.comments,
@@ -341,9 +350,12 @@ def get_post_list(target):
         base_query = base_query.where(Sub.sid == sub.sid)
 
     base_query = base_query.where(SubPost.deleted == 0)
-    posts = misc.getPostList(base_query, sort, page)
+    posts = misc.getPostList(base_query, sort, page, after=after)
 
-    cnt = base_query.count() - page * 25
+    if after is None:
+        cnt = base_query.count() - page * 25
+    else:
+        cnt = 1 if len(posts) == 25 else 0
     postList = []
     for post in posts:
         if post["userstatus"] == 10:  # account deleted
@@ -351,8 +363,11 @@ def get_post_list(target):
         post["archived"] = misc.is_archived(post)
         del post["userstatus"]
         del post["uid"]
+        content_html, html_version = post.pop("content_html"), post.pop("html_version")
         post["content"] = (
-            misc.our_markdown(post["content"]) if post["ptype"] != 1 else ""
+            misc.stored_markdown(post["content"], content_html, html_version)
+            if post["ptype"] != 1
+            else ""
         )
         postList.append(post)
 
@@ -367,6 +382,8 @@ def get_post(sub, pid):
     base_query = SubPost.select(
         SubPost.nsfw,
         SubPost.content,
+        SubPost.content_html,
+        SubPost.html_version,
         SubPost.pid,
         SubPost.title,
         SubPost.posted,
@@ -417,8 +434,11 @@ def get_post(sub, pid):
         post["edited"] = None
 
     post["source"] = post["content"]
+    content_html, html_version = post.pop("content_html"), post.pop("html_version")
     if post["content"]:
-        post["content"] = misc.our_markdown(post["content"])
+        post["content"] = misc.stored_markdown(
+            post["content"], content_html, html_version
+        )
 
     if post["userstatus"] == 10:
         post["user"] = "[Deleted]"
@@ -473,10 +493,12 @@ def edit_post(sub, pid):
         return jsonify(msg="Post is archived"), 403
 
     post.content = content
+    misc.render_content(post)
     # Only save edited time if it was posted more than five minutes ago
     if (datetime.datetime.utcnow() - post.posted.replace(tzinfo=None)).seconds > 300:
         post.edited = datetime.datetime.utcnow()
     post.save()
+    index_post(post.pid)
     return get_post(sub, pid)
 
 
@@ -514,6 +536,7 @@ def delete_post(sub, pid):
             sender=uid,
             target=post.uid,
         )
+        misc.adjust_unread_count(post.uid_id, "notifications")
 
         misc.create_sublog(
             misc.LOG_TYPE_SUB_DELETE_POST,
@@ -542,6 +565,7 @@ def delete_post(sub, pid):
     except SiteMetadata.DoesNotExist:
         pass
     post.save()
+    unindex_post(post.pid)
     Sub.update(posts=Sub.posts - 1).where(Sub.sid == post.sid).execute()
     return jsonify(), 200
 
@@ -590,8 +614,8 @@ def get_post_comments(_sub, pid):
         return jsonify(msg="Post does not exist"), 404
 
     # 1 - Fetch all comments (only cid and parentcid)
-    comments = misc.get_comment_query(post.pid, sort="top")
-    if not comments.count():
+    comments = misc.get_comment_list(post.pid, sort="top")
+    if not comments:
         return jsonify(comments=[])
 
     comment_tree = misc.get_comment_tree(
@@ -664,6 +688,7 @@ def create_comment(sub, pid):
         pid=pid,
         uid=uid,
         content=content,
+        **misc.rendered_fields(content),
         parentcid=parentcid,
         time=datetime.datetime.utcnow(),
         cid=uuid.uuid4(),
@@ -676,12 +701,16 @@ def create_comment(sub, pid):
     SubPost.update(comments=SubPost.comments + 1).where(
         SubPost.pid == post.pid
     ).execute()
+    site_stats.add(comments=1)
+    misc.invalidate_comment_cache(post.pid)
+    index_comment(comment.cid)
 
     if config.site.self_voting.comments:
         SubPostCommentVote.create(cid=comment.cid, uid=uid, positive=True)
         User.update(given=User.given + 1).where(User.uid == uid).execute()
+        site_stats.add(upvotes=1)
 
-    socketio.emit(
+    socketio.emit_latest(
         "threadcomments",
         {"pid": post.pid, "comments": post.comments + 1},
         namespace="/snt",
@@ -693,9 +722,7 @@ def create_comment(sub, pid):
     ]
     comment_res = misc.word_truncate(
         "".join(
-            BeautifulSoup(misc.our_markdown(comment.content), features="lxml").findAll(
-                text=True
-            )
+            BeautifulSoup(comment.content_html, features="lxml").findAll(text=True)
         ).replace("\n", " "),
         250,
     )
@@ -752,6 +779,8 @@ def create_comment(sub, pid):
         SubPostComment.select(
             SubPostComment.cid,
             SubPostComment.content,
+            SubPostComment.content_html,
+            SubPostComment.html_version,
             SubPostComment.lastedit,
             SubPostComment.score,
             SubPostComment.status,
@@ -777,7 +806,9 @@ def create_comment(sub, pid):
         .dicts()[0]
     )
     comm["source"] = comm["content"]
-    comm["content"] = misc.our_markdown(comm["content"])
+    comm["content"] = misc.stored_markdown(
+        comm["content"], comm.pop("content_html"), comm.pop("html_version")
+    )
     return jsonify(comment=comm), 200
 
 
@@ -815,13 +846,18 @@ def edit_comment(_sub, pid, cid):
         return jsonify(msg="Content is too long"), 400
 
     comment.content = content
+    misc.render_content(comment)
     comment.lastedit = datetime.datetime.utcnow()
     comment.save()
+    misc.invalidate_comment_cache(post.pid, [comment.cid])
+    index_comment(comment.cid)
     # TODO: move this block to a function
     comm = (
         SubPostComment.select(
             SubPostComment.cid,
             SubPostComment.content,
+            SubPostComment.content_html,
+            SubPostComment.html_version,
             SubPostComment.lastedit,
             SubPostComment.score,
             SubPostComment.status,
@@ -847,7 +883,9 @@ def edit_comment(_sub, pid, cid):
         .dicts()[0]
     )
     comm["source"] = comm["content"]
-    comm["content"] = misc.our_markdown(comm["content"])
+    comm["content"] = misc.stored_markdown(
+        comm["content"], comm.pop("content_html"), comm.pop("html_version")
+    )
     return jsonify(comment=comm), 200
 
 
@@ -876,6 +914,8 @@ def delete_comment(_sub, pid, cid):
 
     comment.status = 1
     comment.save()
+    misc.invalidate_comment_cache(post.pid, [comment.cid])
+    unindex_comment(comment.cid)
 
     return jsonify(), 200
 
@@ -917,8 +957,8 @@ def get_post_comment_children(_sub, pid, cid):
         except SubPostComment.DoesNotExist:
             return jsonify(msg="Post does not exist"), 404
 
-    comments = misc.get_comment_query(pid, sort="top")
-    if not comments.count():
+    comments = misc.get_comment_list(pid, sort="top")
+    if not comments:
         return jsonify(comments=[])
 
     if lim:
@@ -1096,7 +1136,9 @@ def create_post():
         uid=uid,
         title=title.strip(misc.WHITESPACE),
         content=content,
+        **misc.rendered_fields(content),
         link=link if ptype == "link" else None,
+        domain=misc.link_domain(link) if ptype == "link" else None,
         posted=datetime.datetime.utcnow(),
         score=self_vote,
         upvotes=self_vote,
@@ -1107,10 +1149,13 @@ def create_post():
         nsfw=nsfw if not subdata.get("nsfw") == "1" else 1,
         thumbnail="deferred" if ptype == "link" else "",
     )
+    misc.update_post_hot_rank(post.pid)
+    index_post(post.pid)
     if ptype == "link":
         tasks.create_thumbnail_external(link, [(SubPost, "pid", post.pid)])
 
     Sub.update(posts=Sub.posts + 1).where(Sub.sid == sub.sid).execute()
+    site_stats.add(posts=1)
     addr = url_for("sub.view_post", sub=sub.name, pid=post.pid)
     posts = misc.getPostList(
         misc.postListQueryBase(nofilter=True).where(SubPost.pid == post.pid), "new", 1
@@ -1146,6 +1191,7 @@ def create_post():
     if config.site.self_voting.posts:
         SubPostVote.create(uid=uid, pid=post.pid, positive=True)
         User.update(given=User.given + 1).where(User.uid == uid).execute()
+        site_stats.add(upvotes=1)
 
     misc.workWithMentions(content, None, post, sub, c_user=user)
     misc.workWithMentions(title, None, post, sub, c_user=user)
@@ -1179,6 +1225,132 @@ def search_sub():
     return jsonify(results=list(subs))
 
 
+@API.route("/search/subs/typeahead", methods=["GET"])
+def typeahead_sub():
+    """Returns the names of up to ten subs starting with `q`, for
+    autocompletion. Served from memory, without querying the database."""
+    prefix = request.args.get("q", "")
+    if not prefix or not misc.allowedNames.match(prefix):
+        return jsonify(results=[])
+    return jsonify(results=[{"name": name} for name in sub_names.complete(prefix)])
+
+
+@API.route("/search", methods=["GET"])
+@jwt_required(optional=True)
+@ratelimit(POSTING_LIMIT)
+def search():
+    """Full-text search of posts, or of comments if `type` is `comments`,
+    with the best matches first. `sub` restricts the search to one sub."""
+    terms = request.args.get("q", default="").strip()
+    stype = request.args.get("type", default="posts")
+    page = request.args.get("page", default=1, type=int)
+    sub = request.args.get("sub", default=None)
+
+    if not terms:
+        return jsonify(msg="Missing search terms"), 400
+    if stype not in ("posts", "comments"):
+        return jsonify(msg="Invalid type"), 400
+    if page < 1:
+        return jsonify(msg="Invalid page number"), 400
+
+    uid = get_jwt_identity()
+    if sub is not None:
+        try:
+            sub = Sub.get(fn.Lower(Sub.name) == sub.lower())
+        except Sub.DoesNotExist:
+            return jsonify(msg="Sub does not exist"), 404
+        sub_filter = SubPost.sid == sub.sid
+    elif uid:
+        blocked = SubSubscriber.select(SubSubscriber.sid).where(
+            (SubSubscriber.uid == uid) & (SubSubscriber.status == 2)
+        )
+        sub_filter = SubPost.sid.not_in(blocked)
+    else:
+        sub_filter = None
+
+    if stype == "posts":
+        query = (
+            SubPost.select(
+                SubPost.nsfw,
+                SubPost.content,
+                SubPost.content_html,
+                SubPost.html_version,
+                SubPost.pid,
+                SubPost.title,
+                SubPost.posted,
+                SubPost.score,
+                SubPost.thumbnail,
+                SubPost.link,
+                User.name.alias("user"),
+                Sub.name.alias("sub"),
+                SubPost.flair,
+                SubPost.edited,
+                SubPost.comments,
+                SubPost.ptype,
+                User.status.alias("userstatus"),
+                SubPost.upvotes,
+                SubPost.downvotes,
+            )
+            .join(User, JOIN.LEFT_OUTER)
+            .switch(SubPost)
+            .join(Sub, JOIN.LEFT_OUTER)
+            .where(SubPost.deleted == 0)
+        )
+        if sub_filter is not None:
+            query = query.where(sub_filter)
+        results = list(search_posts(query, terms).paginate(page, 25).dicts())
+        for post in results:
+            content_html, html_version = (
+                post.pop("content_html"),
+                post.pop("html_version"),
+            )
+            post["content"] = (
+                misc.stored_markdown(post["content"], content_html, html_version)
+                if post["ptype"] != 1
+                else ""
+            )
+    else:
+        query = (
+            SubPostComment.select(
+                SubPostComment.cid,
+                SubPostComment.pid,
+                SubPostComment.content,
+                SubPostComment.content_html,
+                SubPostComment.html_version,
+                SubPostComment.time,
+                SubPostComment.lastedit,
+                SubPostComment.score,
+                User.name.alias("user"),
+                User.status.alias("userstatus"),
+                Sub.name.alias("sub"),
+                SubPost.title.alias("post_title"),
+            )
+            .join(User, JOIN.LEFT_OUTER)
+            .switch(SubPostComment)
+            .join(SubPost)
+            .join(Sub)
+            .where(
+                (SubPostComment.status.is_null() | (SubPostComment.status == 0))
+                & (SubPost.deleted == 0)
+            )
+        )
+        if sub_filter is not None:
+            query = query.where(sub_filter)
+        results = list(search_comments(query, terms).paginate(page, 25).dicts())
+        for comment in results:
+            comment["content"] = misc.stored_markdown(
+                comment["content"],
+                comment.pop("content_html"),
+                comment.pop("html_version"),
+            )
+
+    for result in results:
+        if result["userstatus"] == 10:  # account deleted
+            result["user"] = "[Deleted]"
+        del result["userstatus"]
+    return jsonify(results=results, continues=len(results) == 25)
+
+
 @API.route("/sub/<name>", methods=["GET"])
 def get_sub(name):
     try:
@@ -1340,32 +1512,6 @@ def user_overview(username):
 def get_own_user():
     """Return user info and notifications count for the current user"""
     uid = get_jwt_identity()
-    mcount = (
-        Message.select(fn.Count(Message.mid))
-        .join(
-            UserUnreadMessage,
-            on=(
-                (UserUnreadMessage.uid == uid) & (UserUnreadMessage.mid == Message.mid)
-            ),
-        )
-        .where(
-            (Message.receivedby == uid)
-            & (
-                Message.mtype
-                << (
-                    MessageType.USER_TO_USER,
-                    MessageType.MOD_TO_USER_AS_MOD,
-                    MessageType.MOD_TO_USER_AS_USER,
-                    MessageType.USER_NOTIFICATION,
-                )
-            )
-        )
-    )
-    ncount = Notification.select(fn.Count(Notification.id)).where(
-        (Notification.target == uid) & Notification.read.is_null(True)
-    )
-    user = User.select(mcount.alias("messages"), ncount.alias("notifications"))
-    user = user.where(User.uid == uid).dicts().get()
     return jsonify(
         {
             "user": None,  # TODO: send same stuff as get_user
@@ -1426,6 +1572,8 @@ def delete_notification():
         return jsonify(error="Notification does not exist"), 404
 
     notification.delete_instance()
+    if notification.read is None:
+        misc.invalidate_unread_counts(uid)
     return jsonify(status="ok")
 
 
@@ -1506,6 +1654,7 @@ def ignore_notifications():
     else:
         ucb.method = UserContentBlockMethod.HIDE
         ucb.save()
+    misc.invalidate_unread_counts(uid)
     return jsonify(status="ok")
 
 
@@ -1547,6 +1696,7 @@ def unignore_notifications():
         umb.delete_instance()
     if ucb is not None:
         ucb.delete_instance()
+    misc.invalidate_unread_counts(uid)
     return jsonify(status="ok")
 
 
@@ -1579,9 +1729,7 @@ def delete_message():
     except Message.DoesNotExist:
         return jsonify(error="Message does not exist"), 404
 
-    UserUnreadMessage.delete().where(
-        (UserUnreadMessage.uid == uid) & (UserUnreadMessage.mid == message_id)
-    ).execute()
+    misc.delete_unread_message(uid, message_id)
     UserMessageMailbox.update(mailbox=MessageMailbox.DELETED).where(
         (UserMessageMailbox.uid == uid) & (UserMessageMailbox.mid == message_id)
     ).execute()
@@ -1651,7 +1799,7 @@ def read_message(mid):
     except UserUnreadMessage.DoesNotExist:
         return jsonify(status="ok")
 
-    um.delete_instance()
+    misc.delete_unread_message(uid, um.mid_id)
     socketio.emit(
         "notification",
         {"count": misc.get_notification_count(uid)},
@@ -1739,6 +1887,7 @@ def set_settings():
         )
 
     [x.execute() for x in qrys]
+    misc.invalidate_session_snapshot(uid)
     return jsonify()
 
 
@@ -6,7 +6,6 @@ import time
 import datetime
 import uuid
 import random
-from collections import defaultdict
 from flask import Blueprint, redirect, url_for, session, abort, jsonify, current_app
 from flask import request, flash, Markup
 from flask_login import login_user, login_required, logout_user, current_user
@@ -35,6 +34,9 @@ from ..forms import UseInviteCodeForm, SecurityQuestionForm, DistinguishForm
 from ..forms import BanDomainForm, SetOwnUserFlairForm, ChangeConfigSettingForm
 from ..forms import AnnouncePostForm, LiteralBooleanForm, ViewCommentsForm
 from ..badges import badges
+from ..comment_views import comment_views
+from ..search import index_post, unindex_post, index_comment, unindex_comment
+from ..site_stats import site_stats
 from ..misc import (
     cache,
     send_email,
@@ -79,7 +81,6 @@ from ..models import (
     SubPostReport,
 )
 from ..models import (
-    SubPostVote,
     SubPostCommentVote,
     SubPostCommentView,
     SubFlair,
@@ -299,6 +300,7 @@ def edit_user():
         current_user.update_prefs("noscroll", form.noscroll.data)
         current_user.update_prefs("nochat", form.nochat.data)
         current_user.update_prefs("subtheme", form.subtheme.data, False)
+        misc.invalidate_session_snapshot(current_user.uid)
 
         cache.delete_memoized(current_user.get_global_stylesheet)
 
@@ -434,6 +436,7 @@ def delete_post():
 
         post.deleted = deletion
         post.save()
+        unindex_post(post.pid)
 
         return jsonify(status="ok")
     return jsonify(status="ok", error=get_errors(form))
@@ -528,6 +531,7 @@ def undelete_post():
 
         post.deleted = deletion
         post.save()
+        index_post(post.pid)
 
         return jsonify(status="ok")
     return jsonify(status="ok", error=get_errors(form))
@@ -908,6 +912,7 @@ def edit_mod():
             sm.save()
         except SubMod.DoesNotExist:
             SubMod.create(sid=sub.sid, uid=user.uid, power_level=0)
+        misc.invalidate_session_snapshot(user.uid)
 
         misc.create_sublog(
             misc.LOG_TYPE_SUB_TRANSFER,
@@ -942,6 +947,7 @@ def assign_userbadge():
 
     if form.validate():
         badges.assign_userbadge(user.uid, bid)
+        misc.invalidate_session_snapshot(user.uid)
         # TODO log it, create new log type and save to sitelog ??
         return jsonify(status="ok")
     return jsonify(status="error", error=get_errors(form))
@@ -968,6 +974,7 @@ def remove_userbadge():
 
     if form.validate():
         badges.unassign_userbadge(user.uid, bid)
+        misc.invalidate_session_snapshot(user.uid)
         # TODO log it, create new log type and save to sitelog ??
         return jsonify(status="ok")
     return jsonify(status="error", error=get_errors(form))
@@ -1002,6 +1009,7 @@ def subscribe_to_sub(sid):
             time=datetime.datetime.utcnow(), uid=current_user.uid, sid=sid, status=1
         )
         Sub.update(subscribers=Sub.subscribers + 1).where(Sub.sid == sid).execute()
+        misc.invalidate_session_snapshot(current_user.uid)
         return jsonify(status="ok")
     return jsonify(status="error", error=get_errors(form))
 
@@ -1028,6 +1036,7 @@ def unsubscribe_from_sub(sid):
         ss.delete_instance()
 
         Sub.update(subscribers=Sub.subscribers - 1).where(Sub.sid == sid).execute()
+        misc.invalidate_session_snapshot(current_user.uid)
         return jsonify(status="ok")
     return jsonify(status="error", error=get_errors(form))
 
@@ -1058,6 +1067,7 @@ def block_sub(sid):
         SubSubscriber.create(
             time=datetime.datetime.utcnow(), uid=current_user.uid, sid=sid, status=2
         )
+        misc.invalidate_session_snapshot(current_user.uid)
         return jsonify(status="ok")
     return jsonify(status="error", error=get_errors(form))
 
@@ -1082,6 +1092,7 @@ def unblock_sub(sid):
             & (SubSubscriber.status == 2)
         )
         ss.delete_instance()
+        misc.invalidate_session_snapshot(current_user.uid)
         return jsonify(status="ok")
     return jsonify(status="error", error=get_errors(form))
 
@@ -1124,7 +1135,9 @@ def get_txtpost(pid):
     if post["visibility"] == "none":
         abort(404)
 
-    cont = misc.our_markdown(post["content"])
+    cont = misc.stored_markdown(
+        post["content"], post["content_html"], post["html_version"]
+    )
     if post["ptype"] == 3:
         pollData = {"has_voted": False}
         postmeta = misc.metadata_to_dict(
@@ -1222,6 +1235,8 @@ def distinguish():
         item.distinguish = 2
 
     item.save()
+    if cid:
+        misc.invalidate_comment_cache(item.pid_id, [item.cid])
     return jsonify(status="ok")
 
 
@@ -1295,12 +1310,14 @@ def edit_txtpost(pid):
         SubPostContentHistory.create(pid=post.pid, content=post.content, datetime=dt)
 
         post.content = form.content.data
+        misc.render_content(post)
         # Only save edited time if it was posted more than five minutes ago
         if (
             datetime.datetime.utcnow() - post.posted.replace(tzinfo=None)
         ).seconds > 300:
             post.edited = datetime.datetime.utcnow()
         post.save()
+        index_post(post.pid)
         return jsonify(status="ok")
     return json.dumps({"status": "error", "error": get_errors(form)})
 
@@ -1394,6 +1411,7 @@ def create_comment(pid):
             pid=pid,
             uid=current_user.uid,
             content=form.comment.data.encode(),
+            **misc.rendered_fields(form.comment.data),
             parentcid=form.parent.data if form.parent.data != "0" else None,
             time=datetime.datetime.utcnow(),
             cid=uuid.uuid4(),
@@ -1405,6 +1423,9 @@ def create_comment(pid):
         SubPost.update(comments=SubPost.comments + 1).where(
             SubPost.pid == post.pid
         ).execute()
+        site_stats.add(comments=1)
+        misc.invalidate_comment_cache(post.pid)
+        index_comment(comment.cid)
 
         if config.site.self_voting.comments:
             SubPostCommentVote.create(
@@ -1413,8 +1434,9 @@ def create_comment(pid):
             User.update(given=User.given + 1).where(
                 User.uid == current_user.uid
             ).execute()
+            site_stats.add(upvotes=1)
 
-        socketio.emit(
+        socketio.emit_latest(
             "threadcomments",
             {"pid": post.pid, "comments": post.comments + 1},
             namespace="/snt",
@@ -1932,6 +1954,7 @@ def remove_mod2(sub, user):
 
             mod.delete_instance()
             SubMetadata.create(sid=sub.sid, key="xmod2", value=user.uid)
+            misc.invalidate_session_snapshot(user.uid)
 
             misc.create_sublog(
                 misc.LOG_TYPE_SUB_MOD_REMOVE,
@@ -2059,6 +2082,7 @@ def accept_modinv(sub, user):
             Sub.update(subscribers=Sub.subscribers + 1).where(
                 Sub.sid == sub.sid
             ).execute()
+        misc.invalidate_session_snapshot(current_user.uid)
         return jsonify(status="ok")
     return json.dumps({"status": "error", "error": get_errors(form)})
 
@@ -2111,7 +2135,7 @@ def read_pm(mid):
     except UserUnreadMessage.DoesNotExist:
         return jsonify(status="ok")
 
-    um.delete_instance()
+    misc.delete_unread_message(current_user.uid, um.mid_id)
     socketio.emit(
         "notification",
         {"count": misc.get_notification_count(current_user.uid)},
@@ -2129,6 +2153,7 @@ def readall_msgs():
     UserUnreadMessage.delete().where(
         UserUnreadMessage.id << [u["id"] for u in unreads.dicts()]
     ).execute()
+    misc.clear_unread_count(current_user.uid, "messages")
 
     socketio.emit(
         "notification",
@@ -2148,9 +2173,7 @@ def delete_pm(mid):
         if message.receivedby_id != current_user.uid:
             return jsonify(status="error", error=_("Message does not exist"))
 
-        UserUnreadMessage.delete().where(
-            (UserUnreadMessage.uid == current_user.uid) & (UserUnreadMessage.mid == mid)
-        ).execute()
+        misc.delete_unread_message(current_user.uid, message.mid)
         UserMessageMailbox.update(mailbox=MessageMailbox.DELETED).where(
             (UserMessageMailbox.uid == current_user.uid)
             & (UserMessageMailbox.mid == mid)
@@ -2203,6 +2226,7 @@ def edit_title():
 
         post.title = form.reason.data
         post.save()
+        index_post(post.pid)
         socketio.emit(
             "threadtitle",
             {"pid": post.pid, "title": form.reason.data},
@@ -2336,6 +2360,7 @@ def ban_domain(domain_type):
             return jsonify(status="error", error=[_("Domain is already banned")])
         except SiteMetadata.DoesNotExist:
             SiteMetadata.create(key=key, value=form.domain.data)
+            misc.banned_domains.invalidate()
             misc.create_sitelog(action, current_user.uid, comment=form.domain.data)
             return jsonify(status="ok")
 
@@ -2363,6 +2388,7 @@ def remove_banned_domain(domain_type, domain):
         sm.delete_instance()
     except SiteMetadata.DoesNotExist:
         return jsonify(status="error", error=_("Domain is not banned"))
+    misc.banned_domains.invalidate()
 
     misc.create_sitelog(action, current_user.uid, comment=domain)
 
@@ -2603,6 +2629,7 @@ def set_sticky_comment(comment):
             SubPostMetadata.create(pid=comment.pid, key="sticky_cid", value=comment.cid)
             comment.distinguish = 1 if is_mod else 2
         comment.save()
+        misc.invalidate_comment_cache(comment.pid_id, [comment.cid])
 
     return jsonify(status="ok")
 
@@ -2911,11 +2938,16 @@ def edit_comment():
         SubPostCommentHistory.create(
             cid=comment.cid,
             content=comment.content,
+            content_html=comment.content_html,
+            html_version=comment.html_version,
             datetime=(comment.lastedit or comment.time),
         )
         comment.content = form.text.data
+        misc.render_content(comment)
         comment.lastedit = dt
         comment.save()
+        misc.invalidate_comment_cache(post.pid, [comment.cid])
+        index_comment(comment.cid)
         return jsonify(status="ok")
     return json.dumps({"status": "error", "error": get_errors(form)[0]})
 
@@ -3016,6 +3048,8 @@ def delete_comment():
             comment.status = 1
 
         comment.save()
+        misc.invalidate_comment_cache(post.pid, [comment.cid])
+        unindex_comment(comment.cid)
         return jsonify(status="ok")
     return json.dumps({"status": "error", "error": get_errors(form)})
 
@@ -3115,6 +3149,8 @@ def undelete_comment():
             )
         comment.status = 0
         comment.save()
+        misc.invalidate_comment_cache(post.pid, [comment.cid])
+        index_comment(comment.cid)
 
         return jsonify(status="ok")
     return json.dumps({"status": "error", "error": get_errors(form)})
@@ -3174,9 +3210,9 @@ def get_sibling(pid, cid, lim):
     postmeta = misc.metadata_to_dict(
         SubPostMetadata.select().where(SubPostMetadata.pid == pid)
     )
-    comments = misc.get_comment_query(pid, sort=sort)
+    comments = misc.get_comment_list(pid, sort=sort)
 
-    if not comments.count():
+    if not comments:
         return engine.get_template("sub/postcomments.html").render(
             {
                 "post": post,
@@ -3317,6 +3353,7 @@ def ignore_user(uid):
     except UserMessageBlock.DoesNotExist:
         UserMessageBlock.create(uid=current_user.uid, target=uid)
 
+    misc.invalidate_unread_counts(current_user.uid)
     return jsonify(status="ok")
 
 
@@ -3374,6 +3411,7 @@ def edit_ignore(uid):
         except UserContentBlock.DoesNotExist:
             if method is not None:
                 UserContentBlock.create(uid=current_user.uid, target=uid, method=method)
+        misc.invalidate_unread_counts(current_user.uid)
         return jsonify(status="ok")
     return jsonify(status="error", error=get_errors(form))
 
@@ -3463,39 +3501,56 @@ def sub_upload(sub):
             }
         )
 
-    mtype = storage.mtype_from_file(ufile, allow_video_formats=False)
-    if mtype is None:
+    try:
+        spool, mtype, fhash = storage.spool_upload(
+            ufile, size_limit=remaining, allow_video_formats=False
+        )
+    except storage.SizeLimitExceededError:
         return engine.get_template("sub/css.html").render(
             {
                 "sub": sub,
                 "form": form,
                 "storage": int(remaining - (1024 * 1024)),
                 "max_storage": config.storage.sub_css_max_file_size,
-                "error": _("Invalid file type. Only jpg, png and gif allowed."),
+                "error": _("Not enough available space to upload file."),
                 "files": ufiles,
                 "subInfo": subInfo,
                 "subMods": subMods,
             }
         )
 
-    try:
-        fhash = storage.calculate_file_hash(ufile, size_limit=remaining)
-    except storage.SizeLimitExceededError:
+    if mtype is None:
         return engine.get_template("sub/css.html").render(
             {
                 "sub": sub,
                 "form": form,
                 "storage": int(remaining - (1024 * 1024)),
                 "max_storage": config.storage.sub_css_max_file_size,
-                "error": _("Not enough available space to upload file."),
+                "error": _("Invalid file type. Only jpg, png and gif allowed."),
                 "files": ufiles,
                 "subInfo": subInfo,
                 "subMods": subMods,
             }
         )
 
-    basename = str(uuid.uuid5(storage.FILE_NAMESPACE, fhash))
-    f_name = storage.store_file(ufile, basename, mtype, remove_metadata=True)
+    with spool:
+        basename = str(uuid.uuid5(storage.FILE_NAMESPACE, fhash))
+        try:
+            f_name = storage.store_file(spool, basename, mtype, remove_metadata=True)
+        except ValueError:
+            # The file looked like an image but couldn't be parsed.
+            return engine.get_template("sub/css.html").render(
+                {
+                    "sub": sub,
+                    "form": form,
+                    "storage": int(remaining - (1024 * 1024)),
+                    "max_storage": config.storage.sub_css_max_file_size,
+                    "error": _("Invalid file type. Only jpg, png and gif allowed."),
+                    "files": ufiles,
+                    "subInfo": subInfo,
+                    "subMods": subMods,
+                }
+            )
     fsize = storage.get_stored_file_size(f_name)
 
     sub_upload = SubUploads.create(
@@ -3704,6 +3759,7 @@ def edit_top_bar():
         except SubSubscriber.DoesNotExist:
             pass  # TODO: Add these as status=4 SubSubscriber (after implementing some way to delete those)
 
+    misc.invalidate_session_snapshot(current_user.uid)
     return jsonify(status="ok")
 
 
@@ -3722,67 +3778,10 @@ def admin_undo_votes(uid):
     if not form.validate():
         return redirect(url_for("user.view", user=user.name))
 
-    post_v = SubPostVote.select().where(SubPostVote.uid == user.uid)
-    comm_v = SubPostCommentVote.select().where(SubPostCommentVote.uid == user.uid)
-    score_deltas = defaultdict(int)
-    delta_given = 0
-
-    for v in post_v:
-        try:
-            post = (
-                SubPost.select(SubPost.pid, SubPost.uid)
-                .where(SubPost.pid == v.pid_id)
-                .get()
-            )
-        except SubPost.DoesNotExist:
-            # Edge case. An orphan vote.
-            v.delete_instance()
-            continue
-        # Not removing self-votes
-        if post.uid_id == user.uid:
-            continue
-        adjustment = 1 if v.positive else -1
-        score_deltas[post.uid_id] -= adjustment
-        delta_given -= adjustment
-        kwargs = dict(score=SubPost.score - adjustment)
-        if v.positive:
-            kwargs.update(upvotes=SubPost.upvotes - 1)
-        else:
-            kwargs.update(downvotes=SubPost.downvotes - 1)
-        SubPost.update(**kwargs).where(SubPost.pid == v.pid_id).execute()
-        v.delete_instance()
-    for v in comm_v:
-        try:
-            comm = (
-                SubPostComment.select(
-                    SubPostComment.cid,
-                    SubPostComment.score,
-                    SubPostComment.uid,
-                    SubPostComment.upvotes,
-                    SubPostComment.views,
-                )
-                .where(SubPostComment.cid == v.cid)
-                .get()
-            )
-        except SubPostComment.DoesNotExist:
-            # Edge case. An orphan vote.
-            v.delete_instance()
-            continue
-        adjustment = 1 if v.positive else -1
-        kwargs = {}
-        score_deltas[comm.uid_id] -= adjustment
-        delta_given -= adjustment
-        if comm.score is not None:
-            kwargs.update(score=SubPostComment.score - adjustment)
-        if v.positive:
-            kwargs.update(upvotes=SubPostComment.upvotes - 1)
-        else:
-            kwargs.update(downvotes=SubPostComment.downvotes - 1)
-        SubPostComment.update(**kwargs).where(SubPostComment.cid == v.cid).execute()
-        v.delete_instance()
-    for recipient_uid, delta in score_deltas.items():
-        User.update(score=User.score + delta).where(User.uid == recipient_uid).execute()
-    User.update(given=User.given + delta_given).where(User.uid == uid).execute()
+    if tasks.undo_votes(user.uid, current_user.uid):
+        flash(_("Removing the votes of %(user)s...", user=user.name))
+    else:
+        flash(_("The votes of this user are already being removed."), "error")
     return redirect(url_for("user.view", user=user.name))
 
 
@@ -3903,9 +3902,6 @@ def mark_comments_viewed():
             SubPostComment.select(
                 SubPostComment.cid,
                 SubPostComment.pid,
-                SubPostComment.upvotes,
-                SubPostComment.downvotes,
-                SubPostComment.views,
                 SubPost.posted,
                 SubPost.sid,
             )
@@ -3931,19 +3927,10 @@ def mark_comments_viewed():
 
         comments = list(comments)
         if comments and not misc.is_archived(comments[0]):
-            for comment in comments:
-                best_score = misc.best_score(
-                    comment["upvotes"], comment["downvotes"], comment["views"] + 1
-                )
-                SubPostComment.update(
-                    views=SubPostComment.views + 1, best_score=best_score
-                ).where(SubPostComment.cid == comment["cid"]).execute()
-
-            view_records = [
-                {"uid": current_user.uid, "cid": comment["cid"], "pid": comment["pid"]}
-                for comment in comments
-            ]
-            SubPostCommentView.insert_many(view_records).execute()
+            comment_views.add(
+                current_user.uid,
+                [(comment["pid"], comment["cid"]) for comment in comments],
+            )
 
     return jsonify(status="ok")
 
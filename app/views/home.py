@@ -11,11 +11,13 @@ from flask import (
     redirect,
 )
 from flask_login import current_user
+from peewee import fn
 from .. import misc
 from ..config import config
 from ..misc import engine
 from ..misc import ratelimit, POSTING_LIMIT
-from ..models import SubPost, Sub
+from ..models import Sub
+from ..search import search_posts
 
 bp = Blueprint("home", __name__)
 
@@ -30,7 +32,12 @@ def index():
 @bp.route("/hot/<int:page>")
 def hot(page):
     """/hot for subscriptions"""
-    posts = misc.getPostList(misc.postListQueryHome(), "hot", page)
+    posts = misc.getPostList(
+        misc.postListQueryHome(),
+        "hot",
+        page,
+        after=request.args.get("after", type=int),
+    )
     return engine.get_template("index.html").render(
         {
             "posts": posts,
@@ -48,7 +55,12 @@ def hot(page):
 @bp.route("/new/<int:page>")
 def new(page):
     """/new for subscriptions"""
-    posts = misc.getPostList(misc.postListQueryHome(), "new", page)
+    posts = misc.getPostList(
+        misc.postListQueryHome(),
+        "new",
+        page,
+        after=request.args.get("after", type=int),
+    )
     return engine.get_template("index.html").render(
         {
             "posts": posts,
@@ -66,7 +78,12 @@ def new(page):
 @bp.route("/top/<int:page>")
 def top(page):
     """/top for subscriptions"""
-    posts = misc.getPostList(misc.postListQueryHome(), "top", page)
+    posts = misc.getPostList(
+        misc.postListQueryHome(),
+        "top",
+        page,
+        after=request.args.get("after", type=int),
+    )
     return engine.get_template("index.html").render(
         {
             "posts": posts,
@@ -101,7 +118,10 @@ def all_new_rss():
 def all_new(page):
     """The index page, all posts sorted as most recent posted first"""
     posts = misc.getPostList(
-        misc.postListQueryBase(isSubMod=current_user.can_admin), "new", page
+        misc.postListQueryBase(isSubMod=current_user.can_admin),
+        "new",
+        page,
+        after=request.args.get("after", type=int),
     )
     return engine.get_template("index.html").render(
         {
@@ -120,25 +140,11 @@ def all_new(page):
 @bp.route("/all/<sort>/more/<int:page>/<int:pid>")
 def all_more(sort, page, pid):
     """Infinite scroll pagination for /all"""
-    # XXX: Our pagination is very slow
-    if sort == "new":
-        posts = misc.getPostList(
-            misc.postListQueryBase(isSubMod=current_user.can_admin).where(
-                SubPost.pid < pid
-            ),
-            "new",
-            1,
-        )
-    elif sort == "top":
-        posts = misc.getPostList(
-            misc.postListQueryBase(isSubMod=current_user.can_admin), "top", page
-        )
-    elif sort == "hot":
-        posts = misc.getPostList(
-            misc.postListQueryBase(isSubMod=current_user.can_admin), "hot", page
-        )
-    else:
+    if sort not in ("new", "top", "hot"):
         return abort(404)
+    posts = misc.getPostList(
+        misc.postListQueryBase(isSubMod=current_user.can_admin), sort, page, after=pid
+    )
 
     return engine.get_template("shared/post.html").render(
         {"posts": posts, "sub": False}
@@ -149,17 +155,9 @@ def all_more(sort, page, pid):
 @bp.route("/home/<sort>/more/<int:page>/<int:pid>")
 def home_more(sort, page, pid):
     """Infinite scroll pagination for /all"""
-    # XXX: Our pagination is very slow
-    if sort == "new":
-        posts = misc.getPostList(
-            misc.postListQueryHome().where(SubPost.pid < pid), "new", 1
-        )
-    elif sort == "top":
-        posts = misc.getPostList(misc.postListQueryHome(), "top", page)
-    elif sort == "hot":
-        posts = misc.getPostList(misc.postListQueryHome(), "hot", page)
-    else:
+    if sort not in ("new", "top", "hot"):
         return abort(404)
+    posts = misc.getPostList(misc.postListQueryHome(), sort, page, after=pid)
 
     return engine.get_template("shared/post.html").render(
         {"posts": posts, "sub": False}
@@ -169,14 +167,14 @@ def home_more(sort, page, pid):
 @bp.route("/domain/<domain>", defaults={"page": 1})
 @bp.route("/domain/<domain>/<int:page>")
 def all_domain_new(domain, page):
-    """The index page, all posts sorted as most recent posted first"""
+    """The index page, all posts linking to a domain or its subdomains sorted
+    as most recent posted first"""
     domain = re.sub(r"[^A-Za-z0-9.\-_]+", "", domain)
     posts = misc.getPostList(
-        misc.postListQueryBase(noAllFilter=True).where(
-            SubPost.link % ("%://" + domain + "/%")
-        ),
+        misc.postListQueryBase(noAllFilter=True).where(misc.domain_filter(domain)),
         "new",
         page,
+        after=request.args.get("after", type=int),
     )
     return engine.get_template("index.html").render(
         {
@@ -191,38 +189,47 @@ def all_domain_new(domain, page):
     )
 
 
+def search_results(term, page):
+    """Returns a page of the posts matching `term`, best matches first,
+    restricted to the sub named in the `sub` query parameter if present."""
+    query = misc.postListQueryBase()
+    sub = request.args.get("sub")
+    if sub:
+        query = query.where(fn.Lower(Sub.name) == sub.lower())
+    posts = search_posts(query, term).paginate(page, 25)
+    return [misc.add_blur(p) for p in posts.dicts()]
+
+
 @bp.route("/search/<term>", defaults={"page": 1})
 @bp.route("/search/<term>/<int:page>")
 @ratelimit(POSTING_LIMIT)
 def search(page, term):
-    """The index page, with basic title search"""
+    """The index page, with full-text search of posts"""
     term = re.sub(r'[^A-Za-z0-9.,\-_\'" ]+', "", term)
-    posts = misc.getPostList(
-        misc.postListQueryBase().where(SubPost.title ** ("%" + term + "%")), "new", page
-    )
+    kw = {"term": term}
+    if request.args.get("sub"):
+        kw["sub"] = request.args.get("sub")
     return engine.get_template("index.html").render(
         {
-            "posts": posts,
+            "posts": search_results(term, page),
             "sort_type": "home.search",
             "page": page,
             "subOfTheDay": misc.getSubOfTheDay(),
             "changeLog": misc.getChangelog(),
             "ann": misc.getAnnouncement(),
-            "kw": {"term": term},
+            "kw": kw,
         }
     )
 
 
 @bp.route("/search/<term>/.rss")
-def search_and_build_feed(page, term):
+@ratelimit(POSTING_LIMIT)
+def search_and_build_feed(term):
     """Posts matching search keywords rendered as web feed"""
-    if not config.allow_search_feeds:
-        return
+    if not config.site.allow_search_feeds:
+        abort(404)
     term = re.sub(r'[^A-Za-z0-9.,\-_\'" ]+', "", term)
-    posts = misc.getPostList(
-        misc.postListQueryBase().where(SubPost.title ** ("%" + term + "%")), "new", page
-    )
-    posts = misc.getPostList(misc.postListQueryBase(), "new", 1)
+    posts = search_results(term, 1)
     fg = FeedGenerator()
     fg.id(request.url)
     fg.title(f"Search results matching {term}")
@@ -239,7 +246,10 @@ def search_and_build_feed(page, term):
 def all_top(page):
     """The index page, all posts sorted as most recent posted first"""
     posts = misc.getPostList(
-        misc.postListQueryBase(isSubMod=current_user.can_admin), "top", page
+        misc.postListQueryBase(isSubMod=current_user.can_admin),
+        "top",
+        page,
+        after=request.args.get("after", type=int),
     )
     return engine.get_template("index.html").render(
         {
@@ -260,7 +270,10 @@ def all_top(page):
 def all_hot(page):
     """The index page, all posts sorted as most recent posted first"""
     posts = misc.getPostList(
-        misc.postListQueryBase(isSubMod=current_user.can_admin), "hot", page
+        misc.postListQueryBase(isSubMod=current_user.can_admin),
+        "hot",
+        page,
+        after=request.args.get("after", type=int),
     )
 
     return engine.get_template("index.html").render(
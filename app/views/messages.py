@@ -61,6 +61,8 @@ def delete_notification(mid):
     except Notification.DoesNotExist:
         return abort(404)
     notification.delete_instance()
+    if notification.read is None:
+        misc.invalidate_unread_counts(current_user.uid)
     return jsonify(status="ok")
 
 
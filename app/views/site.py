@@ -1,6 +1,6 @@
 """ Miscellaneous site endpoints """
 from peewee import SQL
-from flask import Blueprint, redirect, url_for, abort, render_template
+from flask import Blueprint, redirect, url_for, abort, render_template, request
 from flask_login import login_required, current_user
 from .. import misc
 from ..models import SiteLog, SubPost, SubLog, Sub, SubPostComment
@@ -91,7 +91,10 @@ def view_multisub_new(sublist, page=1):
     sids = [x.sid for x in subs]
 
     posts = misc.getPostList(
-        misc.postListQueryBase().where(Sub.sid << sids), "new", page
+        misc.postListQueryBase().where(Sub.sid << sids),
+        "new",
+        page,
+        after=request.args.get("after", type=int),
     )
     return render_template(
         "indexmulti.html",
@@ -345,6 +345,7 @@ def view_sub_new(sub, page):
         ),
         "new",
         page,
+        after=request.args.get("after", type=int),
     )
 
     return engine.get_template("sub.html").render(
@@ -454,6 +455,7 @@ def view_sub_top(sub, page):
         ),
         "top",
         page,
+        after=request.args.get("after", type=int),
     )
 
     return engine.get_template("sub.html").render(
@@ -494,6 +496,7 @@ def view_sub_hot(sub, page):
         ),
         "hot",
         page,
+        after=request.args.get("after", type=int),
     )
 
     return engine.get_template("sub.html").render(
@@ -567,9 +570,9 @@ def view_post(sub, pid, slug=None, comments=False, highlight=None):
         is_saved = False
 
     if not comments:
-        comments = misc.get_comment_query(post["pid"], sort=sort)
+        comments = misc.get_comment_list(post["pid"], sort=sort)
 
-        if not comments.count():
+        if not comments:
             comments = []
         else:
             comments = misc.get_comment_tree(
@@ -754,7 +757,7 @@ def view_perm(sub, pid, slug, cid):
 
     include_history = current_user.is_mod(post["sid"], 1) or current_user.is_admin()
     sort = "best" if post["posted"] > misc.get_best_comment_sort_init_date() else "top"
-    comments = misc.get_comment_query(pid, sort=sort)
+    comments = misc.get_comment_list(pid, sort=sort)
     comment_tree = misc.get_comment_tree(
         pid,
         post["sid"],
@@ -21,6 +21,8 @@ from ..models import (
 )
 from ..models import SubPostPollOption, SubPostMetadata, SubPostVote, User, UserUploads
 from ..forms import CreateSubPostForm, CreateSubForm
+from ..search import index_post, sub_names
+from ..site_stats import site_stats
 from ..storage import file_url, upload_file
 from ..tasks import create_thumbnail, create_thumbnail_external
 
@@ -264,7 +266,9 @@ def create_post(ptype, sub):
         uid=current_user.uid,
         title=form.title.data,
         content=form.content.data if ptype != 1 else "",
+        **misc.rendered_fields(form.content.data if ptype != 1 else ""),
         link=form.link.data if ptype == 1 else None,
+        domain=misc.link_domain(form.link.data) if ptype == 1 else None,
         posted=datetime.utcnow(),
         score=self_vote,
         upvotes=self_vote,
@@ -276,6 +280,8 @@ def create_post(ptype, sub):
         thumbnail=img,
         flair=flair,
     )
+    misc.update_post_hot_rank(post.pid)
+    index_post(post.pid)
     thumbnail_store = [(SubPost, "pid", post.pid)]
 
     if form.ptype.data == "poll":
@@ -296,6 +302,7 @@ def create_post(ptype, sub):
             )
 
     Sub.update(posts=Sub.posts + 1).where(Sub.sid == sub.sid).execute()
+    site_stats.add(posts=1)
     addr = url_for("sub.view_post", sub=sub.name, pid=post.pid)
     posts = misc.getPostList(
         misc.postListQueryBase(nofilter=True).where(SubPost.pid == post.pid), "new", 1
@@ -337,6 +344,7 @@ def create_post(ptype, sub):
     if config.site.self_voting.posts:
         SubPostVote.create(uid=current_user.uid, pid=post.pid, positive=True)
         User.update(given=User.given + 1).where(User.uid == current_user.uid).execute()
+        site_stats.add(upvotes=1)
         # We send a yourvote message so that the upvote arrow *does* appear highlighted to the creator.
         socketio.emit(
             "yourvote",
@@ -455,6 +463,7 @@ def create_sub():
             )
 
     sub = Sub.create(sid=uuid.uuid4(), name=form.subname.data, title=form.title.data)
+    site_stats.add(subs=1)
 
     smd = [dict(sid=sub.sid, key="mod", value=current_user.uid)]
     for key in ["allow_text_posts", "allow_link_posts", "allow_upload_posts"]:
@@ -470,5 +479,7 @@ def create_sub():
     )
 
     SubSubscriber.create(uid=current_user.uid, sid=sub.sid, status=1)
+    misc.invalidate_session_snapshot(current_user.uid)
+    sub_names.invalidate()
 
     return redirect(url_for("sub.view_sub", sub=form.subname.data))
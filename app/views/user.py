@@ -194,6 +194,7 @@ def view_user_posts(user, page):
         ).where(User.uid == user.uid),
         "new",
         page,
+        after=request.args.get("after", type=int),
     )
 
     return render_template(
@@ -217,6 +218,7 @@ def view_user_savedposts(user, page):
             .where(UserSaved.uid == current_user.uid),
             "new",
             page,
+            after=request.args.get("after", type=int),
         )
         return render_template(
             "userposts.html",
@@ -247,7 +249,10 @@ def view_user_comments(user, page):
             include_deleted_comments = modded_subs
 
     comments = misc.getUserComments(
-        user.uid, page, include_deleted_comments=include_deleted_comments
+        user.uid,
+        page,
+        include_deleted_comments=include_deleted_comments,
+        after=request.args.get("after"),
     )
     postmeta = misc.get_postmeta_dicts((c["pid"] for c in comments))
     return render_template(
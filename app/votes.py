@@ -0,0 +1,128 @@
+""" Batches the counter updates caused by votes """
+import logging
+import gevent
+from gevent import monkey
+from .models import rconn, SubPost, SubPostComment, User
+
+# Redis set holding the keys of the hashes with pending deltas.
+DIRTY_KEY = "vote-deltas"
+
+# Model, primary key and counter fields for every kind of target.
+TARGETS = {
+    "post": (SubPost, SubPost.pid, ("score", "upvotes", "downvotes")),
+    "comment": (SubPostComment, SubPostComment.cid, ("score", "upvotes", "downvotes")),
+    "user": (User, User.uid, ("score", "given")),
+}
+
+
+class VoteCounters(object):
+    """When enabled, votes are still recorded synchronously but the changes
+    to the score counters of posts, comments and users are accumulated in
+    Redis hashes and applied to the database by a background greenlet,
+    coalescing all the changes to a row into one UPDATE per interval."""
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.interval = 5
+        self.logger = logging.getLogger(__name__)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        conf = app.config["THROAT_CONFIG"].app.vote_batching
+        self.enabled = conf.enabled
+        self.interval = conf.interval
+        self.logger = logging.getLogger(app.logger.name + ".votes")
+        if self.enabled and monkey.is_module_patched("os"):
+            gevent.spawn(self.flush_forever, app)
+
+    @staticmethod
+    def key(kind, target):
+        return "{0}:{1}:{2}".format(DIRTY_KEY, kind, target)
+
+    def add(self, kind, target, **deltas):
+        """Accumulate `deltas` (field name => increment) for a target."""
+        key = self.key(kind, target)
+        pipe = rconn.pipeline()
+        for field, delta in deltas.items():
+            if delta:
+                pipe.hincrby(key, field, delta)
+        pipe.sadd(DIRTY_KEY, key)
+        pipe.execute()
+
+    def pending(self, kind, target):
+        """Return the deltas not yet applied to the database for a target."""
+        values = rconn.hgetall(self.key(kind, target))
+        return {field.decode(): int(delta) for field, delta in values.items()}
+
+    def flush(self):
+        """Apply all the pending deltas to the database. Returns the number
+        of rows updated."""
+        count = 0
+        while True:
+            key = rconn.spop(DIRTY_KEY)
+            if key is None:
+                return count
+            pipe = rconn.pipeline()
+            pipe.hgetall(key)
+            pipe.delete(key)
+            values, _deleted = pipe.execute()
+            _prefix, kind, target = key.decode().split(":", 2)
+            deltas = {field.decode(): int(delta) for field, delta in values.items()}
+            try:
+                if self.apply(kind, target, deltas):
+                    count += 1
+            except Exception:
+                # Put the deltas back so they are not lost.
+                self.add(kind, target, **deltas)
+                raise
+
+    @staticmethod
+    def apply(kind, target, deltas):
+        model, pk, fields = TARGETS[kind]
+        update = {
+            field: getattr(model, field) + deltas[field]
+            for field in fields
+            if deltas.get(field)
+        }
+        if not update:
+            return False
+        if kind == "post" and deltas.get("score"):
+            from .misc import post_hot_rank
+
+            update["hot"] = post_hot_rank(SubPost.score + deltas["score"])
+        model.update(**update).where(pk == target).execute()
+
+        if kind == "comment":
+            from .misc import best_score, invalidate_comment_cache
+
+            try:
+                comment = (
+                    SubPostComment.select(
+                        SubPostComment.pid,
+                        SubPostComment.upvotes,
+                        SubPostComment.downvotes,
+                        SubPostComment.views,
+                    )
+                    .where(SubPostComment.cid == target)
+                    .get()
+                )
+            except SubPostComment.DoesNotExist:
+                return True
+            SubPostComment.update(
+                best_score=best_score(comment.upvotes, comment.downvotes, comment.views)
+            ).where(SubPostComment.cid == target).execute()
+            invalidate_comment_cache(comment.pid_id, [target])
+        return True
+
+    def flush_forever(self, app):
+        while True:
+            gevent.sleep(self.interval)
+            try:
+                with app.app_context():
+                    self.flush()
+            except Exception:  # noqa
+                self.logger.exception("Failed to flush vote counters")
+
+
+vote_counters = VoteCounters()
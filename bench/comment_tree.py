@@ -0,0 +1,68 @@
+""" Benchmark for the comment tree builder used by get_comment_tree.
+
+Builds synthetic threads and times building and paginating the bare
+comment tree (the part of get_comment_tree which does not touch the
+database). Run from the repository root:
+
+    python -m bench.comment_tree [size ...]
+"""
+import random
+import sys
+import time
+
+from app.misc import get_comment_skeleton
+
+DEFAULT_SIZES = (10000, 50000)
+ROUNDS = 5
+
+
+def synthetic_thread(size, seed=0):
+    """Returns `size` comments shaped like a busy thread: a fifth of them are
+    top-level, the rest are replies which mostly go to recent comments, and
+    one long reply chain is mixed in."""
+    rng = random.Random(seed)
+    comments = []
+    for i in range(size):
+        if i == 0 or rng.random() < 0.2:
+            parentcid = None
+        elif i % 97 == 0:
+            # Keep a single long chain of replies going.
+            parentcid = comments[i - 97]["cid"] if i > 97 else comments[0]["cid"]
+        else:
+            parentcid = comments[rng.randrange(max(0, i - 50), i)]["cid"]
+        comments.append({"cid": f"cid-{i}", "parentcid": parentcid})
+    rng.shuffle(comments)
+    return comments
+
+
+def timed(comments, **kwargs):
+    best = None
+    for _ in range(ROUNDS):
+        # get_comment_skeleton stores children in the dicts, so give it fresh ones.
+        fresh = [dict(c) for c in comments]
+        start = time.perf_counter()
+        get_comment_skeleton(fresh, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def main(sizes):
+    print(f"{'comments':>10} {'case':<12} {'best of ' + str(ROUNDS):>12}")
+    for size in sizes:
+        comments = synthetic_thread(size)
+        replies = [c for c in comments if c["parentcid"] is not None]
+        cases = {
+            "full": {},
+            "branch": {"root": replies[len(replies) // 2]["cid"]},
+            "only_after": {
+                "root": replies[0]["parentcid"],
+                "only_after": replies[0]["cid"],
+            },
+        }
+        for name, kwargs in cases.items():
+            print(f"{size:>10} {name:<12} {timed(comments, **kwargs):>9.1f} ms")
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
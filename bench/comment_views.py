@@ -0,0 +1,139 @@
+""" Benchmark for the recording of comment views.
+
+Simulates users scrolling through a large thread, marking the comments
+they see as viewed in batches like the browser does, and compares the
+database writes needed to record the views one comment at a time (as
+mark_comments_viewed used to) with the writes needed to record them with
+batched view recording, which updates all the comments of a flush with a
+single statement. Uses an in-memory SQLite database. Run from the
+repository root:
+
+    python -m bench.comment_views [comments users]
+"""
+import random
+import sys
+import time
+import uuid
+
+from flask import Flask
+from peewee import SqliteDatabase
+
+from app.comment_views import record_comment_views
+from app.misc import best_score
+from app.models import dbp, Sub, SubPost, SubPostComment, SubPostCommentView, User
+
+DEFAULT_COMMENTS = 1000
+DEFAULT_USERS = 20
+# Comments marked as viewed by each request, and views recorded per flush.
+SCROLL_BATCH = 50
+FLUSH_BATCH = 1000
+MODELS = [User, Sub, SubPost, SubPostComment, SubPostCommentView]
+
+
+class CountingDatabase(SqliteDatabase):
+    """Counts the statements which write to the database."""
+
+    writes = 0
+
+    def execute_sql(self, sql, params=None, commit=None):
+        if sql.lstrip().upper().startswith(("INSERT", "UPDATE", "DELETE")):
+            self.writes += 1
+        return super().execute_sql(sql, params)
+
+
+def setup(comments, users):
+    """Returns a fresh database with a thread of `comments` comments and the
+    uids of `users` users, and the pid and cids of the thread."""
+    database = CountingDatabase(":memory:")
+    dbp.initialize(database)
+    database.create_tables(MODELS)
+    uids = [str(uuid.uuid4()) for _ in range(users + 1)]
+    User.insert_many(
+        [{"uid": uid, "crypto": 1, "name": f"user{i}"} for i, uid in enumerate(uids)]
+    ).execute()
+    Sub.insert(sid="bench", name="bench").execute()
+    pid = SubPost.insert(sid="bench", uid=uids[0], title="thread", comments=0).execute()
+    rng = random.Random(0)
+    cids = [str(uuid.uuid4()) for _ in range(comments)]
+    SubPostComment.insert_many(
+        [
+            {
+                "cid": cid,
+                "pid": pid,
+                "uid": uids[0],
+                "upvotes": rng.randrange(10),
+                "downvotes": rng.randrange(3),
+            }
+            for cid in cids
+        ]
+    ).execute()
+    return database, uids[1:], pid, cids
+
+
+def scrolls(uids, pid, cids):
+    """Yields (uid, [(pid, cid), ...]) for every request sent by the users."""
+    for uid in uids:
+        for start in range(0, len(cids), SCROLL_BATCH):
+            yield uid, [(pid, cid) for cid in cids[start : start + SCROLL_BATCH]]
+
+
+def one_at_a_time(uid, views):
+    """What mark_comments_viewed used to do for every request."""
+    for pid, cid in views:
+        comment = SubPostComment.get_by_id(cid)
+        SubPostComment.update(
+            views=SubPostComment.views + 1,
+            best_score=best_score(
+                comment.upvotes, comment.downvotes, comment.views + 1
+            ),
+        ).where(SubPostComment.cid == cid).execute()
+    SubPostCommentView.insert_many(
+        [{"uid": uid, "cid": cid, "pid": pid} for pid, cid in views]
+    ).execute()
+
+
+def run(name, comments, users, record):
+    database, uids, pid, cids = setup(comments, users)
+    start = time.perf_counter()
+    record(scrolls(uids, pid, cids))
+    elapsed = time.perf_counter() - start
+    views = SubPostComment.select().where(SubPostComment.views == users).count()
+    assert views == comments, "every comment must have been seen by every user"
+    print(f"{name:<16} {database.writes:>10} {elapsed * 1000:>10.1f} ms")
+    database.close()
+
+
+def unbatched(requests):
+    for uid, views in requests:
+        one_at_a_time(uid, views)
+
+
+def per_request(requests):
+    for uid, views in requests:
+        record_comment_views((uid, pid, cid) for pid, cid in views)
+
+
+def batched(requests):
+    pending = []
+    for uid, views in requests:
+        pending.extend((uid, pid, cid) for pid, cid in views)
+        if len(pending) >= FLUSH_BATCH:
+            record_comment_views(pending)
+            pending = []
+    record_comment_views(pending)
+
+
+def main(comments, users):
+    print(f"{comments} comments seen by {users} users, {SCROLL_BATCH} per request")
+    print(f"{'case':<16} {'writes':>10} {'time':>13}")
+    with Flask(__name__).app_context():
+        run("one at a time", comments, users, unbatched)
+        run("per request", comments, users, per_request)
+        run("batched", comments, users, batched)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        main(int(sys.argv[1]), int(sys.argv[2]))
+    else:
+        main(DEFAULT_COMMENTS, DEFAULT_USERS)
@@ -0,0 +1,133 @@
+""" Load test for the delivery of socketio events across workers.
+
+Starts several socketio servers in this process, each with its own client
+manager connected to Redis like a worker would be, and opens thousands of
+simulated clients spread over them, each one watching a user room and a
+few post rooms. Then sends score updates to random post rooms from random
+workers, and compares how many messages the workers had to read from
+Redis and how long it took to deliver every event to its clients with
+the single channel client manager and with the sharded one, for a few
+shard counts. Sharding only saves reads while a worker's clients are in
+fewer rooms than there are shards. Needs a Redis server at the url given
+(by default the one of the example config). Run from the repository root:
+
+    python -m bench.socketio_fanout [workers clients events [redis_url]]
+"""
+import random
+import sys
+import time
+import uuid
+
+import socketio
+
+from app.socketio import ShardedRedisManager
+
+DEFAULT_WORKERS = 4
+DEFAULT_CLIENTS = 4000
+DEFAULT_EVENTS = 2000
+DEFAULT_REDIS_URL = "redis://127.0.0.1:6379"
+# Post rooms the clients are spread over, and rooms watched by each client.
+POSTS = 2000
+POSTS_PER_CLIENT = 3
+SHARDS = (64, 1024, 8192)
+
+
+class Worker(object):
+    """A socketio server whose packets to the clients are counted instead
+    of being sent, and which counts the messages it reads from Redis."""
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.read = 0
+        self.delivered = 0
+        self.server = socketio.Server(client_manager=manager, async_mode="threading")
+        self.server._send_eio_packet = self.send
+        listen = manager._listen
+
+        def counting_listen():
+            for message in listen():
+                self.read += 1
+                yield message
+
+        manager._listen = counting_listen
+        manager.initialize()
+
+    def send(self, eio_sid, packet):
+        self.delivered += 1
+
+    def join(self, eio_sid, rooms):
+        sid = self.manager.connect(eio_sid, "/snt")
+        for room in rooms:
+            self.manager.enter_room(sid, "/snt", room)
+
+
+def run(name, make_manager, workers, clients, events):
+    rng = random.Random(0)
+    pool = [Worker(make_manager()) for _ in range(workers)]
+    expected = 0
+    watchers = {}
+    for n in range(clients):
+        rooms = ["user{0}".format(n)] + [
+            "post{0}".format(rng.randrange(POSTS)) for _ in range(POSTS_PER_CLIENT)
+        ]
+        pool[n % workers].join("client{0}".format(n), rooms)
+        for room in set(rooms):
+            watchers[room] = watchers.get(room, 0) + 1
+    # Let the subscriptions reach Redis before sending anything.
+    time.sleep(1)
+
+    targets = ["post{0}".format(rng.randrange(POSTS)) for _ in range(events)]
+    expected = sum(watchers.get(room, 0) for room in targets)
+    start = time.perf_counter()
+    for n, room in enumerate(targets):
+        pool[n % workers].manager.emit(
+            "threadscore", {"pid": room, "score": n}, namespace="/snt", room=room
+        )
+    deadline = time.monotonic() + 60
+    while sum(w.delivered for w in pool) < expected and time.monotonic() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    delivered = sum(w.delivered for w in pool)
+    read = sum(w.read for w in pool)
+    print(
+        f"{name:<12} {read:>10} {delivered:>10} / {expected:<10}"
+        f" {elapsed * 1000:>10.1f} ms"
+    )
+
+
+def main(workers, clients, events, redis_url):
+    print(
+        f"{workers} workers, {clients} clients watching {POSTS_PER_CLIENT} of"
+        f" {POSTS} posts, {events} events"
+    )
+    print(f"{'case':<12} {'read':>10} {'delivered':>23} {'time':>13}")
+    channel = "bench-" + uuid.uuid4().hex
+    run(
+        "single",
+        lambda: socketio.RedisManager(redis_url, channel=channel + "-single"),
+        workers,
+        clients,
+        events,
+    )
+    for shards in SHARDS:
+        run(
+            "sharded/{0}".format(shards),
+            lambda: ShardedRedisManager(
+                redis_url, channel="{0}-{1}".format(channel, shards), shards=shards
+            ),
+            workers,
+            clients,
+            events,
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 4:
+        main(
+            int(sys.argv[1]),
+            int(sys.argv[2]),
+            int(sys.argv[3]),
+            sys.argv[4] if len(sys.argv) > 4 else DEFAULT_REDIS_URL,
+        )
+    else:
+        main(DEFAULT_WORKERS, DEFAULT_CLIENTS, DEFAULT_EVENTS, DEFAULT_REDIS_URL)
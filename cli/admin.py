@@ -1,6 +1,7 @@
 import click
 from flask.cli import AppGroup
 from peewee import fn
+from app.misc import invalidate_session_snapshot
 from app.models import User, UserMetadata, UserMessageBlock, UserContentBlock
 
 admin = AppGroup("admin", help="Manages admin users")
@@ -21,6 +22,7 @@ def add(username):
     UserContentBlock.delete().where(
         ((UserContentBlock.uid == user.uid) | (UserContentBlock.target == user.uid))
     ).execute()
+    invalidate_session_snapshot(user.uid)
     print("Done.")
 
 
@@ -37,6 +39,7 @@ def remove(username):
             (UserMetadata.uid == user.uid) & (UserMetadata.key == "admin")
         )
         umeta.delete_instance()
+        invalidate_session_snapshot(user.uid)
         print("Done.")
     except UserMetadata.DoesNotExist:
         print("Error: User is not an administrator.")
@@ -1,34 +1,391 @@
+import operator
+import time
+from functools import reduce
 import click
 from flask.cli import AppGroup
-from app.models import Sub, SubSubscriber
+from peewee import JOIN, fn, Case, SQL, Value
+from app.misc import MARKDOWN_RENDERER_VERSION, render_markdown
+from app.misc import best_score_sql, post_hot_rank, repair_unread_counts
+from app.models import db, Sub, SubSubscriber, User
+from app.models import SubPost, SubPostComment, SubPostCommentHistory
+from app.models import SubPostVote, SubPostCommentVote, SubPostCommentView
+from app.search import rebuild_search_index
+from app.site_stats import site_stats
+from app.votes import vote_counters
 
 recount = AppGroup("recount", help="Re-count various internal counters")
 
 
+def key_ranges(key, batch_size):
+    """Yields (last, end) for consecutive chunks of up to `batch_size` rows
+    of the table of `key`, in `key` order. The chunk holds the rows with
+    `last < key <= end`; `last` is None for the first chunk and `end` is
+    None for the last one."""
+    last = None
+    while True:
+        chunk = key.model.select(key).order_by(key)
+        if last is not None:
+            chunk = chunk.where(key > last)
+        end = chunk.offset(batch_size - 1).limit(1).scalar()
+        yield last, end
+        if end is None:
+            return
+        last = end
+
+
+def in_range(column, last, end):
+    """Condition selecting the rows of a chunk given by `key_ranges`."""
+    conditions = []
+    if last is not None:
+        conditions.append(column > last)
+    if end is not None:
+        conditions.append(column <= end)
+    return reduce(operator.and_, conditions) if conditions else SQL("1 = 1")
+
+
+def fix_counters(name, key, fields, counts, save, batch_size, extra=None):
+    """Compare counter columns with the values counted from the rows they
+    summarize, and optionally fix them, one chunk of rows at a time.
+
+    `counts(last, end)` must return a query grouped by a `target` column,
+    which matches `key`, with a column for each field in `fields`. The
+    counters of the targets missing from it must be zero. The wrong
+    counters of each chunk are fixed with one UPDATE ... FROM, which also
+    sets the fields returned by `extra(fixes)`, if given."""
+    start = time.perf_counter()
+    model = key.model
+    current = model.alias("current")
+    target = getattr(current, key.name)
+    print(f"{name:40}{'Before':>12}{'After':>15}")
+    wrong = 0
+    for last, end in key_ranges(key, batch_size):
+        counted = counts(last, end).alias("counts")
+        before = [getattr(current, field) for field in fields]
+        after = [fn.COALESCE(getattr(counted.c, field), 0) for field in fields]
+        fixes = (
+            current.select(
+                target.alias("target"),
+                *[value.alias("old_" + field) for value, field in zip(before, fields)],
+                *[value.alias(field) for value, field in zip(after, fields)],
+            )
+            .join(counted, JOIN.LEFT_OUTER, on=(counted.c.target == target))
+            .where(
+                in_range(target, last, end)
+                & reduce(
+                    operator.or_,
+                    [(b != a) | b.is_null() for b, a in zip(before, after)],
+                )
+            )
+        )
+        with db.atomic():
+            rows = list(fixes.tuples())
+            for row in rows:
+                old = "/".join(str(value) for value in row[1 : len(fields) + 1])
+                new = "/".join(str(value) for value in row[len(fields) + 1 :])
+                print(f"{str(row[0]):40}{old:>12}{new:>15}")
+            if save and rows:
+                fixes = fixes.alias("fixes")
+                values = {field: getattr(fixes.c, field) for field in fields}
+                if extra is not None:
+                    values.update(extra(fixes))
+                model.update(**values).from_(fixes).where(
+                    key == fixes.c.target
+                ).execute()
+        wrong += len(rows)
+    elapsed = time.perf_counter() - start
+    action = "Fixed" if save else "Found"
+    print(f"{action} {wrong} wrong {name} counters in {elapsed:.2f}s")
+
+
+def subscriber_counts(last, end):
+    return (
+        SubSubscriber.select(
+            SubSubscriber.sid.alias("target"),
+            fn.COUNT(SubSubscriber.xid).alias("subscribers"),
+        )
+        .where((SubSubscriber.status == 1) & in_range(SubSubscriber.sid, last, end))
+        .group_by(SubSubscriber.sid)
+    )
+
+
+def post_counts(last, end):
+    return (
+        SubPost.select(
+            SubPost.sid.alias("target"), fn.COUNT(SubPost.pid).alias("posts")
+        )
+        .where((SubPost.deleted == 0) & in_range(SubPost.sid, last, end))
+        .group_by(SubPost.sid)
+    )
+
+
+def comment_counts(last, end):
+    return (
+        SubPostComment.select(
+            SubPostComment.pid.alias("target"),
+            fn.COUNT(SubPostComment.cid).alias("comments"),
+        )
+        .where(in_range(SubPostComment.pid, last, end))
+        .group_by(SubPostComment.pid)
+    )
+
+
+def vote_counts(vote_model, vote_key):
+    """Returns a `counts` function for the vote counters of posts or
+    comments, for `fix_counters`."""
+
+    def counts(last, end):
+        up = fn.COUNT(Case(None, [(vote_model.positive == 1, 1)]))
+        down = fn.COUNT(Case(None, [(vote_model.positive == 0, 1)]))
+        return (
+            vote_model.select(
+                vote_key.alias("target"),
+                (up - down).alias("score"),
+                up.alias("upvotes"),
+                down.alias("downvotes"),
+            )
+            .where(in_range(vote_key, last, end))
+            .group_by(vote_key)
+        )
+
+    return counts
+
+
+def user_counts(last, end):
+    """Votes received by users on their posts and comments, except their
+    own, and votes given by them, for `fix_counters`."""
+    parts = []
+    for vote_model, model, key in [
+        (SubPostVote, SubPost.alias("voted_post"), "pid"),
+        (SubPostCommentVote, SubPostComment.alias("voted_comment"), "cid"),
+    ]:
+        vote = Case(None, [(vote_model.positive == 1, 1)], -1)
+        parts.append(
+            vote_model.select(
+                model.uid.alias("target"), vote.alias("score"), Value(0).alias("given")
+            )
+            .join(model, on=(getattr(vote_model, key) == getattr(model, key)))
+            .where(
+                (vote_model.uid.is_null() | (vote_model.uid != model.uid))
+                & in_range(model.uid, last, end)
+            )
+        )
+        parts.append(
+            vote_model.select(
+                vote_model.uid.alias("target"), Value(0), vote.alias("given")
+            ).where(in_range(vote_model.uid, last, end))
+        )
+    votes = reduce(operator.add, parts).alias("votes")
+    return votes.select_from(
+        SQL("target"),
+        fn.SUM(SQL("score")).alias("score"),
+        fn.SUM(SQL("given")).alias("given"),
+    ).group_by(SQL("target"))
+
+
+# Counters checked by `recount counters`, by name: key of the table, the
+# counter fields, the function computing their values and the function
+# returning other fields to update along with them.
+COUNTERS = {
+    "subscribers": (Sub.sid, ("subscribers",), subscriber_counts, None),
+    "posts": (Sub.sid, ("posts",), post_counts, None),
+    "comments": (SubPost.pid, ("comments",), comment_counts, None),
+    "post-votes": (
+        SubPost.pid,
+        ("score", "upvotes", "downvotes"),
+        vote_counts(SubPostVote, SubPostVote.pid),
+        lambda fixes: {"hot": post_hot_rank(fixes.c.score)},
+    ),
+    "comment-votes": (
+        SubPostComment.cid,
+        ("score", "upvotes", "downvotes"),
+        vote_counts(SubPostCommentVote, SubPostCommentVote.cid),
+        lambda fixes: {
+            "best_score": best_score_sql(
+                fixes.c.upvotes, fixes.c.downvotes, SubPostComment.views
+            )
+        },
+    ),
+    "users": (User.uid, ("score", "given"), user_counts, None),
+}
+
+save_option = click.option(
+    "--save/--dry-run",
+    default=True,
+    help="Use --save (the default) to fix the counts, or --dry-run to just print them.",
+)
+batch_size_option = click.option(
+    "--batch-size", default=10000, help="Number of rows checked at once."
+)
+
+
+def recount_counters(names, save, batch_size):
+    if {"post-votes", "comment-votes", "users"} & set(names):
+        flushed = vote_counters.flush()
+        print(f"Flushed pending vote deltas of {flushed} rows")
+    for name in names:
+        key, fields, counts, extra = COUNTERS[name]
+        fix_counters(name, key, fields, counts, save, batch_size, extra)
+
+
+@recount.command(help="Verifies the denormalized counters of subs, posts and users")
+@click.argument("names", nargs=-1, type=click.Choice(list(COUNTERS)))
+@save_option
+@batch_size_option
+def counters(names, save, batch_size):
+    """Compare the counters kept in subs, posts, comments and users with
+    the rows they count, and fix them. Checks all the counters unless some
+    are named."""
+    recount_counters(names or list(COUNTERS), save, batch_size)
+
+
 @recount.command(help="Rebuilds all sub's subscriber counters")
+@save_option
+@batch_size_option
+def subscribers(save, batch_size):
+    """Update subscriber counts for all the subs."""
+    recount_counters(["subscribers"], save, batch_size)
+
+
+@recount.command(
+    name="rendered-html",
+    help="Renders and stores the HTML of posts, comments and comment history",
+)
+@click.option(
+    "--all",
+    "everything",
+    is_flag=True,
+    help="Re-render every row, not only the ones rendered by an older renderer version.",
+)
+@click.option("--batch-size", default=1000, help="Number of rows updated at once.")
+@click.option(
+    "--save/--dry-run",
+    default=True,
+    help="Use --save (the default) to store the HTML, or --dry-run to just count the rows.",
+)
+def rendered_html(everything, batch_size, save):
+    """Fill in `content_html` for the rows that lack it or were rendered by
+    an older version of the markdown renderer."""
+    print(f"Renderer version {MARKDOWN_RENDERER_VERSION}")
+    print("Table                              Rows")
+    for model, key in [
+        (SubPost, SubPost.pid),
+        (SubPostComment, SubPostComment.cid),
+        (SubPostCommentHistory, SubPostCommentHistory.id),
+    ]:
+        query = model.select(key, model.content).order_by(key).limit(batch_size)
+        if not everything:
+            query = query.where(
+                model.html_version.is_null()
+                | (model.html_version != MARKDOWN_RENDERER_VERSION)
+            )
+        count = 0
+        last = None
+        while True:
+            batch = query if last is None else query.where(key > last)
+            rows = list(batch.tuples())
+            if not rows:
+                break
+            if save:
+                with db.atomic():
+                    for pk, content in rows:
+                        model.update(
+                            content_html=(
+                                None if content is None else render_markdown(content)
+                            ),
+                            html_version=MARKDOWN_RENDERER_VERSION,
+                        ).where(key == pk).execute()
+            count += len(rows)
+            last = rows[-1][0]
+        print(f"{model._meta.table_name:32}{count:8}")
+
+
+@recount.command(help="Verifies the vote counters of posts and comments")
+@save_option
+@batch_size_option
+def votes(save, batch_size):
+    """Flush the pending vote counter deltas and compare the score, upvote
+    and downvote counters of posts and comments with their votes."""
+    recount_counters(["post-votes", "comment-votes"], save, batch_size)
+
+
+@recount.command(help="Recomputes the hot rank of all the posts")
+def hot():
+    """Update the stored hot rank of every post. Needed after changing
+    `site.custom_hot_sort` or the SQL `hot` function."""
+    count = SubPost.update(hot=post_hot_rank()).execute()
+    print(f"Updated {count} posts")
+
+
+@recount.command(
+    name="best-scores", help="Recomputes the best score of all the comments"
+)
+@click.option(
+    "--views",
+    is_flag=True,
+    help="Count the views of every comment again before computing its score.",
+)
+@click.option("--batch-size", default=10000, help="Number of rows updated at once.")
+def best_scores(views, batch_size):
+    """Update the stored best score of every comment, in chunks of
+    consecutive cids so no single transaction holds many locks. Needed
+    after changing `best_score` or fixing the view counts."""
+    view_count = SubPostCommentView.select(fn.COUNT(SubPostCommentView.id)).where(
+        SubPostCommentView.cid == SubPostComment.cid
+    )
+    score = best_score_sql(
+        SubPostComment.upvotes, SubPostComment.downvotes, SubPostComment.views
+    )
+    count = 0
+    for last, end in key_ranges(SubPostComment.cid, batch_size):
+        in_chunk = in_range(SubPostComment.cid, last, end)
+        with db.atomic():
+            if views:
+                SubPostComment.update(views=view_count).where(in_chunk).execute()
+            count += SubPostComment.update(best_score=score).where(in_chunk).execute()
+    print(f"Updated {count} comments")
+
+
+@recount.command(help="Verifies the cached unread message and notification counts")
 @click.option(
     "--save/--dry-run",
     default=True,
     help="Use --save (the default) to fix the counts, or --dry-run to just print them.",
 )
-def subscribers(save):
-    """Update subscriber counts for all the subs."""
-    if save:
-        print("Name                             Before   After")
-    else:
-        print("Name                            Current Correct")
-
-    subs = Sub.select(Sub.sid, Sub.name, Sub.subscribers).order_by(Sub.name)
-    for sub in subs:
-        count = (
-            SubSubscriber.select()
-            .where((SubSubscriber.sid == sub.sid) & (SubSubscriber.status == 1))
-            .count()
-        )
-        print(f"{sub.name:32}{sub.subscribers:7}{count:8}")
-        if save:
-            Sub.update(
-                subscribers=SubSubscriber.select()
-                .where((SubSubscriber.sid == sub.sid) & (SubSubscriber.status == 1))
-                .count()
-            ).where(Sub.sid == sub.sid).execute()
+def unread(save):
+    """Compare the unread counts kept in redis with the database. Meant to be
+    run periodically, to correct the counts that drifted because of changes
+    which don't update them, like blocks removed by `flask admin add`."""
+    print("User                                    Before          After")
+    for uid, cached, actual in repair_unread_counts(save):
+        before = "{0}/{1}".format(*cached)
+        after = "{0}/{1}".format(*actual) if actual else "-"
+        print(f"{uid:40}{before:>6}{after:>15}")
+
+
+@recount.command(help="Rebuilds the full-text search index of posts and comments")
+def search():
+    """Index all the posts and comments again. Needed after changing
+    `app.search.language`."""
+    posts, comments = rebuild_search_index()
+    print(f"Indexed {posts} posts and {comments} comments")
+
+
+@recount.command(
+    name="site-stats", help="Counts the site totals shown in the admin page"
+)
+@click.option(
+    "--history",
+    is_flag=True,
+    help="Also rebuild the daily statistics from the creation times of the rows.",
+)
+def site_totals(history):
+    """Count the totals of users, subs, posts, comments and votes again.
+    This is also done periodically by the app, see `app.site_stats`."""
+    before = site_stats.totals()
+    after = site_stats.reconcile()
+    print("Total                 Before     After")
+    for field, value in after.items():
+        print(f"{field:16}{before[field]:12}{value:10}")
+    if history:
+        days = site_stats.rebuild_history()
+        print(f"Stored the statistics of {days} days")
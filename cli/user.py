@@ -1,6 +1,7 @@
 import click
 from flask.cli import AppGroup
 from peewee import JOIN
+from app.misc import invalidate_all_session_snapshots
 from app.models import User, UserMetadata
 
 user = AppGroup("user", help="Manage users")
@@ -27,6 +28,7 @@ def set_pref_all(name, value):
     if value == "1":
         for user in User.select():
             UserMetadata.create(uid=user.uid, key=name, value="1")
+    invalidate_all_session_snapshots()
 
 
 @user.command(name="set-nsfw-hidden-to-blur")
@@ -48,3 +50,4 @@ def set_nsfw_hidden_to_blur():
         ).execute()
         UserMetadata.create(uid=user.uid, key="nsfw", value="1")
         UserMetadata.create(uid=user.uid, key="nsfw_blur", value="1")
+    invalidate_all_session_snapshots()
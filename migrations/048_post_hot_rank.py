@@ -0,0 +1,67 @@
+"""Peewee migrations -- 048_post_hot_rank.py.
+
+Some examples (model - class or model name)::
+
+    > Model = migrator.orm['model_name']            # Return model in current state by name
+
+    > migrator.sql(sql)                             # Run custom SQL
+    > migrator.python(func, *args, **kwargs)        # Run python code
+    > migrator.create_model(Model)                  # Create a model (could be used as decorator)
+    > migrator.remove_model(model, cascade=True)    # Remove a model
+    > migrator.add_fields(model, **fields)          # Add fields to a model
+    > migrator.change_fields(model, **fields)       # Change fields
+    > migrator.remove_fields(model, *field_names, cascade=True)
+    > migrator.rename_field(model, old_field_name, new_field_name)
+    > migrator.rename_table(model, new_table_name)
+    > migrator.add_index(model, *col_names, unique=False)
+    > migrator.drop_index(model, *col_names)
+    > migrator.add_not_null(model, *field_names)
+    > migrator.drop_not_null(model, *field_names)
+    > migrator.add_default(model, field_name, default)
+
+"""
+
+import peewee as pw
+from peewee_migrate import Migrator
+from decimal import ROUND_HALF_EVEN
+
+try:
+    import playhouse.postgres_ext as pw_pext
+except ImportError:
+    pass
+
+SQL = pw.SQL
+
+
+def migrate(migrator: Migrator, database: pw.Database, fake=False, **kwargs):
+    """Add the materialized hot rank of posts, filled in with the default
+    hot sort. Sites using `custom_hot_sort` should run `flask recount hot`
+    after this migration."""
+    migrator.add_fields("sub_post", hot=pw.FloatField(null=True))
+
+    if isinstance(database, pw.Proxy):
+        database = database.obj
+    if isinstance(database, pw.PostgresqlDatabase):
+        posted = "EXTRACT(EPOCH FROM posted)"
+    elif isinstance(database, pw.SqliteDatabase):
+        posted = "strftime('%s', posted)"
+    else:
+        posted = "UNIX_TIMESTAMP(posted)"
+    migrator.sql(
+        f"UPDATE sub_post SET hot = score * 20 + ({posted} - 1134028003) / 1500.0"
+    )
+
+    SubPost = migrator.orm["sub_post"]
+    ctx = database.get_sql_context()
+    idx = pw.Index("sub_post_sid_hot", "sub_post", [SubPost.sid, SubPost.hot])
+    migrator.sql("".join(ctx.sql(idx)._sql))
+    ctx = database.get_sql_context()
+    idx = pw.Index("sub_post_hot", "sub_post", [SubPost.hot])
+    migrator.sql("".join(ctx.sql(idx)._sql))
+
+
+def rollback(migrator: Migrator, database: pw.Database, fake=False, **kwargs):
+    """Write your rollback migrations here."""
+    migrator.sql('DROP INDEX IF EXISTS "sub_post_sid_hot"')
+    migrator.sql('DROP INDEX IF EXISTS "sub_post_hot"')
+    migrator.remove_fields("sub_post", "hot")
@@ -0,0 +1,98 @@
+"""Peewee migrations -- 049_search_index.py.
+
+Some examples (model - class or model name)::
+
+    > Model = migrator.orm['model_name']            # Return model in current state by name
+
+    > migrator.sql(sql)                             # Run custom SQL
+    > migrator.python(func, *args, **kwargs)        # Run python code
+    > migrator.create_model(Model)                  # Create a model (could be used as decorator)
+    > migrator.remove_model(model, cascade=True)    # Remove a model
+    > migrator.add_fields(model, **fields)          # Add fields to a model
+    > migrator.change_fields(model, **fields)       # Change fields
+    > migrator.remove_fields(model, *field_names, cascade=True)
+    > migrator.rename_field(model, old_field_name, new_field_name)
+    > migrator.rename_table(model, new_table_name)
+    > migrator.add_index(model, *col_names, unique=False)
+    > migrator.drop_index(model, *col_names)
+    > migrator.add_not_null(model, *field_names)
+    > migrator.drop_not_null(model, *field_names)
+    > migrator.add_default(model, field_name, default)
+
+"""
+
+import peewee as pw
+from peewee_migrate import Migrator
+from decimal import ROUND_HALF_EVEN
+from app.config import config
+
+try:
+    import playhouse.postgres_ext as pw_pext
+except ImportError:
+    pass
+
+SQL = pw.SQL
+
+
+def migrate(migrator: Migrator, database: pw.Database, fake=False, **kwargs):
+    """Create the full-text search index of posts and comments and fill it
+    in. Postgres uses weighted tsvectors with GIN indexes and SQLite uses
+    FTS5 tables; other databases have no index and search with LIKE."""
+    if isinstance(database, pw.Proxy):
+        database = database.obj
+    if isinstance(database, pw.PostgresqlDatabase):
+        language = config.app.search.language.replace("'", "''")
+        migrator.sql(
+            "CREATE TABLE sub_post_search ("
+            "pid INTEGER PRIMARY KEY REFERENCES sub_post (pid) ON DELETE CASCADE, "
+            "vector TSVECTOR NOT NULL)"
+        )
+        migrator.sql(
+            "CREATE TABLE sub_post_comment_search ("
+            "cid VARCHAR(40) PRIMARY KEY "
+            "REFERENCES sub_post_comment (cid) ON DELETE CASCADE, "
+            "vector TSVECTOR NOT NULL)"
+        )
+        migrator.sql(
+            "INSERT INTO sub_post_search (pid, vector) "
+            f"SELECT pid, setweight(to_tsvector('{language}', title), 'A') || "
+            f"setweight(to_tsvector('{language}', coalesce(content, '')), 'B') "
+            "FROM sub_post WHERE deleted = 0"
+        )
+        migrator.sql(
+            "INSERT INTO sub_post_comment_search (cid, vector) "
+            f"SELECT cid, to_tsvector('{language}', coalesce(content, '')) "
+            "FROM sub_post_comment WHERE coalesce(status, 0) = 0"
+        )
+        migrator.sql(
+            "CREATE INDEX sub_post_search_vector ON sub_post_search USING GIN (vector)"
+        )
+        migrator.sql(
+            "CREATE INDEX sub_post_comment_search_vector "
+            "ON sub_post_comment_search USING GIN (vector)"
+        )
+    elif isinstance(database, pw.SqliteDatabase):
+        migrator.sql("CREATE VIRTUAL TABLE sub_post_search USING fts5(title, content)")
+        migrator.sql(
+            "INSERT INTO sub_post_search (sub_post_search, rank) "
+            "VALUES ('rank', 'bm25(10.0, 1.0)')"
+        )
+        migrator.sql(
+            "CREATE VIRTUAL TABLE sub_post_comment_search "
+            "USING fts5(cid UNINDEXED, content)"
+        )
+        migrator.sql(
+            "INSERT INTO sub_post_search (rowid, title, content) "
+            "SELECT pid, title, coalesce(content, '') FROM sub_post WHERE deleted = 0"
+        )
+        migrator.sql(
+            "INSERT INTO sub_post_comment_search (cid, content) "
+            "SELECT cid, coalesce(content, '') FROM sub_post_comment "
+            "WHERE coalesce(status, 0) = 0"
+        )
+
+
+def rollback(migrator: Migrator, database: pw.Database, fake=False, **kwargs):
+    """Write your rollback migrations here."""
+    migrator.sql("DROP TABLE IF EXISTS sub_post_comment_search")
+    migrator.sql("DROP TABLE IF EXISTS sub_post_search")
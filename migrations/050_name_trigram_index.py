@@ -0,0 +1,53 @@
+"""Peewee migrations -- 050_name_trigram_index.py.
+
+Some examples (model - class or model name)::
+
+    > Model = migrator.orm['model_name']            # Return model in current state by name
+
+    > migrator.sql(sql)                             # Run custom SQL
+    > migrator.python(func, *args, **kwargs)        # Run python code
+    > migrator.create_model(Model)                  # Create a model (could be used as decorator)
+    > migrator.remove_model(model, cascade=True)    # Remove a model
+    > migrator.add_fields(model, **fields)          # Add fields to a model
+    > migrator.change_fields(model, **fields)       # Change fields
+    > migrator.remove_fields(model, *field_names, cascade=True)
+    > migrator.rename_field(model, old_field_name, new_field_name)
+    > migrator.rename_table(model, new_table_name)
+    > migrator.add_index(model, *col_names, unique=False)
+    > migrator.drop_index(model, *col_names)
+    > migrator.add_not_null(model, *field_names)
+    > migrator.drop_not_null(model, *field_names)
+    > migrator.add_default(model, field_name, default)
+
+"""
+
+import peewee as pw
+from peewee_migrate import Migrator
+from decimal import ROUND_HALF_EVEN
+
+try:
+    import playhouse.postgres_ext as pw_pext
+except ImportError:
+    pass
+
+SQL = pw.SQL
+
+
+def migrate(migrator: Migrator, database: pw.Database, fake=False, **kwargs):
+    """Add trigram indexes on the names of subs and users, so the name
+    searches, which use `ILIKE '%term%'`, don't scan the whole table.
+    Only on Postgres."""
+    if isinstance(database, pw.Proxy):
+        database = database.obj
+    if isinstance(database, pw.PostgresqlDatabase):
+        migrator.sql("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        migrator.sql("CREATE INDEX sub_name_trgm ON sub USING GIN (name gin_trgm_ops)")
+        migrator.sql(
+            'CREATE INDEX user_name_trgm ON "user" USING GIN (name gin_trgm_ops)'
+        )
+
+
+def rollback(migrator: Migrator, database: pw.Database, fake=False, **kwargs):
+    """Write your rollback migrations here."""
+    migrator.sql('DROP INDEX IF EXISTS "sub_name_trgm"')
+    migrator.sql('DROP INDEX IF EXISTS "user_name_trgm"')
@@ -0,0 +1,94 @@
+"""Peewee migrations -- 051_post_domain.py.
+
+Some examples (model - class or model name)::
+
+    > Model = migrator.orm['model_name']            # Return model in current state by name
+
+    > migrator.sql(sql)                             # Run custom SQL
+    > migrator.python(func, *args, **kwargs)        # Run python code
+    > migrator.create_model(Model)                  # Create a model (could be used as decorator)
+    > migrator.remove_model(model, cascade=True)    # Remove a model
+    > migrator.add_fields(model, **fields)          # Add fields to a model
+    > migrator.change_fields(model, **fields)       # Change fields
+    > migrator.remove_fields(model, *field_names, cascade=True)
+    > migrator.rename_field(model, old_field_name, new_field_name)
+    > migrator.rename_table(model, new_table_name)
+    > migrator.add_index(model, *col_names, unique=False)
+    > migrator.drop_index(model, *col_names)
+    > migrator.add_not_null(model, *field_names)
+    > migrator.drop_not_null(model, *field_names)
+    > migrator.add_default(model, field_name, default)
+
+"""
+
+import peewee as pw
+from peewee_migrate import Migrator
+from decimal import ROUND_HALF_EVEN
+from urllib.parse import urlparse
+
+try:
+    import playhouse.postgres_ext as pw_pext
+except ImportError:
+    pass
+
+SQL = pw.SQL
+
+
+def domain_key(link):
+    """Same as app.misc.link_domain."""
+    try:
+        host = urlparse(link).hostname
+    except ValueError:
+        return None
+    if not host:
+        return None
+    return ".".join(reversed(host.lower().strip(".").split("."))) + "."
+
+
+def fill_domains(SubPost, batch_size=1000):
+    last = 0
+    while True:
+        posts = list(
+            SubPost.select(SubPost.pid, SubPost.link)
+            .where((SubPost.pid > last) & SubPost.link.is_null(False))
+            .order_by(SubPost.pid)
+            .limit(batch_size)
+            .tuples()
+        )
+        if not posts:
+            return
+        by_domain = {}
+        for pid, link in posts:
+            by_domain.setdefault(domain_key(link), []).append(pid)
+        by_domain.pop(None, None)
+        for domain, pids in by_domain.items():
+            SubPost.update(domain=domain).where(SubPost.pid << pids).execute()
+        last = posts[-1][0]
+
+
+def migrate(migrator: Migrator, database: pw.Database, fake=False, **kwargs):
+    """Add the reversed host name of link posts, with an index to list the
+    posts linking to a domain and its subdomains, and fill it in."""
+    migrator.add_fields("sub_post", domain=pw.CharField(null=True))
+
+    if isinstance(database, pw.Proxy):
+        database = database.obj
+    if isinstance(database, pw.PostgresqlDatabase):
+        # Compare bytes, so that prefix ranges match the prefix.
+        migrator.sql(
+            'ALTER TABLE sub_post ALTER COLUMN domain TYPE VARCHAR(255) COLLATE "C"'
+        )
+
+    SubPost = migrator.orm["sub_post"]
+    if not fake:
+        migrator.python(fill_domains, SubPost)
+
+    ctx = database.get_sql_context()
+    idx = pw.Index("sub_post_domain_pid", "sub_post", [SubPost.domain, SubPost.pid])
+    migrator.sql("".join(ctx.sql(idx)._sql))
+
+
+def rollback(migrator: Migrator, database: pw.Database, fake=False, **kwargs):
+    """Write your rollback migrations here."""
+    migrator.sql('DROP INDEX IF EXISTS "sub_post_domain_pid"')
+    migrator.remove_fields("sub_post", "domain")
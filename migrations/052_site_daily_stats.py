@@ -0,0 +1,56 @@
+"""Peewee migrations -- 052_site_daily_stats.py.
+
+Some examples (model - class or model name)::
+
+    > Model = migrator.orm['model_name']            # Return model in current state by name
+
+    > migrator.sql(sql)                             # Run custom SQL
+    > migrator.python(func, *args, **kwargs)        # Run python code
+    > migrator.create_model(Model)                  # Create a model (could be used as decorator)
+    > migrator.remove_model(model, cascade=True)    # Remove a model
+    > migrator.add_fields(model, **fields)          # Add fields to a model
+    > migrator.change_fields(model, **fields)       # Change fields
+    > migrator.remove_fields(model, *field_names, cascade=True)
+    > migrator.rename_field(model, old_field_name, new_field_name)
+    > migrator.rename_table(model, new_table_name)
+    > migrator.add_index(model, *col_names, unique=False)
+    > migrator.drop_index(model, *col_names)
+    > migrator.add_not_null(model, *field_names)
+    > migrator.drop_not_null(model, *field_names)
+    > migrator.add_default(model, field_name, default)
+
+"""
+
+import peewee as pw
+from peewee_migrate import Migrator
+from decimal import ROUND_HALF_EVEN
+
+try:
+    import playhouse.postgres_ext as pw_pext
+except ImportError:
+    pass
+
+SQL = pw.SQL
+
+
+def migrate(migrator: Migrator, database: pw.Database, fake=False, **kwargs):
+    """Add a table for the daily changes of the site totals shown in the
+    admin page. Run `recount site-stats --history` to fill it in."""
+
+    @migrator.create_model
+    class SiteDailyStats(pw.Model):
+        day = pw.DateField(primary_key=True)
+        users = pw.IntegerField(default=0)
+        subs = pw.IntegerField(default=0)
+        posts = pw.IntegerField(default=0)
+        comments = pw.IntegerField(default=0)
+        upvotes = pw.IntegerField(default=0)
+        downvotes = pw.IntegerField(default=0)
+
+        class Meta:
+            table_name = "site_daily_stats"
+
+
+def rollback(migrator: Migrator, database: pw.Database, fake=False, **kwargs):
+    """Write your rollback migrations here."""
+    migrator.remove_model("site_daily_stats")
@@ -10,6 +10,9 @@ from app.config import Config
 from app.models import db, BaseModel, User, SiteMetadata
 from app.caching import cache
 from app.auth import auth_provider
+from app.misc import banned_domains
+from app.search import create_search_tables, sub_names
+from app.site_stats import site_stats
 
 from test.utilities import recursively_update, add_config_to_site_metadata
 
@@ -112,7 +115,12 @@ def app(app_before_init_db):
         db.execute_sql("GRANT ALL ON SCHEMA public TO public;")
 
     db.create_tables(BaseModel.__subclasses__())
+    create_search_tables()
     add_config_to_site_metadata(conf_obj)
+    conf_obj.invalidate_snapshot()
+    banned_domains.invalidate()
+    sub_names.invalidate()
+    site_stats.invalidate()
 
     yield app
 
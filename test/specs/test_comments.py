@@ -1,8 +1,13 @@
 import json
+import pytest
 from bs4 import BeautifulSoup
 from flask import url_for
 
+from app.comment_views import comment_views, PENDING_KEY
 from app.config import config
+from app.misc import best_score, get_comment_skeleton
+from app.models import rconn, SubPostComment, SubPostCommentView
+from cli.recount import best_scores
 from test.utilities import (
     create_sub,
     csrf_token,
@@ -129,3 +134,167 @@ def test_comment_sort(client, user_info):
         comments = [c.get_text() for c in soup.find_all("div", class_="content")]
         for expected, comment in zip(order, comments):
             assert comment.find(expected) != -1
+
+
+def test_comment_cache_invalidation(client, user_info):
+    "Cached comments are refreshed when they are edited or deleted."
+    config.update_value("site.sub_creation_min_level", 0)
+    register_user(client, user_info)
+    create_sub(client)
+
+    rv = client.get(url_for("subs.submit", ptype="text", sub="test"))
+    csrf = csrf_token(rv.data)
+    rv = client.post(
+        url_for("subs.submit", ptype="text", sub="test"),
+        data={
+            "csrf_token": csrf,
+            "title": "the title",
+            "ptype": "text",
+            "content": "the content",
+        },
+        follow_redirects=False,
+    )
+    soup = BeautifulSoup(rv.data, "html.parser", from_encoding="utf-8")
+    link = soup.a.get_text()
+    pid = link.split("/")[-1]
+
+    rv = client.post(
+        url_for("do.create_comment", pid=pid),
+        data={
+            "csrf_token": csrf,
+            "post": pid,
+            "parent": "0",
+            "comment": "*first* version",
+        },
+    )
+    cid = json.loads(rv.data.decode("utf-8"))["cid"]
+
+    rv = client.get(link, follow_redirects=True)
+    assert b"<em>first</em> version" in rv.data
+
+    rv = client.post(
+        url_for("do.edit_comment"),
+        data={"csrf_token": csrf, "cid": cid, "text": "*second* version"},
+    )
+    assert json.loads(rv.data.decode("utf-8"))["status"] == "ok"
+    rv = client.get(link, follow_redirects=True)
+    assert b"<em>first</em> version" not in rv.data
+    assert b"<em>second</em> version" in rv.data
+
+    rv = client.post(
+        url_for("do.delete_comment"), data={"csrf_token": csrf, "cid": cid}
+    )
+    assert json.loads(rv.data.decode("utf-8"))["status"] == "ok"
+    log_out_current_user(client)
+    rv = client.get(link, follow_redirects=True)
+    assert b"second</em> version" not in rv.data
+
+
+def test_batched_comment_views(app, client, user_info, user2_info):
+    "Batched comment views are recorded when the buffer is flushed."
+    config.update_value("site.sub_creation_min_level", 0)
+    register_user(client, user_info)
+    create_sub(client)
+    rv = client.get(url_for("subs.submit", ptype="text", sub="test"))
+    csrf = csrf_token(rv.data)
+    rv = client.post(
+        url_for("subs.submit", ptype="text", sub="test"),
+        data={
+            "csrf_token": csrf,
+            "title": "the title",
+            "ptype": "text",
+            "content": "the content",
+        },
+        follow_redirects=False,
+    )
+    soup = BeautifulSoup(rv.data, "html.parser", from_encoding="utf-8")
+    pid = soup.a.get_text().split("/")[-1]
+    cids = []
+    for text in ["first", "second"]:
+        rv = client.post(
+            url_for("do.create_comment", pid=pid),
+            data={"csrf_token": csrf, "post": pid, "parent": "0", "comment": text},
+        )
+        cids.append(json.loads(rv.data.decode("utf-8"))["cid"])
+    log_out_current_user(client)
+
+    register_user(client, user2_info)
+    rconn.delete(PENDING_KEY)
+    comment_views.enabled = True
+    try:
+        for _ in range(2):
+            rv = client.post(
+                url_for("do.mark_comments_viewed"),
+                data={"csrf_token": csrf, "cids": json.dumps(cids)},
+            )
+            assert json.loads(rv.data.decode("utf-8"))["status"] == "ok"
+        assert comment_views.pending() == 2
+        assert SubPostComment.get_by_id(cids[0]).views == 0
+
+        assert comment_views.flush() == 2
+        assert comment_views.pending() == 0
+    finally:
+        comment_views.enabled = False
+
+    for cid in cids:
+        comment = SubPostComment.get_by_id(cid)
+        assert comment.views == 1
+        assert comment.best_score == pytest.approx(
+            best_score(comment.upvotes, comment.downvotes, 1)
+        )
+    assert SubPostCommentView.select().count() == 2
+
+    # Views already recorded are not counted again.
+    rv = client.post(
+        url_for("do.mark_comments_viewed"),
+        data={"csrf_token": csrf, "cids": json.dumps(cids)},
+    )
+    assert SubPostComment.get_by_id(cids[0]).views == 1
+
+    # The views and best scores can be recomputed in bulk.
+    scores = {cid: SubPostComment.get_by_id(cid).best_score for cid in cids}
+    SubPostComment.update(views=7, best_score=None).execute()
+    result = app.test_cli_runner().invoke(best_scores, ["--views", "--batch-size", "1"])
+    assert result.exit_code == 0
+    assert "Updated 2 comments" in result.output
+    for cid in cids:
+        comment = SubPostComment.get_by_id(cid)
+        assert comment.views == 1
+        assert comment.best_score == pytest.approx(scores[cid])
+
+
+def test_comment_skeleton():
+    "The bare comment tree keeps the query order and paginates branches."
+
+    def thread():
+        # Eight top-level comments, the first one with seven replies.
+        comments = [{"cid": f"r{i}", "parentcid": None} for i in range(8)]
+        comments += [{"cid": f"c{i}", "parentcid": "r0"} for i in range(7)]
+        # A reply whose parent is gone is not shown.
+        comments.append({"cid": "orphan", "parentcid": "missing"})
+        return comments
+
+    tree, cids = get_comment_skeleton(thread(), sticky_cid="r3")
+    assert [c["cid"] for c in tree] == ["r3", "r0", "r1", "r2", "r4", "r5", "r6", "r7"]
+    replies = tree[1]["children"]
+    assert [c["cid"] for c in replies[:-1]] == [f"c{i}" for i in range(6)]
+    assert replies[-1] == {"cid": None, "key": "c5", "more": 1, "pcid": "r0"}
+    assert "orphan" not in cids
+
+    tree, cids = get_comment_skeleton(thread(), root="c2")
+    assert [c["cid"] for c in tree] == ["r0"]
+    assert [c["cid"] for c in tree[0]["children"]] == ["c2"]
+
+    tree, cids = get_comment_skeleton(thread(), root="r0", only_after="c4")
+    assert [c["cid"] for c in tree[0]["children"]] == ["c5", "c6"]
+
+    assert get_comment_skeleton(thread(), root="orphan") == ([], [])
+
+    # Very deep threads don't hit the recursion limit.
+    chain = [{"cid": "0", "parentcid": None}]
+    chain += [{"cid": str(i), "parentcid": str(i - 1)} for i in range(1, 5000)]
+    tree, cids = get_comment_skeleton(chain)
+    assert cids == ["0", "1", "2", "3"]
+    assert tree[0]["children"][0]["children"][0]["children"][0]["children"] == [
+        {"cid": None, "more": 1, "pcid": "3"}
+    ]
@@ -0,0 +1,30 @@
+from app.config import config, ConfigSnapshot
+from app.models import rconn, SiteMetadata
+
+
+def test_config_snapshot(app):
+    """Values stored in the database are read from a local copy, which
+    update_value keeps current and announces to the other processes."""
+    assert config.site.sub_creation_min_level == 2
+    SiteMetadata.update(value="7").where(
+        SiteMetadata.key == "site.sub_creation_min_level"
+    ).execute()
+    assert config.site.sub_creation_min_level == 2
+
+    pubsub = rconn.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(ConfigSnapshot.CHANNEL)
+    config.update_value("site.sub_creation_min_level", 3)
+    assert config.site.sub_creation_min_level == 3
+    for _ in range(3):
+        message = pubsub.get_message(timeout=5)
+        if message is not None:
+            break
+    assert message["data"].decode().endswith(" site.sub_creation_min_level")
+    pubsub.close()
+
+    SiteMetadata.update(value="7").where(
+        SiteMetadata.key == "site.sub_creation_min_level"
+    ).execute()
+    app.config["THROAT_CONFIG"].invalidate_snapshot()
+    # The cache still has the value written by update_value.
+    assert config.site.sub_creation_min_level == 3
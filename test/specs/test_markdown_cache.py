@@ -0,0 +1,73 @@
+import pytest
+
+from app.misc import MarkdownCache, markdown_cache, our_markdown, render_markdown
+from app.models import rconn
+
+
+def test_markdown_cache_eviction():
+    "The least recently used entries are dropped once the cache is full."
+    cache = MarkdownCache(size=3)
+    for key in "abc":
+        cache.set(key, key.upper())
+    # Reading "a" makes "b" the least recently used entry.
+    assert cache.get("a") == "A"
+    cache.set("d", "D")
+    assert list(cache._entries) == ["c", "a", "d"]
+    assert cache.get("b") is None
+    cache.set("e", "E")
+    assert list(cache._entries) == ["a", "d", "e"]
+    assert cache.info() == {
+        "hits": 1,
+        "shared_hits": 0,
+        "misses": 1,
+        "size": 3,
+        "max_size": 3,
+    }
+
+    cache = MarkdownCache(size=0)
+    cache.set("a", "A")
+    assert cache.get("a") is None
+    assert cache.info()["size"] == 0
+
+
+def test_markdown_cache_counters(app):
+    "Renders are counted as hits and misses, and keyed by the text."
+    markdown_cache.clear()
+    html = our_markdown("*cached*")
+    assert html == render_markdown("*cached*")
+    assert our_markdown("*cached*") == html
+    assert our_markdown("*other*") == render_markdown("*other*")
+    info = markdown_cache.info()
+    assert (info["hits"], info["shared_hits"], info["misses"]) == (1, 0, 2)
+    assert info["size"] == 2
+
+    markdown_cache.clear()
+    assert markdown_cache.info()["size"] == markdown_cache.info()["misses"] == 0
+
+
+@pytest.mark.parametrize(
+    "test_config", [{"app": {"markdown_cache": {"size": 1, "redis_ttl": 60}}}]
+)
+def test_markdown_cache_redis(app):
+    "Entries missing in the process are read from the shared Redis tier."
+    assert (markdown_cache.size, markdown_cache.redis_ttl) == (1, 60)
+    keys = [markdown_cache.key(text) for text in ("*one*", "*two*")]
+    rconn.delete(*keys)
+    html = our_markdown("*one*")
+    assert rconn.get(keys[0]).decode() == html
+    assert 0 < rconn.ttl(keys[0]) <= 60
+
+    # "*two*" pushes "*one*" out of the process, but not out of Redis.
+    our_markdown("*two*")
+    assert list(markdown_cache._entries) == [keys[1]]
+    assert our_markdown("*one*") == html
+    assert list(markdown_cache._entries) == [keys[0]]
+    info = markdown_cache.info()
+    assert (info["hits"], info["shared_hits"], info["misses"]) == (0, 1, 2)
+
+    # Another process with an empty cache gets it from Redis as well.
+    other = MarkdownCache(size=1)
+    other.redis_ttl, other.prefix = markdown_cache.redis_ttl, markdown_cache.prefix
+    assert other.get(keys[1]) == render_markdown("*two*")
+    assert other.info()["shared_hits"] == 1
+    rconn.delete(*keys)
@@ -1,7 +1,16 @@
 from bs4 import BeautifulSoup
 from flask import url_for
 
-from app.models import User
+from app import misc
+from app.misc import (
+    UNREAD_COUNTS_KEY,
+    UNREAD_COUNTS_TTL,
+    adjust_unread_count,
+    count_unread,
+    get_unread_counts,
+    repair_unread_counts,
+)
+from app.models import rconn, User
 
 from test.utilities import csrf_token
 from test.utilities import register_user, log_in_user, log_out_current_user
@@ -355,3 +364,49 @@ def test_exchange_pm(client, user_info, user2_info):
     soup = BeautifulSoup(rv.data, "html.parser", from_encoding="utf-8")
     link = soup.find(href=url_for("messages.inbox_sort"))
     assert link.get_text().strip() == "0"
+
+
+def test_unread_counters(client, user_info, user2_info, monkeypatch):
+    """Unread counts are kept in redis and can be repaired."""
+    username = user_info["username"]
+    register_user(client, user_info)
+    uid = User.get(User.name == username).uid
+    key = UNREAD_COUNTS_KEY.format(uid)
+    assert get_unread_counts(uid) == (0, 0)
+    log_out_current_user(client)
+    register_user(client, user2_info)
+
+    rv = client.get(url_for("user.view", user=username))
+    for subject in ["One", "Two"]:
+        client.post(
+            url_for("do.create_sendmsg"),
+            data=dict(
+                csrf_token=csrf_token(rv.data),
+                to=username,
+                subject=subject,
+                content="Test Content",
+            ),
+        )
+    assert rconn.hmget(key, "messages", "notifications") == [b"2", b"0"]
+    assert count_unread(uid) == (2, 0)
+
+    rconn.hset(key, "messages", 5)
+    wrong = [w for w in repair_unread_counts(save=False) if w[0] == uid]
+    assert wrong == [(uid, (5, 0), (2, 0))]
+    assert get_unread_counts(uid) == (5, 0)
+    repair_unread_counts()
+    assert get_unread_counts(uid) == (2, 0)
+
+    # Counts filled in by another process while this one was counting in
+    # the database are kept, along with the adjustments made to them.
+    rconn.delete(key)
+
+    def racing_count_unread(uid):
+        rconn.hset(key, mapping={"messages": 2, "notifications": 0})
+        adjust_unread_count(uid, "messages")
+        return 2, 0
+
+    monkeypatch.setattr(misc, "count_unread", racing_count_unread)
+    assert get_unread_counts(uid) == (3, 0)
+    assert rconn.hmget(key, "messages", "notifications") == [b"3", b"0"]
+    assert 0 < rconn.ttl(key) <= UNREAD_COUNTS_TTL
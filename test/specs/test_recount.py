@@ -0,0 +1,88 @@
+import json
+import pytest
+from bs4 import BeautifulSoup
+from flask import url_for
+
+from app.config import config
+from app.models import Sub, SubPost, SubPostComment, User
+from cli.recount import counters
+from test.utilities import (
+    create_sub,
+    csrf_token,
+    log_out_current_user,
+    register_user,
+)
+
+
+def test_recount_counters(app, client, user_info, user2_info):
+    "Drifted counters are reported by a dry run and fixed by the recount."
+    config.update_value("site.sub_creation_min_level", 0)
+    register_user(client, user_info)
+    create_sub(client)
+    rv = client.get(url_for("subs.submit", ptype="text", sub="test"))
+    csrf = csrf_token(rv.data)
+    pids = []
+    for title in ["first", "second"]:
+        rv = client.post(
+            url_for("subs.submit", ptype="text", sub="test"),
+            data={"csrf_token": csrf, "title": title, "ptype": "text", "content": "x"},
+        )
+        soup = BeautifulSoup(rv.data, "html.parser", from_encoding="utf-8")
+        pids.append(int(soup.a.get_text().split("/")[-1]))
+    rv = client.post(
+        url_for("do.create_comment", pid=pids[0]),
+        data={"csrf_token": csrf, "post": pids[0], "parent": "0", "comment": "hi"},
+    )
+    cid = json.loads(rv.data.decode("utf-8"))["cid"]
+    log_out_current_user(client)
+
+    register_user(client, user2_info)
+    rv = client.post(
+        url_for("do.upvote", pid=pids[0], value="up"), data={"csrf_token": csrf}
+    )
+    assert rv.json["score"] == 2
+    rv = client.post(
+        url_for("do.upvotecomment", cid=cid, value="down"), data={"csrf_token": csrf}
+    )
+    assert rv.json["score"] == -1
+
+    def snapshot():
+        sub = Sub.get(Sub.name == "test")
+        post = SubPost.get_by_id(pids[0])
+        comment = SubPostComment.get_by_id(cid)
+        users = [User.get(User.name == u["username"]) for u in [user_info, user2_info]]
+        return (
+            (sub.subscribers, sub.posts),
+            (post.comments, post.score, post.upvotes, post.downvotes),
+            (comment.score, comment.upvotes, comment.downvotes),
+            [(user.score, user.given) for user in users],
+        )
+
+    correct = snapshot()
+    result = app.test_cli_runner().invoke(counters, ["--dry-run"])
+    assert result.exit_code == 0
+    assert "Found 0 wrong users counters" in result.output
+
+    Sub.update(subscribers=5, posts=0).execute()
+    hot = SubPost.get_by_id(pids[0]).hot
+    SubPost.update(comments=3, score=7, upvotes=0, hot=0).execute()
+    SubPostComment.update(score=None, downvotes=0).execute()
+    User.update(score=9, given=0).execute()
+    wrong = snapshot()
+
+    result = app.test_cli_runner().invoke(counters, ["--dry-run"])
+    assert result.exit_code == 0
+    assert "Found 1 wrong posts counters" in result.output
+    assert "Found 2 wrong post-votes counters" in result.output
+    assert snapshot() == wrong
+
+    result = app.test_cli_runner().invoke(counters, ["--save", "--batch-size", "1"])
+    assert result.exit_code == 0
+    assert "Fixed 2 wrong users counters" in result.output
+    assert snapshot() == correct
+    assert SubPost.get_by_id(pids[0]).hot == pytest.approx(hot)
+
+    result = app.test_cli_runner().invoke(counters, ["users", "--dry-run"])
+    assert result.exit_code == 0
+    assert "Found 0 wrong users counters" in result.output
+    assert "post-votes" not in result.output
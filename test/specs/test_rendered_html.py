@@ -0,0 +1,95 @@
+import json
+from bs4 import BeautifulSoup
+from flask import url_for
+
+from app.config import config
+from app.misc import MARKDOWN_RENDERER_VERSION, our_markdown, stored_markdown
+from app.models import SubPost, SubPostComment
+from cli.recount import rendered_html
+from test.utilities import create_sub, csrf_token, log_out_current_user, register_user
+
+
+def create_post_and_comment(client, user_info):
+    """Returns the csrf token, the pid of a new text post and the cid of a
+    new comment on it."""
+    config.update_value("site.sub_creation_min_level", 0)
+    register_user(client, user_info)
+    create_sub(client)
+    rv = client.get(url_for("subs.submit", ptype="text", sub="test"))
+    csrf = csrf_token(rv.data)
+    rv = client.post(
+        url_for("subs.submit", ptype="text", sub="test"),
+        data={
+            "csrf_token": csrf,
+            "title": "the title",
+            "ptype": "text",
+            "content": "*post* content",
+        },
+    )
+    soup = BeautifulSoup(rv.data, "html.parser", from_encoding="utf-8")
+    pid = int(soup.a.get_text().split("/")[-1])
+    rv = client.post(
+        url_for("do.create_comment", pid=pid),
+        data={"csrf_token": csrf, "post": pid, "parent": "0", "comment": "*first*"},
+    )
+    return csrf, pid, json.loads(rv.data.decode("utf-8"))["cid"]
+
+
+def test_html_stored_on_create_and_edit(client, user_info):
+    "The rendered HTML is stored when posts and comments are created or edited."
+    csrf, pid, cid = create_post_and_comment(client, user_info)
+    post, comment = SubPost.get_by_id(pid), SubPostComment.get_by_id(cid)
+    assert post.content_html == our_markdown("*post* content")
+    assert comment.content_html == our_markdown("*first*")
+    assert post.html_version == comment.html_version == MARKDOWN_RENDERER_VERSION
+
+    rv = client.post(
+        url_for("do.edit_txtpost", pid=pid),
+        data={"csrf_token": csrf, "content": "*edited* content"},
+    )
+    assert json.loads(rv.data.decode("utf-8"))["status"] == "ok"
+    rv = client.post(
+        url_for("do.edit_comment"),
+        data={"csrf_token": csrf, "cid": cid, "text": "*second*"},
+    )
+    assert json.loads(rv.data.decode("utf-8"))["status"] == "ok"
+    assert SubPost.get_by_id(pid).content_html == our_markdown("*edited* content")
+    assert SubPostComment.get_by_id(cid).content_html == our_markdown("*second*")
+
+    # The API serves the stored HTML.
+    SubPost.update(content_html="<p>stored</p>").execute()
+    log_out_current_user(client)
+    rv = client.get(url_for("apiv3.get_post_list", target="all", sort="new"))
+    assert [p["content"] for p in rv.json["posts"]] == ["<p>stored</p>"]
+
+
+def test_stored_markdown_version():
+    "Stored HTML is only used if it was made by the current renderer."
+    assert (
+        stored_markdown("*new*", "<p>old</p>", MARKDOWN_RENDERER_VERSION)
+        == "<p>old</p>"
+    )
+    assert stored_markdown(
+        "*new*", "<p>old</p>", MARKDOWN_RENDERER_VERSION - 1
+    ) == our_markdown("*new*")
+    assert stored_markdown("*new*", None, None) == our_markdown("*new*")
+
+
+def test_recount_rendered_html(app, client, user_info):
+    "The recount command fills in missing and outdated HTML."
+    _, pid, cid = create_post_and_comment(client, user_info)
+    SubPost.update(content_html=None, html_version=None).execute()
+    SubPostComment.update(
+        content_html="<p>old</p>", html_version=MARKDOWN_RENDERER_VERSION - 1
+    ).execute()
+
+    result = app.test_cli_runner().invoke(rendered_html, ["--dry-run"])
+    assert result.exit_code == 0
+    assert SubPost.get_by_id(pid).content_html is None
+
+    result = app.test_cli_runner().invoke(rendered_html, ["--batch-size", "1"])
+    assert result.exit_code == 0
+    post, comment = SubPost.get_by_id(pid), SubPostComment.get_by_id(cid)
+    assert post.content_html == our_markdown("*post* content")
+    assert comment.content_html == our_markdown("*first*")
+    assert post.html_version == comment.html_version == MARKDOWN_RENDERER_VERSION
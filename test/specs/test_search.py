@@ -0,0 +1,94 @@
+import json
+from bs4 import BeautifulSoup
+from flask import url_for
+
+from app.config import config
+from cli.recount import search
+from test.utilities import (
+    create_sub,
+    csrf_token,
+    register_user,
+)
+
+
+def test_full_text_search(app, client, user_info):
+    "Posts and comments are searchable, best matches first, as they change."
+    config.update_value("site.sub_creation_min_level", 0)
+    register_user(client, user_info)
+    create_sub(client)
+    rv = client.get(url_for("subs.submit", ptype="text", sub="test"))
+    csrf = csrf_token(rv.data)
+
+    pids = {}
+    for title, content in [
+        ("Ripe bananas", "Apples are nice too."),
+        ("Apples and pears", "Picked yesterday."),
+        ("Something else", "Nothing to see here."),
+    ]:
+        rv = client.post(
+            url_for("subs.submit", ptype="text", sub="test"),
+            data={
+                "csrf_token": csrf,
+                "title": title,
+                "ptype": "text",
+                "content": content,
+            },
+            follow_redirects=False,
+        )
+        soup = BeautifulSoup(rv.data, "html.parser", from_encoding="utf-8")
+        pids[title] = int(soup.a.get_text().split("/")[-1])
+
+    def search_posts(term, **kwargs):
+        rv = client.get(url_for("apiv3.search", q=term, **kwargs))
+        assert rv.status_code == 200
+        return [post["title"] for post in rv.json["results"]]
+
+    # Matches in the title rank above matches in the content.
+    assert search_posts("apples") == ["Apples and pears", "Ripe bananas"]
+    assert search_posts("apples", sub="test") == ["Apples and pears", "Ripe bananas"]
+    assert search_posts("apples pears") == ["Apples and pears"]
+    assert search_posts("oranges") == []
+
+    rv = client.get(url_for("home.search", term="apples"))
+    soup = BeautifulSoup(rv.data, "html.parser", from_encoding="utf-8")
+    posts = soup.find("div", class_="alldaposts")
+    titles = [a.get_text().strip() for a in posts.find_all("a", class_="title")]
+    assert titles == ["Apples and pears", "Ripe bananas"]
+
+    # Edited titles are indexed again, and deleted posts disappear.
+    rv = client.post(
+        url_for("do.edit_title"),
+        data={"csrf_token": csrf, "post": pids["Something else"], "reason": "Pears"},
+    )
+    assert rv.json["status"] == "ok"
+    assert search_posts("pears") == ["Pears", "Apples and pears"]
+    rv = client.post(
+        url_for("do.delete_post"),
+        data={"csrf_token": csrf, "post": pids["Apples and pears"]},
+    )
+    assert rv.json["status"] == "ok"
+    assert search_posts("pears") == ["Pears"]
+
+    rv = client.post(
+        url_for("do.create_comment", pid=pids["Something else"]),
+        data={
+            "csrf_token": csrf,
+            "post": pids["Something else"],
+            "parent": "0",
+            "comment": "Pears are better than apples.",
+        },
+    )
+    cid = json.loads(rv.data.decode("utf-8"))["cid"]
+    rv = client.get(url_for("apiv3.search", q="better", type="comments"))
+    assert [c["cid"] for c in rv.json["results"]] == [cid]
+    rv = client.post(
+        url_for("do.delete_comment"), data={"csrf_token": csrf, "cid": cid}
+    )
+    assert rv.json["status"] == "ok"
+    rv = client.get(url_for("apiv3.search", q="better", type="comments"))
+    assert rv.json["results"] == []
+
+    result = app.test_cli_runner().invoke(search)
+    assert result.exit_code == 0
+    assert "Indexed 2 posts and 0 comments" in result.output
+    assert search_posts("apples") == ["Ripe bananas"]
@@ -0,0 +1,230 @@
+import json
+import sys
+import time
+
+import gevent
+import socketio
+
+from app.config import config
+from app.models import rconn
+from app.socketio import SocketIOWithLogging, ShardedRedisManager, LEADER_KEY
+from app.socketio import CHAT_KEY, chat_backlog
+
+
+socketio_module = sys.modules["app.socketio"]
+
+
+def instance(name, emitted):
+    """An instance which records what it emits instead of emitting it."""
+    sio = SocketIOWithLogging()
+    sio.instance_name = name
+    sio.emit = lambda event, data, **kwargs: emitted.append((name, event, data))
+    return sio
+
+
+def message(n):
+    return {
+        "type": "pmessage",
+        "channel": b"/send:test:room",
+        "data": json.dumps({"n": n}),
+    }
+
+
+def test_socketio_leader_handoff(app, monkeypatch):
+    "Only the lease holder emits, and another instance takes over when it stops."
+    monkeypatch.setattr(socketio_module, "NAME_KEY_KEEPALIVE", 0.2)
+    rconn.delete(LEADER_KEY)
+    emitted = []
+    first, second = instance("first", emitted), instance("second", emitted)
+
+    assert first.claim_lease()
+    assert not second.claim_lease()
+    for n in range(3):
+        first.emit_message(message(n))
+        second.emit_message(message(n))
+    assert emitted == [("first", "test", {"n": n}) for n in range(3)]
+
+    # The follower trusts the lease until it expires, without asking Redis.
+    with monkeypatch.context() as m:
+        m.setattr(rconn, "eval", None)
+        assert not second.emitting_instance()
+
+    # The leader goes away without renewing its lease. Messages are lost
+    # until the lease expires, then the next one is emitted by the follower.
+    emitted.clear()
+    second.emit_message(message(3))
+    assert emitted == []
+    time.sleep(0.25)
+    second.emit_message(message(4))
+    assert emitted == [("second", "test", {"n": 4})]
+    assert rconn.get(LEADER_KEY) == b"second"
+
+    # The old leader doesn't emit once it notices it lost the lease.
+    emitted.clear()
+    first.emit_message(message(5))
+    second.emit_message(message(5))
+    assert emitted == [("second", "test", {"n": 5})]
+
+
+def test_socketio_leader_resign(app, monkeypatch):
+    "A leader which resigns can be replaced right away."
+    rconn.delete(LEADER_KEY)
+    emitted = []
+    first, second = instance("first", emitted), instance("second", emitted)
+    assert first.claim_lease()
+    assert first.claim_lease()
+    assert not second.claim_lease()
+
+    second.resign()
+    assert rconn.get(LEADER_KEY) == b"first"
+    first.resign()
+    assert rconn.get(LEADER_KEY) is None
+    assert second.claim_lease()
+    first.emit_message(message(0))
+    second.emit_message(message(0))
+    assert emitted == [("second", "test", {"n": 0})]
+
+
+def test_socketio_local_delivery(app):
+    "With sharded rooms every instance emits to its own clients, without a lease."
+    rconn.set(LEADER_KEY, "someone-else")
+    emitted = []
+    sio = SocketIOWithLogging()
+    sio.local_delivery = True
+    sio.emit = lambda event, data, **kwargs: emitted.append((event, data, kwargs))
+    assert sio.emit_message(message(0))
+    assert emitted == [
+        ("test", {"n": 0}, {"room": "room", "namespace": "/snt", "ignore_queue": True})
+    ]
+
+
+def test_coalesced_updates(app):
+    "Only the latest update of an event to a room is sent in each window."
+    emitted = []
+    sio = SocketIOWithLogging()
+    sio.coalesce_window = 0.05
+    sio.emit = lambda event, data, **kwargs: emitted.append(
+        (event, kwargs["room"], data)
+    )
+    for score in range(100):
+        sio.emit_latest("threadscore", {"score": score}, namespace="/snt", room=1)
+        sio.emit_latest("uscore", {"score": score}, namespace="/snt", room="user1")
+    sio.emit_latest("threadscore", {"score": 7}, namespace="/snt", room=2)
+    assert emitted == []
+
+    gevent.sleep(0.1)
+    assert sorted(emitted, key=str) == sorted(
+        [
+            ("threadscore", 1, {"score": 99}),
+            ("uscore", "user1", {"score": 99}),
+            ("threadscore", 2, {"score": 7}),
+        ],
+        key=str,
+    )
+    assert sio.pending_updates == {}
+
+    # The next update starts a new window.
+    emitted.clear()
+    sio.emit_latest("threadscore", {"score": 100}, namespace="/snt", room=1)
+    gevent.sleep(0.1)
+    assert emitted == [("threadscore", 1, {"score": 100})]
+
+    # Without a window every update is sent right away.
+    emitted.clear()
+    sio.coalesce_window = 0
+    sio.emit_latest("threadscore", {"score": 101}, namespace="/snt", room=1)
+    assert emitted == [("threadscore", 1, {"score": 101})]
+
+
+def test_chat_backlog(app):
+    "The chat history is sent in pages, from the newest messages back."
+    rconn.delete(CHAT_KEY)
+    assert chat_backlog() == ("[]", None)
+    for n in range(45):
+        rconn.xadd(CHAT_KEY, {"msg": json.dumps({"user": "u", "msg": str(n)})})
+
+    pages = []
+    messages, cursor = chat_backlog()
+    pages.append([m["msg"] for m in json.loads(messages)])
+    while cursor is not None:
+        messages, cursor = chat_backlog(cursor)
+        pages.append([m["msg"] for m in json.loads(messages)])
+    assert pages == [
+        [str(n) for n in range(25, 45)],
+        [str(n) for n in range(5, 25)],
+        [str(n) for n in range(5)],
+    ]
+
+    messages, cursor = chat_backlog(count=45)
+    assert len(json.loads(messages)) == 45
+    assert cursor is None
+
+
+def worker(sent):
+    """A worker with a sharded client manager, which records the packets
+    it sends to its clients."""
+    manager = ShardedRedisManager(
+        config.app.redis_url, channel="test-sharded", shards=8, resubscribe_interval=60
+    )
+    server = socketio.Server(client_manager=manager, async_mode="threading")
+    server._send_eio_packet = lambda eio_sid, packet: sent.append(
+        (eio_sid, packet.data)
+    )
+    manager.initialize()
+    return manager
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_sharded_fan_out(app):
+    "Events to a room reach only the workers with clients in it, via its shard."
+    sent = []
+    first, second = worker(sent), worker(sent)
+    assert wait_for(lambda: first.listener and second.listener)
+
+    sid = second.connect("client", "/snt")
+    second.enter_room(sid, "/snt", "post1")
+    other = next(
+        room
+        for room in ("post{0}".format(n) for n in range(2, 100))
+        if first.room_channel(room) != first.room_channel("post1")
+        and first.room_channel(room) != first.room_channel(sid)
+    )
+    assert second.subscribed == {
+        second.room_channel(sid),
+        second.room_channel("post1"),
+    }
+    assert first.subscribed == set()
+    assert first.message_channel({"method": "emit", "room": "post1"}) == (
+        first.room_channel("post1")
+    )
+    assert first.message_channel({"method": "emit", "room": None}) == "test-sharded"
+    assert first.message_channel({"method": "close_room", "room": "x"}) == (
+        "test-sharded"
+    )
+
+    # Wait until the subscriptions have been processed by Redis.
+    assert wait_for(
+        lambda: dict(rconn.pubsub_numsub(second.room_channel("post1")))[
+            second.room_channel("post1").encode()
+        ]
+        == 1
+    )
+    first.emit("threadscore", {"score": 2}, namespace="/snt", room="post1")
+    first.emit("threadscore", {"score": 3}, namespace="/snt", room=other)
+    first.emit("announcement", {"pid": 1}, namespace="/snt")
+    assert wait_for(lambda: len(sent) == 2)
+    time.sleep(0.1)
+    assert sent == [
+        ("client", '2/snt,["threadscore",{"score":2}]'),
+        ("client", '2/snt,["announcement",{"pid":1}]'),
+    ]
+
+    second.leave_room(sid, "/snt", "post1")
+    second.resubscribe()
+    assert second.subscribed == {second.room_channel(sid)}
@@ -0,0 +1,101 @@
+import hashlib
+import io
+import os
+
+import pytest
+from PIL import Image, PngImagePlugin
+from werkzeug.datastructures import FileStorage
+
+from app.storage import SizeLimitExceededError, SPOOL_MAX_MEMORY
+from app.storage import clear_metadata, spool_upload
+
+ORIENTATION, MAKE = 274, 271
+
+
+def image_with_metadata(fmt):
+    """Returns an image file with an orientation, a camera make and a
+    comment, in the given format."""
+    image = Image.new("RGB", (64, 48), (200, 30, 30))
+    for x in range(64):
+        image.putpixel((x, x % 48), (0, 0, x * 4))
+    exif = Image.Exif()
+    exif[ORIENTATION] = 6
+    exif[MAKE] = "Secret Camera"
+    result = io.BytesIO()
+    if fmt == "JPEG":
+        image.save(result, "JPEG", exif=exif.tobytes(), comment=b"secret comment")
+    else:
+        info = PngImagePlugin.PngInfo()
+        info.add_text("Comment", "secret comment")
+        image.save(result, "PNG", exif=exif.tobytes(), pnginfo=info)
+    return result.getvalue()
+
+
+@pytest.mark.parametrize("fmt, mtype", [("JPEG", "image/jpeg"), ("PNG", "image/png")])
+def test_clear_metadata(fmt, mtype):
+    "Metadata other than the orientation is removed without touching the image."
+    data = image_with_metadata(fmt)
+    assert b"Secret Camera" in data and b"secret comment" in data
+
+    spool, found, fhash = spool_upload(FileStorage(io.BytesIO(data)))
+    assert found == mtype
+    assert fhash == hashlib.blake2b(data).hexdigest()
+    with spool:
+        assert spool.read() == data
+        with clear_metadata(spool, mtype) as cleaned:
+            result = cleaned.read()
+
+    assert b"Secret Camera" not in result and b"secret comment" not in result
+    original, stripped = Image.open(io.BytesIO(data)), Image.open(io.BytesIO(result))
+    assert dict(stripped.getexif()) == {ORIENTATION: 6}
+    assert stripped.tobytes() == original.tobytes()
+    if fmt == "JPEG":
+        # The compressed image data is copied as it was.
+        assert result.endswith(data[data.index(b"\xff\xda") :])
+
+
+def test_spool_upload_limits():
+    "Uploads are checked for type and size while they are copied."
+    text = FileStorage(io.BytesIO(b"just some text\n" * 1000))
+    assert spool_upload(text) == (None, None, None)
+
+    data = image_with_metadata("JPEG") + os.urandom(SPOOL_MAX_MEMORY)
+    with pytest.raises(SizeLimitExceededError):
+        spool_upload(FileStorage(io.BytesIO(data)), size_limit=len(data) - 1)
+
+    spool, mtype, fhash = spool_upload(
+        FileStorage(io.BytesIO(data)), size_limit=len(data)
+    )
+    with spool:
+        assert mtype == "image/jpeg"
+        assert fhash == hashlib.blake2b(data).hexdigest()
+        # Big uploads are kept on disk instead of in memory.
+        assert spool._rolled
+        assert spool.read() == data
+
+
+@pytest.mark.parametrize(
+    "data, error",
+    [
+        # Segment lengths too small, followed by a big file.
+        (b"\xff\xd8\xff\xe0\x00\x00" + bytes(SPOOL_MAX_MEMORY), "Invalid JPEG segment"),
+        (b"\xff\xd8\xff\xe0\x00\x01" + bytes(SPOOL_MAX_MEMORY), "Invalid JPEG segment"),
+        (b"\xff\xd8\xff\xfe\x10\x00short", "Unexpected end of file"),
+        (b"\xff\xd8\xff\xe1\x00\x0fExif\x00\x00garbage", "Invalid EXIF data"),
+    ],
+    ids=["length-0", "length-1", "truncated", "bad-exif"],
+)
+def test_clear_metadata_malformed_jpeg(data, error):
+    "Malformed JPEG files are rejected without reading the rest of them."
+    fileobj = io.BytesIO(data)
+    read = fileobj.read
+    sizes = []
+
+    def bounded_read(size=-1):
+        sizes.append(size)
+        return read(size)
+
+    fileobj.read = bounded_read
+    with pytest.raises(ValueError, match=error):
+        clear_metadata(fileobj, "image/jpeg").close()
+    assert all(0 <= size < 0x10000 for size in sizes)
@@ -0,0 +1,139 @@
+import json
+from bs4 import BeautifulSoup
+from flask import url_for
+
+from app.config import config
+from app.models import rconn, SubPost, SubPostComment, SubPostCommentVote
+from app.models import SubPostVote, User
+from app.votes import vote_counters, DIRTY_KEY
+from cli.recount import votes
+from test.utilities import (
+    create_sub,
+    csrf_token,
+    log_out_current_user,
+    promote_user_to_admin,
+    register_user,
+)
+
+
+def test_batched_votes(app, client, user_info, user2_info):
+    "Batched vote counters are applied by the flusher and can be reconciled."
+    config.update_value("site.sub_creation_min_level", 0)
+    register_user(client, user_info)
+    create_sub(client)
+    rv = client.get(url_for("subs.submit", ptype="text", sub="test"))
+    csrf = csrf_token(rv.data)
+    rv = client.post(
+        url_for("subs.submit", ptype="text", sub="test"),
+        data={
+            "csrf_token": csrf,
+            "title": "the title",
+            "ptype": "text",
+            "content": "the content",
+        },
+        follow_redirects=False,
+    )
+    soup = BeautifulSoup(rv.data, "html.parser", from_encoding="utf-8")
+    pid = int(soup.a.get_text().split("/")[-1])
+    log_out_current_user(client)
+
+    register_user(client, user2_info)
+    rconn.delete(DIRTY_KEY)
+    vote_counters.enabled = True
+    try:
+        rv = client.post(
+            url_for("do.upvote", pid=pid, value="up"), data={"csrf_token": csrf}
+        )
+        assert rv.json["score"] == 2
+        assert SubPost.get_by_id(pid).score == 1
+        assert vote_counters.pending("post", pid) == {"score": 1, "upvotes": 1}
+
+        hot = SubPost.get_by_id(pid).hot
+        assert vote_counters.flush() == 3
+        post = SubPost.get_by_id(pid)
+        assert (post.score, post.upvotes, post.downvotes) == (2, 2, 0)
+        assert post.hot == hot + 20
+        assert User.get(User.name == user_info["username"]).score == 1
+        assert User.get(User.name == user2_info["username"]).given == 1
+    finally:
+        vote_counters.enabled = False
+
+    SubPost.update(score=10, downvotes=3).where(SubPost.pid == pid).execute()
+    result = app.test_cli_runner().invoke(votes, ["--save"])
+    assert result.exit_code == 0
+    post = SubPost.get_by_id(pid)
+    assert (post.score, post.upvotes, post.downvotes) == (2, 2, 0)
+
+
+def test_undo_votes(client, user_info, user2_info, user3_info):
+    "Admins can remove all the votes of a user at once."
+    config.update_value("site.sub_creation_min_level", 0)
+    register_user(client, user_info)
+    create_sub(client)
+    rv = client.get(url_for("subs.submit", ptype="text", sub="test"))
+    csrf = csrf_token(rv.data)
+
+    def submit(title):
+        rv = client.post(
+            url_for("subs.submit", ptype="text", sub="test"),
+            data={"csrf_token": csrf, "title": title, "ptype": "text", "content": "x"},
+        )
+        soup = BeautifulSoup(rv.data, "html.parser", from_encoding="utf-8")
+        return int(soup.a.get_text().split("/")[-1])
+
+    def comment(pid):
+        rv = client.post(
+            url_for("do.create_comment", pid=pid),
+            data={"csrf_token": csrf, "post": pid, "parent": "0", "comment": "hi"},
+        )
+        return json.loads(rv.data.decode("utf-8"))["cid"]
+
+    pids = [submit("first"), submit("second")]
+    cid = comment(pids[0])
+    log_out_current_user(client)
+
+    register_user(client, user2_info)
+    own_pid = submit("own post")
+    for pid, value, score in [(pids[0], "up", 2), (pids[1], "down", 0)]:
+        rv = client.post(
+            url_for("do.upvote", pid=pid, value=value), data={"csrf_token": csrf}
+        )
+        assert rv.json["score"] == score
+    # The voter's own post has their automatic self vote.
+    rv = client.post(
+        url_for("do.upvotecomment", cid=cid, value="down"), data={"csrf_token": csrf}
+    )
+    assert rv.json["score"] == -1
+    log_out_current_user(client)
+
+    author = User.get(User.name == user_info["username"])
+    voter = User.get(User.name == user2_info["username"])
+    before = {pid: SubPost.get_by_id(pid) for pid in pids}
+    score_before = author.score
+
+    register_user(client, user3_info)
+    promote_user_to_admin(client, user3_info)
+    rv = client.get(url_for("user.view", user=user2_info["username"]))
+    rv = client.post(
+        url_for("do.admin_undo_votes", uid=voter.uid),
+        data={"csrf_token": csrf_token(rv.data)},
+    )
+    assert rv.status_code == 302
+
+    first, second = (SubPost.get_by_id(pid) for pid in pids)
+    assert (first.score, first.upvotes) == (before[pids[0]].score - 1, 1)
+    assert (second.score, second.downvotes) == (before[pids[1]].score + 1, 0)
+    assert second.hot > before[pids[1]].hot
+    comm = SubPostComment.get_by_id(cid)
+    assert (comm.score, comm.downvotes) == (0, 0)
+    assert User.get_by_id(author.uid).score == score_before + 1
+    assert User.get_by_id(voter.uid).given == voter.given + 1
+    # Votes on the voter's own posts are kept.
+    assert [
+        v.pid_id for v in SubPostVote.select().where(SubPostVote.uid == voter.uid)
+    ] == [own_pid]
+    assert (
+        not SubPostCommentVote.select()
+        .where(SubPostCommentVote.uid == voter.uid)
+        .exists()
+    )
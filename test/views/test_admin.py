@@ -1,9 +1,16 @@
+import datetime
 import pytest
 import pyotp
+from bs4 import BeautifulSoup
 from flask import url_for
 
-from app.models import UserMetadata, User
+from app.config import config
+from app.misc import is_domain_banned
+from app.models import rconn, UserMetadata, User, SiteDailyStats
+from app.site_stats import site_stats, DAY_KEY, DAYS_KEY
+from cli.recount import site_totals
 from test.utilities import register_user, promote_user_to_admin, csrf_token
+from test.utilities import create_sub, log_out_current_user
 
 
 @pytest.mark.parametrize("test_config", [{"site": {"enable_totp": True}}])
@@ -60,3 +67,92 @@ def test_get_totp_image(client, user_info, test_config):
     rv = client.get(url_for("admin.get_totp_image"))
     assert rv.status_code == 200
     assert rv.content_type == "image/png"
+
+
+def test_admin_page_db_stats(client, user_info):
+    register_user(client, user_info)
+    promote_user_to_admin(client, user_info)
+    rv = client.get(url_for("admin.index"))
+    assert rv.status_code == 200
+    assert b"DB checkouts" in rv.data
+
+
+def test_ban_domain(client, user_info):
+    register_user(client, user_info)
+    promote_user_to_admin(client, user_info)
+    rv = client.get(url_for("admin.index"))
+    csrf = csrf_token(rv.data)
+    assert not is_domain_banned("someone@mail.example.com", "email")
+
+    rv = client.post(
+        url_for("do.ban_domain", domain_type="email"),
+        data={"csrf_token": csrf, "domain": "example.com"},
+    )
+    assert rv.json["status"] == "ok"
+    assert is_domain_banned("someone@mail.example.com", "email")
+    assert is_domain_banned("someone@EXAMPLE.COM", "email")
+    assert not is_domain_banned("someone@example.org", "email")
+    assert not is_domain_banned("https://example.com/", "link")
+
+    rv = client.post(
+        url_for("do.remove_banned_domain", domain_type="email", domain="example.com"),
+        data={"csrf_token": csrf},
+    )
+    assert rv.status_code == 200
+    assert not is_domain_banned("someone@mail.example.com", "email")
+
+
+def test_site_stats(app, client, user_info, user2_info):
+    "The admin page shows running totals and the changes of each day."
+    today = datetime.datetime.utcnow().date()
+    rconn.delete(DAYS_KEY, DAY_KEY.format(today.isoformat()))
+    config.update_value("site.sub_creation_min_level", 0)
+    register_user(client, user_info)
+    create_sub(client)
+    rv = client.get(url_for("subs.submit", ptype="text", sub="test"))
+    csrf = csrf_token(rv.data)
+    rv = client.post(
+        url_for("subs.submit", ptype="text", sub="test"),
+        data={
+            "csrf_token": csrf,
+            "title": "the title",
+            "ptype": "text",
+            "content": "x",
+        },
+    )
+    soup = BeautifulSoup(rv.data, "html.parser", from_encoding="utf-8")
+    pid = int(soup.a.get_text().split("/")[-1])
+    log_out_current_user(client)
+
+    register_user(client, user2_info)
+    for value in ["down", "up"]:
+        client.post(
+            url_for("do.upvote", pid=pid, value=value), data={"csrf_token": csrf}
+        )
+    promote_user_to_admin(client, user2_info)
+
+    expected = {
+        "users": 2,
+        "subs": 1,
+        "posts": 1,
+        "comments": 0,
+        "upvotes": 2,
+        "downvotes": 0,
+    }
+    assert site_stats.totals() == expected == site_stats.count()
+    rv = client.get(url_for("admin.index"))
+    assert rv.status_code == 200
+    soup = BeautifulSoup(rv.data, "html.parser", from_encoding="utf-8")
+    totals = soup.find("div", class_="stats").find("tbody").find_all("td")
+    assert [td.get_text() for td in totals] == ["2", "1", "1", "0", "+2 | -0"]
+    day = SiteDailyStats.get_by_id(today)
+    assert (day.users, day.posts, day.upvotes, day.downvotes) == (2, 1, 2, 0)
+    row = soup.find("table", id="daily-stats").find("tbody").find("tr")
+    assert row.find("td").get_text() == str(today)
+
+    site_stats.add(posts=5)
+    result = app.test_cli_runner().invoke(site_totals, ["--history"])
+    assert result.exit_code == 0
+    assert "posts                      6         1" in result.output
+    assert "Stored the statistics of 1 days" in result.output
+    assert site_stats.totals() == expected
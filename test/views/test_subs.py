@@ -1,4 +1,5 @@
 import datetime
+import io
 import re
 import pytest
 import mock
@@ -6,7 +7,10 @@ import requests.exceptions
 from bs4 import BeautifulSoup
 from flask import url_for
 from test.utilities import register_user, csrf_token, create_sub
-from app.models import Sub, SubMetadata
+from app.misc import banned_domains, is_domain_banned, link_domain
+from app.misc import BannedDomains, BANNED_DOMAINS_VERSION_KEY, domain_key
+from app.misc import update_post_hot_rank
+from app.models import rconn, SiteMetadata, Sub, SubMetadata, SubPost, User
 
 
 def get_error(data):
@@ -104,6 +108,30 @@ def test_submit_text_post(client, user_info, test_config):
     assert b"Testing! |  test" in rv.data
 
 
+@pytest.mark.parametrize(
+    "test_config",
+    [{"site": {"sub_creation_min_level": 0, "allow_uploads": True}}],
+)
+def test_submit_malformed_upload(client, user_info, test_config):
+    register_user(client, user_info)
+    create_sub(client)
+    rv = client.get(url_for("subs.submit", ptype="upload", sub="test"))
+    # Looks like a JPEG file, but its first segment has an invalid length.
+    data = {
+        "csrf_token": csrf_token(rv.data),
+        "title": "Broken image",
+        "ptype": "upload",
+        "files": (io.BytesIO(b"\xff\xd8\xff\xe0\x00\x00" + bytes(1024)), "a.jpg"),
+    }
+    rv = client.post(
+        url_for("subs.submit", ptype="upload", sub="test"),
+        data=data,
+        content_type="multipart/form-data",
+    )
+    assert rv.status_code == 400
+    assert get_error(rv.data) == b"File type not allowed"
+
+
 @pytest.mark.parametrize("test_config", [{"site": {"sub_creation_min_level": 0}}])
 def test_submit_link_post(client, user_info, test_config):
     with mock.patch("requests.get", side_effect=requests.exceptions.HTTPError):
@@ -248,3 +276,112 @@ def test_random_sub(client, user_info, test_config):
     rv = client.get(url_for("subs.random_sub"), follow_redirects=False)
     assert rv.status_code == 302
     assert "/s/test" == rv.location
+
+
+@pytest.mark.parametrize("test_config", [{"site": {"sub_creation_min_level": 0}}])
+def test_post_list_cursor(client, user_info, test_config):
+    register_user(client, user_info)
+    create_sub(client)
+    sub = Sub.get(Sub.name == "test")
+    user = User.get(User.name == user_info["username"])
+    for i in range(30):
+        post = SubPost.create(
+            sid=sub.sid, uid=user.uid, title=f"post {i}", score=i % 4, comments=0
+        )
+        update_post_hot_rank(post.pid)
+
+    def pids(data):
+        soup = BeautifulSoup(data, "html.parser", from_encoding="utf-8")
+        return [int(div["pid"]) for div in soup.find_all("div", class_="post")]
+
+    for sort in ["new", "top", "hot"]:
+        rv = client.get(url_for(f"home.all_{sort}"))
+        first = pids(rv.data)
+        assert len(first) == 25
+        rv = client.get(url_for(f"home.all_{sort}", page=2))
+        by_page = pids(rv.data)
+        assert len(by_page) == 5
+        rv = client.get(url_for(f"home.all_{sort}", page=2, after=first[-1]))
+        assert pids(rv.data) == by_page
+        rv = client.get(url_for("home.all_more", sort=sort, page=2, pid=first[-1]))
+        assert pids(rv.data) == by_page
+
+
+@pytest.mark.parametrize("test_config", [{"site": {"sub_creation_min_level": 0}}])
+def test_sub_typeahead(client, user_info, test_config):
+    register_user(client, user_info)
+    for name in ["pictures", "Pics", "pie", "games"]:
+        create_sub(client, name)
+    Sub.update(subscribers=5).where(Sub.name == "pie").execute()
+
+    def typeahead(prefix):
+        rv = client.get(url_for("apiv3.typeahead_sub", q=prefix))
+        return [sub["name"] for sub in rv.json["results"]]
+
+    # The most subscribed subs come first.
+    assert typeahead("pi") == ["pie", "Pics", "pictures"]
+    assert typeahead("PICS") == ["Pics"]
+    assert typeahead("x") == []
+    assert typeahead("%") == []
+
+    # New subs show up right away, and an exact match comes first.
+    create_sub(client, "pi")
+    assert typeahead("pi") == ["pi", "pie", "Pics", "pictures"]
+
+    # It doesn't shadow a sub with the same name as the route.
+    create_sub(client, "typeahead")
+    rv = client.get(url_for("apiv3.get_sub", name="typeahead"))
+    assert rv.json["name"] == "typeahead"
+
+
+@pytest.mark.parametrize("test_config", [{"site": {"sub_creation_min_level": 0}}])
+def test_domain_listing(client, user_info, test_config):
+    register_user(client, user_info)
+    create_sub(client)
+    sub = Sub.get(Sub.name == "test")
+    user = User.get(User.name == user_info["username"])
+    links = [
+        "https://example.com/a",
+        "https://WWW.Example.com:8080/b",
+        "https://notexample.com/c",
+        "https://example.community/d",
+        "https://example.com.evil.net/e",
+    ]
+    pids = {}
+    for link in links:
+        post = SubPost.create(
+            sid=sub.sid,
+            uid=user.uid,
+            title=link,
+            link=link,
+            domain=link_domain(link),
+            ptype=1,
+            comments=0,
+        )
+        pids[link] = post.pid
+
+    rv = client.get(url_for("home.all_domain_new", domain="example.com"))
+    soup = BeautifulSoup(rv.data, "html.parser", from_encoding="utf-8")
+    listed = [int(div["pid"]) for div in soup.find_all("div", class_="post")]
+    assert listed == [pids[links[1]], pids[links[0]]]
+
+    SiteMetadata.create(key="banned_domain", value="Example.com")
+    banned_domains.invalidate()
+    assert is_domain_banned("https://WWW.EXAMPLE.COM:443/x", "link")
+    assert is_domain_banned("https://example.com./x", "link")
+    assert not is_domain_banned("https://notexample.com/x", "link")
+    assert not is_domain_banned("https://example.com.evil.net/x", "link")
+
+
+def test_banned_domains_without_version(app):
+    "The bans are loaded even if their version was never set in Redis."
+    rconn.delete(BANNED_DOMAINS_VERSION_KEY)
+    matcher = BannedDomains()
+    assert not matcher.is_banned(domain_key("example.com"), "link")
+    assert not matcher.is_banned(domain_key("example.com"), "email")
+
+    SiteMetadata.create(key="banned_domain", value="example.com")
+    rconn.delete(BANNED_DOMAINS_VERSION_KEY)
+    matcher = BannedDomains()
+    assert matcher.is_banned(domain_key("www.example.com"), "link")
+    assert not matcher.is_banned(domain_key("example.com"), "email")
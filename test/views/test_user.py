@@ -1,8 +1,45 @@
+import json
+
 from flask import url_for
-from test.utilities import register_user
+
+from app.config import config
+from app.misc import SESSION_SNAPSHOT_KEY, get_session_snapshot
+from app.models import rconn, Sub, User
+from test.utilities import create_sub, csrf_token, log_out_current_user, register_user
 
 
 def test_settings_page(client, user_info):
     register_user(client, user_info)
     username = user_info["username"]
     assert client.get(url_for("user.edit_user", user=username)).status_code == 200
+
+
+def test_session_snapshot(client, user_info, user2_info):
+    config.update_value("site.sub_creation_min_level", 0)
+    register_user(client, user_info)
+    create_sub(client)
+    uid = User.get(User.name == user_info["username"]).uid
+    sid = Sub.get(Sub.name == "test").sid
+
+    snapshot = get_session_snapshot(uid)
+    assert [s["sid"] for s in snapshot["subs"]] == [sid]
+    assert snapshot["subs_modded"] == [sid]
+    assert json.loads(rconn.get(SESSION_SNAPSHOT_KEY.format(uid))) == snapshot
+    log_out_current_user(client)
+
+    register_user(client, user2_info)
+    uid = User.get(User.name == user2_info["username"]).uid
+    key = SESSION_SNAPSHOT_KEY.format(uid)
+    assert get_session_snapshot(uid)["subs"] == []
+    assert rconn.get(key) is not None
+
+    rv = client.get(url_for("home.index"))
+    rv = client.post(
+        url_for("do.subscribe_to_sub", sid=sid),
+        data={"csrf_token": csrf_token(rv.data)},
+    )
+    assert rv.json["status"] == "ok"
+    assert rconn.get(key) is None
+    snapshot = get_session_snapshot(uid)
+    assert [s["sid"] for s in snapshot["subs"]] == [sid]
+    assert snapshot["subs_modded"] == []